@@ -0,0 +1,129 @@
+import asyncio
+import functools
+from typing import Iterable, List
+from concurrent.futures import ThreadPoolExecutor
+
+from bellastore.database.db import Db
+from bellastore.utils.scan import Scan
+
+
+class AsyncDb():
+    '''
+    An asyncio facade of `Db`, e.g. for serving slides from an async web service.
+
+    All blocking work runs on executors, so the event loop is never blocked by sqlite or file I/O:
+    - queries run on a bounded pool of `readers` threads, each with its own connection,
+      which in WAL mode do not wait for a running insert
+    - inserts and backups run one after the other on a single writer thread, so a long
+      ingest neither occupies the readers nor competes with another writer for the database lock
+
+    Attributes
+    ----------
+    db: Db
+        The wrapped database
+    readers: int
+        Number of threads running queries
+
+    Methods
+    -------
+    insert / insert_many / insert_from_ingress:
+        Awaitable versions of the `Db` inserts
+    create_backup:
+        Awaitable version of `Db.create_backup`
+    get_*:
+        Awaitable versions of the `Db` queries
+    close:
+        Waits for the running work and closes the database
+    '''
+
+    def __init__(self, db: Db, readers: int = 4):
+        self.db = db
+        self.readers = readers
+        self._readers = ThreadPoolExecutor(max_workers = readers, thread_name_prefix = 'bellastore-reader')
+        self._writer = ThreadPoolExecutor(max_workers = 1, thread_name_prefix = 'bellastore-writer')
+
+    @classmethod
+    def open(cls, root_dir, ingress_dir, filename, readers: int = 4, **kwargs) -> 'AsyncDb':
+        '''
+        Creates the facade together with its `Db`, passing `kwargs` on to `Db`.
+        '''
+        return cls(Db(root_dir, ingress_dir, filename, **kwargs), readers)
+
+    async def _run(self, executor: ThreadPoolExecutor, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
+
+    async def _read(self, func, *args, **kwargs):
+        return await self._run(self._readers, func, *args, **kwargs)
+
+    async def _write(self, func, *args, **kwargs):
+        return await self._run(self._writer, func, *args, **kwargs)
+
+    # WRITES
+
+    async def insert(self, scan: Scan):
+        '''
+        Inserts a single scan, see `Db.insert`.
+        '''
+        return await self._write(self.db.insert, scan)
+
+    async def insert_many(self, scans: Iterable[Scan], **kwargs):
+        '''
+        Inserts several scans, see `Db.insert_many` for the options.
+        '''
+        return await self._write(self.db.insert_many, scans, **kwargs)
+
+    async def insert_from_ingress(self, **kwargs) -> List[Scan]:
+        '''
+        Inserts all valid scans of the ingress, see `Db.insert_from_ingress` for the options.
+        '''
+        return await self._write(self.db.insert_from_ingress, **kwargs)
+
+    async def create_backup(self, **kwargs) -> bool:
+        '''
+        Creates a backup of the database, see `Db.create_backup` for the options.
+        '''
+        return await self._write(self.db.create_backup, **kwargs)
+
+    # QUERIES
+
+    async def get_entries_from_ingress_db(self):
+        return await self._read(self.db.get_entries_from_ingress_db)
+
+    async def get_entries_from_storage_db(self):
+        return await self._read(self.db.get_entries_from_storage_db)
+
+    async def get_scan_by_hash(self, hash: str):
+        return await self._read(self.db.get_scan_by_hash, hash)
+
+    async def get_ingress_entries_by_hash(self, hash: str):
+        return await self._read(self.db.get_ingress_entries_by_hash, hash)
+
+    async def get_scans_by_scanname(self, scanname: str):
+        return await self._read(self.db.get_scans_by_scanname, scanname)
+
+    async def get_scans_by_prefix(self, prefix: str):
+        return await self._read(self.db.get_scans_by_prefix, prefix)
+
+    async def get_scans_by_extension(self, extension: str):
+        return await self._read(self.db.get_scans_by_extension, extension)
+
+    async def get_storage_page(self, limit: int = 1000, after: str | None = None):
+        return await self._read(self.db.get_storage_page, limit, after)
+
+    async def close(self):
+        '''
+        Waits for the running calls to finish and closes all connections of the database.
+        '''
+        await asyncio.get_running_loop().run_in_executor(None, self._shutdown)
+
+    def _shutdown(self):
+        self._writer.shutdown(wait = True)
+        self._readers.shutdown(wait = True)
+        self.db.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
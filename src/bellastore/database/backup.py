@@ -0,0 +1,158 @@
+import os
+import re
+import json
+import shutil
+import sqlite3
+import tempfile
+import contextlib
+from pathlib import Path
+from datetime import datetime
+from typing import Dict, List
+
+from bellastore.utils.hashing import hash_file, fsync_dir
+from bellastore.utils.compression import open_compressed
+
+# Periods of grandfather-father-son retention, each bucketing backups by a timestamp format
+retention_periods = {
+    'hourly': '%Y%m%d%H',
+    'daily': '%Y%m%d',
+    'weekly': '%G%V',
+    'monthly': '%Y%m',
+}
+backup_timestamp = '%Y%m%d_%H%M%S'
+_backup_name = re.compile(r'_backup_(\d{8}_\d{6})')
+
+
+class BackupManifest():
+    '''
+    The list of backups of a database with their creation time, size and checksum,
+    kept as a json file next to the backups.
+
+    Retention and verification only read the manifest instead of listing and stat'ing the backup
+    directory, and do not rely on ctimes, which change when backups are copied or restored.
+    Backups from before the manifest existed are adopted once, taking the time from their name.
+
+    Attributes
+    ----------
+    path: Path
+        The manifest file, `<database>_backups.json` within the backup directory
+    entries: List[Dict]
+        The backups from old to new, each with `file`, `created`, `size`, `sha256`, `data_version`
+
+    Methods
+    -------
+    add:
+        Records a new backup file
+    retain:
+        Deletes the backups not covered by a retention policy
+    save:
+        Atomically writes the manifest
+    '''
+
+    def __init__(self, backup_dir, db_name: str):
+        self.backup_dir = Path(backup_dir)
+        self.db_name = db_name
+        self.path = self.backup_dir / f"{db_name}_backups.json"
+        if self.path.exists():
+            self.entries: List[Dict] = json.loads(self.path.read_text(encoding = 'utf-8'))
+        else:
+            self.entries = self._adopt()
+
+    def _adopt(self) -> List[Dict]:
+        entries = []
+        for path in sorted(self.backup_dir.glob(f"{self.db_name}_backup_*.sqlite*")):
+            match = _backup_name.search(path.name)
+            if match is None:
+                continue
+            created = datetime.strptime(match.group(1), backup_timestamp)
+            entries.append(self._entry(path, created, None))
+        return entries
+
+    @staticmethod
+    def _entry(path: Path, created: datetime, data_version) -> Dict:
+        return {
+            'file': path.name,
+            'created': created.isoformat(timespec = 'seconds'),
+            'size': path.stat().st_size,
+            'sha256': hash_file(str(path)).hex(),
+            'data_version': data_version,
+        }
+
+    def add(self, path: Path, created: datetime, data_version = None) -> Dict:
+        entry = self._entry(Path(path), created, data_version)
+        self.entries = [other for other in self.entries if other['file'] != entry['file']] + [entry]
+        return entry
+
+    def save(self):
+        partial = self.path.with_name(self.path.name + '.partial')
+        with open(partial, 'w', encoding = 'utf-8') as f:
+            json.dump(self.entries, f, indent = 1)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(partial, self.path)
+        fsync_dir(str(self.backup_dir))
+
+    def retain(self, last: int = 10, **periods: int) -> List[Dict]:
+        '''
+        Deletes all backups except for the `last` newest and, per period of `retention_periods`
+        (e.g. `daily = 7`), the newest backup of each of the most recent periods.
+
+        Returns:
+            removed (List[Dict]): the entries of the deleted backups
+        '''
+        for period in periods:
+            if period not in retention_periods:
+                raise ValueError(f"Unknown retention period {period}, choose one of {list(retention_periods)}")
+        newest_first = sorted(self.entries, key = lambda entry: entry['created'], reverse = True)
+        keep = {entry['file'] for entry in newest_first[:last]}
+        for period, amount in periods.items():
+            buckets = set()
+            for entry in newest_first:
+                if len(buckets) >= amount:
+                    break
+                bucket = datetime.fromisoformat(entry['created']).strftime(retention_periods[period])
+                if bucket not in buckets:
+                    buckets.add(bucket)
+                    keep.add(entry['file'])
+        removed = [entry for entry in self.entries if entry['file'] not in keep]
+        self.entries = [entry for entry in self.entries if entry['file'] in keep]
+        # the manifest goes first, so it never lists a deleted backup
+        self.save()
+        for entry in removed:
+            with contextlib.suppress(FileNotFoundError):
+                (self.backup_dir / entry['file']).unlink()
+        return removed
+
+
+def verify_backup(backup_dir, entry: Dict) -> List[str]:
+    '''
+    Checks a backup against its manifest entry: existence, size, checksum and sqlite's `quick_check`.
+    Compressed backups are decompressed into a temporary file for the latter.
+
+    Returns:
+        problems (List[str]): empty if the backup is intact
+    '''
+    path = Path(backup_dir) / entry['file']
+    if not path.exists():
+        return [f"{entry['file']} is missing"]
+    if path.stat().st_size != entry['size']:
+        return [f"{entry['file']} has {path.stat().st_size} instead of {entry['size']} bytes"]
+    if hash_file(str(path)).hex() != entry['sha256']:
+        return [f"{entry['file']} does not match its checksum"]
+    with tempfile.TemporaryDirectory(dir = backup_dir) as tmp:
+        database = path
+        if not path.name.endswith('.sqlite'):
+            database = Path(tmp) / 'backup.sqlite'
+            try:
+                with open_compressed(path, 'rb') as f, open(database, 'wb') as out:
+                    shutil.copyfileobj(f, out, 2**20)
+            except Exception as e:
+                return [f"{entry['file']} can not be decompressed: {e}"]
+        try:
+            with contextlib.closing(sqlite3.connect(f"{database.as_uri()}?mode=ro", uri = True)) as conn:
+                result = [row[0] for row in conn.execute("PRAGMA quick_check")]
+        except sqlite3.DatabaseError as e:
+            return [f"{entry['file']} is not a valid database: {e}"]
+    if result != ['ok']:
+        return [f"{entry['file']} fails the integrity check: {message}" for message in result]
+    return []
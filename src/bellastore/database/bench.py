@@ -0,0 +1,220 @@
+import os
+import time
+import base64
+import random
+import hashlib
+from pathlib import Path
+from typing import Dict, Iterator, List
+
+from bellastore.filesystem.fs import Fs
+from bellastore.database.db import Db
+from bellastore.utils.scan import Scan
+from bellastore.utils.table import format_bytes
+
+# Bytes of random content at the head and the tail of a synthetic scan, the rest is a hole
+unique_span = 64 * 2**10
+
+
+def create_sparse_scan(path, size: int, seed: int = 0) -> Scan:
+    '''
+    Creates a scan of `size` bytes that is unique (random head and tail) but sparse in between,
+    so a slide of several GiB costs neither the time to write nor the disk space.
+    Hashing still reads every byte, holes are read as zeros.
+    '''
+    path = Path(path)
+    os.makedirs(path.parent, exist_ok = True)
+    rng = random.Random(seed)
+    span = min(unique_span, size // 2)
+    with open(path, 'wb') as f:
+        f.write(rng.randbytes(span))
+        f.truncate(size)
+        f.seek(size - span)
+        f.write(rng.randbytes(span))
+    return Scan(str(path))
+
+
+def create_mrxs_scan(path, name: str, files: int, size: int, seed: int = 0) -> Scan:
+    '''
+    Creates a MIRAX scan, the index file plus a companion folder with `files` sparse data files of `size` bytes.
+    '''
+    path = Path(path)
+    os.makedirs(path / name, exist_ok = True)
+    (path / f"{name}.mrxs").write_text(f"Index of {name} ({seed})", encoding = "utf-8")
+    (path / name / "Slidedat.ini").write_text(f"Slide data of {name} ({seed})", encoding = "utf-8")
+    for i in range(files):
+        create_sparse_scan(path / name / f"Data{i:04d}.dat", size, seed = seed * files + i)
+    return Scan(str(path / f"{name}.mrxs"))
+
+
+def create_ingress(
+        ingress_dir, scans: int, size: int, depth: int = 1, fanout: int = 10,
+        mrxs: int = 0, mrxs_files: int = 10, seed: int = 0
+    ) -> List[Scan]:
+    '''
+    Fills the ingress with `scans` sparse scans spread over a tree of `depth` levels with `fanout`
+    folders each, as well as `mrxs` MIRAX scans at the top level.
+    '''
+    created = []
+    folders = [Path(ingress_dir)]
+    for _ in range(depth - 1):
+        folders = [folder / f"level_{i}" for folder in folders for i in range(fanout)]
+    for i in range(scans):
+        folder = folders[i % len(folders)]
+        created.append(create_sparse_scan(folder / f"scan_{i}.ndpi", size, seed = seed + i))
+    for i in range(mrxs):
+        created.append(create_mrxs_scan(ingress_dir, f"mrxs_{i}", mrxs_files, size // max(mrxs_files, 1), seed = seed + scans + i))
+    return created
+
+
+def synthetic_hash(i: int) -> str:
+    return base64.urlsafe_b64encode(hashlib.sha256(str(i).encode()).digest()).decode()
+
+
+def fill_db(db, rows: int, batch_size: int = 10000) -> int:
+    '''
+    Records `rows` synthetic scans in the ingress and storage tables without creating any files.
+
+    Returns:
+        rows (int): the number of rows added per table
+    '''
+    conn = db._connection()
+    with db.session() as session:
+        for start in range(0, rows, batch_size):
+            batch = []
+            for i in range(start, min(start + batch_size, rows)):
+                hash = synthetic_hash(i)
+                filename = f"synthetic_{i}.ndpi"
+                batch.append((hash, os.path.join(db.get_scan_dir(hash), filename), filename, f"synthetic_{i}"))
+            conn.executemany(
+                "INSERT INTO ingress (hash, filepath, filename) VALUES (?, ?, ?)",
+                [(hash, os.path.join(db.ingress_dir or db.root_dir, filename), filename) for hash, _, filename, _ in batch]
+            )
+            conn.executemany("INSERT INTO storage (hash, filepath, filename, scanname) VALUES (?, ?, ?, ?)", batch)
+            session.commit()
+    return rows
+
+
+def _percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+def stage_result(stage: str, seconds: float, items: int, bytes: int = 0, latencies: List[float] | None = None) -> Dict:
+    '''
+    The record of a stage: its duration, throughput and, if measured per item, the latency distribution.
+    '''
+    result = {
+        'type': 'stage', 'stage': stage, 'seconds': seconds, 'items': items, 'bytes': bytes,
+        'items_per_second': items / seconds if seconds else 0.0,
+        'bytes_per_second': bytes / seconds if seconds else 0.0,
+    }
+    if latencies:
+        result['latency_mean'] = sum(latencies) / len(latencies)
+        result['latency_p50'] = _percentile(latencies, 0.5)
+        result['latency_p95'] = _percentile(latencies, 0.95)
+        result['latency_max'] = max(latencies)
+    return result
+
+
+def _timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def run_benchmarks(
+        work_dir, scans: int = 20, size: int = 64 * 2**20, depth: int = 3, fanout: int = 4,
+        mrxs: int = 2, mrxs_files: int = 10, rows: int = 100000, lookups: int = 1000,
+        workers: int = 1, move_workers: int = 1, seed: int = 0
+    ) -> Iterator[Dict]:
+    '''
+    Generator running the hot paths on synthetic data within `work_dir` and yielding a record per stage:
+
+    - `walk`: listing the ingress tree (`Fs._get_files`)
+    - `hash`: hashing every scan on its own (`Scan.hash_scan`), with the latency per scan
+    - `insert`: `Db.insert_from_ingress`, i.e. hashing, recording and moving
+    - `fill`: recording `rows` synthetic scans in batches
+    - `lookup`: `Db.get_scan_by_hash` for random stored hashes, with the latency per lookup
+    - `page`: paging through the whole storage table (`Db.iter_rows`)
+    - `backup`: `Db.create_backup` of the filled database
+
+    The hash cache is disabled, so every stage does the full work.
+    '''
+    work_dir = Path(work_dir)
+    root_dir = work_dir / 'root'
+    ingress_dir = work_dir / 'ingress'
+    os.makedirs(root_dir)
+    os.makedirs(ingress_dir)
+    setup, created = _timed(create_ingress, ingress_dir, scans, size, depth, fanout, mrxs, mrxs_files, seed)
+    total_bytes = sum(os.path.getsize(file) for scan in created for file in scan.get_files())
+    yield {'type': 'setup', 'scans': len(created), 'bytes': total_bytes, 'seconds': setup}
+
+    seconds, files = _timed(Fs._get_files, str(ingress_dir))
+    yield stage_result('walk', seconds, len(files))
+
+    latencies = []
+    for scan in created:
+        latency, _ = _timed(Scan(scan.path).hash_scan)
+        latencies.append(latency)
+    yield stage_result('hash', sum(latencies), len(created), total_bytes, latencies)
+
+    db = Db(root_dir, str(ingress_dir), 'bench.sqlite', use_hash_cache = False)
+    try:
+        seconds, inserted = _timed(db.insert_from_ingress, workers, move_workers = move_workers)
+        yield stage_result('insert', seconds, len(inserted), total_bytes)
+
+        seconds, _ = _timed(fill_db, db, rows)
+        yield stage_result('fill', seconds, rows)
+
+        rng = random.Random(seed)
+        latencies = []
+        for _ in range(lookups if rows else 0):
+            latency, _ = _timed(db.get_scan_by_hash, synthetic_hash(rng.randrange(rows)))
+            latencies.append(latency)
+        yield stage_result('lookup', sum(latencies), len(latencies), latencies = latencies)
+
+        seconds, paged = _timed(lambda: sum(1 for _ in db.iter_rows('storage')))
+        yield stage_result('page', seconds, paged)
+
+        size = os.path.getsize(db.sqlite_path)
+        seconds, _ = _timed(db.create_backup, force = True)
+        yield stage_result('backup', seconds, 1, size)
+    finally:
+        db.close()
+
+
+def format_result(record: Dict) -> str:
+    '''
+    Renders a record of `run_benchmarks` as a line of plain text.
+    '''
+    if record['type'] == 'setup':
+        return f"setup: {record['scans']} scans, {format_bytes(record['bytes'])} in {record['seconds']:.2f}s"
+    line = f"{record['stage']}: {record['items']} items in {record['seconds']:.3f}s, {record['items_per_second']:.1f} items/s"
+    if record['bytes']:
+        line += f", {format_bytes(record['bytes_per_second'])}/s"
+    if 'latency_mean' in record:
+        line += ', latency ' + ' '.join(
+            f"{name} {record[f'latency_{name}'] * 1000:.2f}ms" for name in ['mean', 'p50', 'p95', 'max']
+        )
+    return line
+
+
+def compare_results(results: List[Dict], baseline: List[Dict], tolerance: float = 0.2) -> List[str]:
+    '''
+    Compares the throughput of the stages with a previous run (e.g. read back from `--format jsonl`).
+
+    Returns:
+        regressions (List[str]): the stages that are more than `tolerance` slower than in the baseline
+    '''
+    previous = {record['stage']: record for record in baseline if record.get('type') == 'stage'}
+    regressions = []
+    for record in results:
+        if record['type'] != 'stage' or record['stage'] not in previous:
+            continue
+        before = previous[record['stage']]['items_per_second']
+        if before and record['items_per_second'] < (1 - tolerance) * before:
+            regressions.append(
+                f"{record['stage']}: {record['items_per_second']:.1f} items/s, "
+                f"{(1 - record['items_per_second'] / before) * 100:.0f}% slower than {before:.1f} items/s"
+            )
+    return regressions
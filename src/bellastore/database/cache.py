@@ -0,0 +1,138 @@
+import os
+from typing import Tuple
+
+from bellastore.database.connection import SideTable, sqlite_connection, add_missing_columns, prefix_range
+from bellastore.utils.constants import multi_file_extensions
+from bellastore.utils.scan import Scan
+
+
+class HashCache(SideTable):
+    '''
+    A persistent cache of scan hashes kept in a side table of the database.
+
+    Entries are keyed on the path and only valid as long as the identity of the file,
+    i.e. its size, modification time and inode, did not change.
+    This way e.g. a dry run followed by the actual insert reads every scan only once.
+    The fingerprint of a scan is cached alongside its hash, so it is recorded without reading the scan again.
+
+    Multi-file scans (`.mrxs`) are never cached, as their companion files may change
+    without the identity of the index file changing.
+
+    Entries are stored and discarded by the thread inserting scans, within its transactions (see `SideTable`).
+
+    Attributes
+    ----------
+    db: Db
+        The database holding the cache table, which also hands out the connections
+
+    Methods
+    -------
+    lookup:
+        Returns the cached hash of a file if it did not change since it was cached
+    lookup_scan:
+        Takes over the cached hash and fingerprint of a scan if it did not change since it was cached
+    store:
+        Caches the hash of a file
+    discard:
+        Removes the entry of a file, e.g. after moving it
+    evict_stale:
+        Removes all entries of files that are gone or changed
+    '''
+
+    def __init__(self, db):
+        super().__init__(db)
+        self._initialize_table()
+
+    @sqlite_connection
+    def _initialize_table(self, cursor):
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS hash_cache (
+            filepath TEXT NOT NULL PRIMARY KEY,
+            size INTEGER,
+            mtime_ns INTEGER,
+            inode INTEGER,
+            hash TEXT,
+            fingerprint TEXT
+        )
+        ''')
+        add_missing_columns(cursor, 'hash_cache', {'fingerprint': 'TEXT'})
+
+    @staticmethod
+    def _identity(path: str) -> Tuple[int, int, int] | None:
+        if any(path.endswith(ending) for ending in multi_file_extensions):
+            return None
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+    def _entry(self, cursor, path: str) -> tuple | None:
+        cursor.execute("SELECT size, mtime_ns, inode, hash, fingerprint FROM hash_cache WHERE filepath = ?", (path, ))
+        entry = cursor.fetchone()
+        if entry is None or self._identity(path) != tuple(entry[:3]):
+            return None
+        return entry
+
+    @sqlite_connection
+    def lookup(self, cursor, path: str) -> str | None:
+        '''
+        Returns the cached hash of the file at `path` or `None` if there is none or the file changed.
+        '''
+        entry = self._entry(cursor, path)
+        return None if entry is None else entry[3]
+
+    @sqlite_connection
+    def lookup_scan(self, cursor, scan: Scan) -> str | None:
+        '''
+        Returns the cached hash of the scan (see `lookup`) and sets its hash as well as its fingerprint, if cached.
+        '''
+        entry = self._entry(cursor, scan.path)
+        if entry is None:
+            return None
+        scan.hash = entry[3]
+        if entry[4] is not None:
+            scan.size, scan.fingerprint = entry[0], entry[4]
+        return scan.hash
+
+    @sqlite_connection
+    def store(self, cursor, path: str, hash: str, fingerprint: str | None = None):
+        identity = self._identity(path)
+        if identity is None or hash is None:
+            return
+        cursor.execute(
+            "INSERT OR REPLACE INTO hash_cache (filepath, size, mtime_ns, inode, hash, fingerprint) VALUES (?, ?, ?, ?, ?, ?)",
+            (path, *identity, hash, fingerprint)
+        )
+
+    @sqlite_connection
+    def discard(self, cursor, path: str):
+        cursor.execute("DELETE FROM hash_cache WHERE filepath = ?", (path, ))
+
+    @sqlite_connection
+    def evict_stale(self, cursor, prefix: str | None = None) -> int:
+        '''
+        Removes the entries of all files that are gone or changed since they were cached.
+
+        Args:
+            prefix (str | None): only check entries with paths starting with this prefix, e.g. the ingress
+
+        Returns:
+            amount (int): the number of evicted entries
+        '''
+        if prefix:
+            # range on the primary key
+            cursor.execute(
+                "SELECT filepath, size, mtime_ns, inode FROM hash_cache WHERE filepath >= ? AND filepath < ?",
+                prefix_range(prefix)
+            )
+        else:
+            cursor.execute("SELECT filepath, size, mtime_ns, inode FROM hash_cache")
+        stale = [(entry[0], ) for entry in cursor.fetchall() if self._identity(entry[0]) != tuple(entry[1:])]
+        cursor.executemany("DELETE FROM hash_cache WHERE filepath = ?", stale)
+        return len(stale)
+
+    @sqlite_connection
+    def __len__(self, cursor) -> int:
+        cursor.execute("SELECT COUNT(*) FROM hash_cache")
+        return cursor.fetchone()[0]
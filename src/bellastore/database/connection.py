@@ -0,0 +1,116 @@
+import sqlite3
+import functools
+from typing import Dict, Tuple
+
+# Pragmas applied to every connection, see https://www.sqlite.org/pragma.html
+# In WAL mode `synchronous = NORMAL` is still safe against corruption and the
+# negative cache size is in KiB, i.e. 64 MiB of page cache per connection
+sqlite_pragmas = {
+    'synchronous': 'NORMAL',
+    'cache_size': -65536,
+    'temp_store': 'MEMORY',
+}
+
+# DATABSES
+class Session():
+    '''
+    A transaction held open on a connection across many calls.
+
+    Within a session every call decorated by `sqlite_connection` runs inside a savepoint
+    of the running transaction, so a failing call only rolls back its own records.
+    The transaction is committed every `batch_size` units (see `checkpoint`) and when the session ends.
+    '''
+
+    def __init__(self, conn: sqlite3.Connection, batch_size: int | None = None):
+        self.conn = conn
+        self.batch_size = batch_size
+        self.pending = 0
+        self.conn.execute("BEGIN")
+
+    def checkpoint(self):
+        '''
+        Marks one unit (e.g. a scan) as done and commits if `batch_size` units are pending.
+        '''
+        self.pending += 1
+        if self.batch_size and self.pending >= self.batch_size:
+            self.commit()
+
+    def commit(self):
+        self.conn.execute("COMMIT")
+        self.pending = 0
+        self.conn.execute("BEGIN")
+
+    def end(self):
+        # Failing units are already rolled back by their savepoints, everything else
+        # has physically happened and thus has to be committed
+        self.conn.execute("COMMIT")
+
+
+def sqlite_connection(func):
+    ''' 
+    Decorator allowing for comprehensive sqlite connection
+
+    The decorated method's instance has to hand out connections by `_connection()`, see `Db._connection`.
+    The call runs on the persistent connection of the current thread.
+    If no transaction is running the call is committed on its own, otherwise
+    (within a session or a nested call) it is wrapped in a savepoint of the running transaction.
+    '''
+    
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        conn = self._connection()
+        cursor = conn.cursor()
+        if conn.in_transaction:
+            cursor.execute("SAVEPOINT bellastore")
+            try:
+                result = func(self, cursor, *args, **kwargs)
+                cursor.execute("RELEASE bellastore")
+                return result
+            except Exception as e:
+                cursor.execute("ROLLBACK TO bellastore")
+                cursor.execute("RELEASE bellastore")
+                raise e
+        cursor.execute("BEGIN")
+        try:
+            result = func(self, cursor, *args, **kwargs)
+            cursor.execute("COMMIT")
+            return result
+        except Exception as e:
+            cursor.execute("ROLLBACK")
+            raise e
+    return wrapper
+
+
+class SideTable():
+    '''
+    Base of the classes keeping their state in a side table of a `Db`, e.g. `HashCache`.
+
+    Their calls decorated by `sqlite_connection` run on the persistent connection of the calling thread
+    handed out by the database, so they join a session running on that thread.
+    '''
+
+    def __init__(self, db):
+        self.db = db
+
+    def _connection(self) -> sqlite3.Connection:
+        return self.db._connection()
+
+
+def prefix_range(prefix: str) -> Tuple[str, str]:
+    '''
+    Returns the bounds `[lower, upper)` of the strings starting with the (non-empty) `prefix`,
+    so they are found by a range on an index, as opposed to `LIKE` which is case insensitive and can not use it.
+    Strings are compared bytewise in utf-8, which preserves the order of code points.
+    '''
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def add_missing_columns(cursor: sqlite3.Cursor, table: str, columns: Dict[str, str]):
+    '''
+    Adds the `columns` (name -> type) a table created by an older version lacks.
+    '''
+    cursor.execute(f"PRAGMA table_info({table})")
+    existing = {row[1] for row in cursor.fetchall()}
+    for name, type in columns.items():
+        if name not in existing:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {name} {type}")
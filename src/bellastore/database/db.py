@@ -1,39 +1,65 @@
 import os
 from os.path import join as _j
 import sqlite3
-from typing import List
-import functools
-import pandas as pd
+from typing import Dict, List, Iterable, Iterator
+import itertools
+from collections import deque
+import contextlib
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import logging
 from pathlib import Path
 
-from bellastore.filesystem.fs import Fs
-from bellastore.utils.scan import Scan
+from bellastore.filesystem.fs import Fs, parse_layout, format_layout
+from bellastore.database.connection import Session, sqlite_connection, sqlite_pragmas, prefix_range
+from bellastore.database.cache import HashCache
+from bellastore.database.journal import IngestJournal
+from bellastore.database.index import DedupIndex
+from bellastore.database.pipeline import IngestPipeline, hash_pools
+from bellastore.database.report import iter_report, format_record
+from bellastore.database.backup import BackupManifest, verify_backup, backup_timestamp
+from bellastore.utils.scan import Scan, is_scan_hash
+from bellastore.utils.constants import scan_extensions
+from bellastore.utils.compression import compression_suffixes, open_compressed
+from bellastore.utils.metrics import Metrics
+
+logger = logging.getLogger(__name__)
+
+# Secondary indexes serving the query methods of `Db`
+# The ingress hash is already covered by UNIQUE(hash, filepath, filename) and the storage hash is the primary key.
+# As storage filenames are the scannames plus the extension, the extension index is an expression index.
+secondary_indexes = [
+    "CREATE INDEX IF NOT EXISTS idx_ingress_filepath ON ingress(filepath)",
+    "CREATE INDEX IF NOT EXISTS idx_ingress_filename ON ingress(filename)",
+    "CREATE INDEX IF NOT EXISTS idx_storage_filepath ON storage(filepath)",
+    "CREATE INDEX IF NOT EXISTS idx_storage_filename ON storage(filename)",
+    "CREATE INDEX IF NOT EXISTS idx_storage_scanname ON storage(scanname)",
+    "CREATE INDEX IF NOT EXISTS idx_storage_extension ON storage(substr(filename, length(scanname) + 1))",
+    "CREATE INDEX IF NOT EXISTS idx_fingerprints_fingerprint ON fingerprints(fingerprint)",
+]
+storage_columns = "hash, filepath, filename, scanname"
+# Changes to these tables bump the `data_version` in the meta table, so unchanged databases are not backed up again
+versioned_tables = ['ingress', 'storage', 'fingerprints']
+# Pages copied per step of a backup, the database is not locked in between
+backup_pages = 1024
+# Writes in between restart a stepwise backup, after this many restarts the rest is copied in a single step
+backup_restarts = 3
+
+
+class _BackupRestarted(Exception):
+    pass
 
-# DATABSES
-def sqlite_connection(func):
-    ''' 
-    Decorator allowing for comprehensive sqlite connection
-    '''
-    
-    @functools.wraps(func)
-    def wrapper(self, *args, **kwargs):
-        with sqlite3.connect(self.sqlite_path) as conn:
-            cursor = conn.cursor()
-            try:
-                result = func(self, cursor, *args, **kwargs)
-                conn.commit()
-                return result
-            except Exception as e:
-                conn.rollback()
-                raise e
-    return wrapper
 
 class Db(Fs):
     ''' 
     A class representing an sqlite databse abstracting the underlying file system
 
+    Every thread talks to the database through its own persistent connection, which
+    is opened lazily and kept until `close`. By default the database runs in WAL mode,
+    so readers (e.g. `bellapi`) are not blocked by a long running insert.
+
     Attributes
     ----------
     filename: str
@@ -41,18 +67,138 @@ class Db(Fs):
     sqlite_path:
         The path to the database.
         The databse is placed always on top level within the storage directory.
+    journal_mode: str
+        The sqlite journal mode. WAL needs shared memory and thus does not work
+        if the database lives on a network filesystem, use `DELETE` there.
+    timeout: float
+        Seconds to wait for a lock before raising "database is locked"
+    hash_cache: HashCache | None
+        Cache of the hashes of unchanged files, so e.g. a dry run and a subsequent insert
+        only hash every scan once (disable by `use_hash_cache = False`)
+    hash_chunk_size: int | None
+        The number of bytes read at once when hashing, see `hashing.hash_file`
+    layout: str
+        How the scan folders are sharded in the storage, e.g. `2/2` for `storage/ab/cd/<hash>/`.
+        It is recorded in the database, changing it for a non-empty storage needs `reshard`.
+    journal: IngestJournal
+        Write-ahead journal of the scans being inserted, so an interrupted insert is resumed
+        without hashing again and its half-done moves are rolled forward or back
+    metrics: Metrics
+        Timings and counters of the stages of inserts, accumulated over the lifetime of the instance
+    trust_fingerprint: bool
+        If set, a scan whose quick fingerprint (see `Scan.fingerprint_scan`) matches the one of
+        a stored scan is taken as a duplicate of it without hashing the whole file.
+        This saves reading re-delivered scans completely, but as duplicates get deleted
+        it is off by default and the fingerprint is only used to record stored scans.
     
     Methods
     -------
     insert_from_ingress:
         The method for inserting several scans to the storage
+    session:
+        Context manager grouping many records into batched transactions
+    close:
+        Closes all connections opened by this instance
     '''
 
-    def __init__(self, root_dir, ingress_dir, filename):
+    def __init__(
+            self, root_dir, ingress_dir, filename,
+            journal_mode: str = 'WAL', timeout: float = 30.0, trust_fingerprint: bool = False,
+            use_hash_cache: bool = True, hash_chunk_size: int | None = None, layout: str | None = None,
+            metrics: Metrics | None = None
+        ):
         super().__init__(root_dir, ingress_dir)
         self.filename = filename
         self.sqlite_path = os.path.join(self.storage_dir, self.filename)
+        self.journal_mode = journal_mode
+        self.timeout = timeout
+        self.trust_fingerprint = trust_fingerprint
+        self.hash_chunk_size = hash_chunk_size
+        self.metrics = metrics if metrics is not None else Metrics()
+        # connections and sessions are bound to the thread that opened them
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._connections_lock = threading.Lock()
         self._initialize_db()
+        self._initialize_layout(layout)
+        self.hash_cache = HashCache(self) if use_hash_cache else None
+        self.journal = IngestJournal(self)
+
+    def _connection(self) -> sqlite3.Connection:
+        '''
+        Returns the persistent connection of the current thread, opening it if needed.
+        '''
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            return conn
+        # autocommit mode, transactions are handled explicitly by `sqlite_connection` and `Session`
+        # the connection may be closed from another thread by `close`
+        conn = sqlite3.connect(
+            self.sqlite_path, timeout = self.timeout,
+            isolation_level = None, check_same_thread = False
+        )
+        conn.execute(f"PRAGMA journal_mode = {self.journal_mode}")
+        for pragma, value in sqlite_pragmas.items():
+            conn.execute(f"PRAGMA {pragma} = {value}")
+        self._local.conn = conn
+        with self._connections_lock:
+            self._connections.append(conn)
+        return conn
+
+    def _release_connection(self):
+        '''
+        Closes the connection of the current thread, e.g. before a short lived worker thread exits.
+        '''
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            return
+        self._local.conn = None
+        with self._connections_lock:
+            if conn in self._connections:
+                self._connections.remove(conn)
+        conn.close()
+
+    def close(self):
+        '''
+        Closes the connections of all threads.
+        '''
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+        # other threads notice the closed connection on their next call
+        self._local = threading.local()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @contextlib.contextmanager
+    def session(self, batch_size: int | None = None):
+        '''
+        Context manager grouping all database calls within into transactions on a single connection.
+
+        Each decorated call runs in its own savepoint, so e.g. a scan whose move fails
+        does not leave any records behind while the others are kept.
+        Nested sessions simply join the outer one.
+
+        Args:
+            batch_size (int | None): commit after this many units, see `Session.checkpoint`.
+                If `None`, everything is committed at the end of the session.
+        '''
+        session = getattr(self._local, 'session', None)
+        if session is not None:
+            yield session
+            return
+        session = Session(self._connection(), batch_size)
+        self._local.session = session
+        try:
+            yield session
+        finally:
+            self._local.session = None
+            session.end()
 
     @sqlite_connection
     def _table_exists(self, cursor, table_name: str):
@@ -85,6 +231,78 @@ class Db(Fs):
                 FOREIGN KEY(hash) REFERENCES ingress(hash)
             )
             ''')
+        # The quick fingerprints of stored scans are kept aside, so the storage table stays untouched
+        if not self._table_exists('fingerprints'):
+            cursor.execute('''
+            CREATE TABLE fingerprints (
+                hash TEXT NOT NULL PRIMARY KEY,
+                filesize INTEGER,
+                fingerprint TEXT,
+                FOREIGN KEY(hash) REFERENCES storage(hash)
+            )
+            ''')
+        # Secondary indexes, also created for databases from older versions
+        for statement in secondary_indexes:
+            cursor.execute(statement)
+        # Key value store about the database itself
+        cursor.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT NOT NULL PRIMARY KEY, value)")
+        # only written once, so opening an existing database does not need the write lock
+        cursor.execute("SELECT 1 FROM meta WHERE key = 'data_version'")
+        if cursor.fetchone() is None:
+            cursor.execute("INSERT INTO meta (key, value) VALUES ('data_version', 0)")
+        for table in versioned_tables:
+            for operation in ['INSERT', 'UPDATE', 'DELETE']:
+                cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS {table}_{operation.lower()}_version AFTER {operation} ON {table}
+                BEGIN
+                    UPDATE meta SET value = value + 1 WHERE key = 'data_version';
+                END
+                ''')
+
+    def _initialize_layout(self, layout: str | None):
+        recorded = self.get_meta('storage_layout')
+        if layout is not None:
+            layout = format_layout(parse_layout(layout))
+        if recorded is None or (layout not in (None, recorded) and not self.count_rows('storage')):
+            # stores from before the layout was recorded are flat
+            recorded = layout or 'flat'
+            self.set_meta('storage_layout', recorded)
+        elif layout not in (None, recorded):
+            raise ValueError(f"The storage has the layout {recorded}, use `reshard` (bellastore-reshard) to change it to {layout}")
+        self.layout = recorded
+        self.shards = parse_layout(recorded)
+
+    @sqlite_connection
+    def _refresh_layout(self, cursor):
+        '''
+        Re-reads the layout once another connection committed since the last check of this thread's connection,
+        e.g. a `reshard` in another process. Until then this is a single pragma without any I/O.
+        '''
+        cursor.execute("PRAGMA data_version")
+        checked = (cursor.connection, cursor.fetchone()[0])
+        if getattr(self._local, 'layout_checked', None) == checked:
+            return
+        self._local.layout_checked = checked
+        layout = self.get_meta('storage_layout')
+        if layout is not None and layout != self.layout:
+            logger.info(f"The storage layout changed from {self.layout} to {layout}")
+            self.layout = layout
+            self.shards = parse_layout(layout)
+
+    def get_scan_dir(self, hash: str) -> str:
+        # another process might have resharded the storage meanwhile
+        self._refresh_layout()
+        return super().get_scan_dir(hash)
+
+    @sqlite_connection
+    def get_meta(self, cursor, key: str, default = None):
+        cursor.execute("SELECT value FROM meta WHERE key = ?", (key, ))
+        entry = cursor.fetchone()
+        return default if entry is None else entry[0]
+
+    @sqlite_connection
+    def set_meta(self, cursor, key: str, value):
+        cursor.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
 
     @sqlite_connection  
     def add_scan_to_ingress_db(self, cursor, scan: Scan, rec = False):
@@ -92,31 +310,353 @@ class Db(Fs):
         # have to physically move the file around
         if not rec:
             self._add_scan_to_ingress(scan)
-        print(f"Recording scan in ingress")
+        logger.debug(f"Recording {scan.path} in ingress")
         cursor.execute(
             f"INSERT INTO ingress (hash, filepath, filename) VALUES (?, ?, ?)",
             (scan.hash, scan.path, scan.filename)
         )
-    def add_scans_to_ingress_db(self, scans: List[Scan]):
-        for scan in scans:
-            self.add_scan_to_ingress_db(scan)
 
-    @sqlite_connection  
-    def add_scan_to_storage_db(self, cursor, scan: List[Scan]):
-        self.add_scan_to_ingress_db(scan)
-        # This is super important
-        self.add_scan_to_storage(scan)
-        print(f"Recording scan in storage")
-        cursor.execute(f"""
+    @sqlite_connection
+    def add_scans_to_ingress_db(self, cursor, scans: List[Scan], rec = False):
+        if not rec:
+            for scan in scans:
+                self._add_scan_to_ingress(scan)
+        logger.debug(f"Recording {len(scans)} scans in ingress")
+        cursor.executemany(
+            f"INSERT INTO ingress (hash, filepath, filename) VALUES (?, ?, ?)",
+            [(scan.hash, scan.path, scan.filename) for scan in scans]
+        )
+
+    def add_scan_to_storage_db(self, scan: Scan):
+        '''
+        Moves a scan into the storage (hashing it if needed) and records it in the ingress and storage tables.
+
+        The move is journaled ahead and serialized with the inserts (see `IngestJournal`),
+        so an interrupted call is recovered by the next insert instead of leaving an orphan in the storage.
+        '''
+        with self.journal.lock():
+            self._store(scan)
+
+    def _store(self, scan: Scan):
+        # the caller holds the journal's lock
+        self._add_scan_to_ingress(scan)
+        with self.session() as session:
+            ingress_path = scan.path
+            storage_path = self.journal.moving(scan)
+            # write-ahead: the move has to be in the journal before anything is moved,
+            # this also commits whatever a running session recorded so far
+            session.commit()
+            try:
+                self.add_scan_to_storage(scan, os.path.dirname(storage_path))
+            except Exception:
+                # `Scan.move` undoes a failed move, so the scan is back in the ingress
+                self.journal._set_hashed(ingress_path)
+                raise
+            self.record_stored_scan(scan, ingress_path)
+            self.journal.finish(ingress_path)
+
+    @sqlite_connection
+    def record_stored_scan(self, cursor, scan: Scan, ingress_path: str):
+        '''
+        Records a scan that has already been moved into the storage, see `IngestPipeline`.
+
+        Args:
+            scan (Scan): the scan, already at its storage path
+            ingress_path (str): the path the scan had in the ingress
+        '''
+        logger.debug(f"Recording {scan.path} in ingress and storage")
+        cursor.execute(
+            "INSERT INTO ingress (hash, filepath, filename) VALUES (?, ?, ?)",
+            (scan.hash, ingress_path, scan.filename)
+        )
+        cursor.execute("""
             INSERT INTO storage (hash, filepath, filename, scanname) 
             VALUES (?, ?, ?, ?)
             """, (scan.hash, scan.path, scan.filename, scan.scanname))
+        if scan.fingerprint:
+            self._add_fingerprint(cursor, scan)
+
+    @staticmethod
+    def _add_fingerprint(cursor, scan: Scan):
+        cursor.execute(
+            "INSERT OR REPLACE INTO fingerprints (hash, filesize, fingerprint) VALUES (?, ?, ?)",
+            (scan.hash, scan.size, scan.fingerprint)
+        )
+
+    @sqlite_connection
+    def fingerprint_storage(self, cursor) -> int:
+        '''
+        Records the quick fingerprint of all stored scans that do not have one yet,
+        e.g. as they were inserted by an older version.
+
+        Returns:
+            amount (int): the number of fingerprinted scans
+        '''
+        cursor.execute('''
+            SELECT storage.filepath, storage.hash FROM storage
+            LEFT JOIN fingerprints ON storage.hash = fingerprints.hash
+            WHERE fingerprints.hash IS NULL
+        ''')
+        amount = 0
+        for filepath, hash in cursor.fetchall():
+            scan = Scan(filepath)
+            scan.hash = hash
+            if not os.path.isfile(filepath) or scan.fingerprint_scan() is None:
+                continue
+            self._add_fingerprint(cursor, scan)
+            amount += 1
+        return amount
+
+    def reconcile(self, repair: bool = False, check_files: bool = False) -> Dict[str, list]:
+        '''
+        Compares the storage table with the storage directory without hashing anything,
+        as every stored scan lives in a folder named by its hash.
+
+        Only the storage folders (see `Fs.iter_storage`) are listed and diffed against the recorded hashes
+        as sets, so this takes seconds even for hundreds of thousands of scans.
+        Whether the content still matches the hashes is checked by `Scrubber`.
+
+        Args:
+            repair (bool): fix the drift in the database (the files are never touched):
+                entries of missing scans (also in the ingress table) are deleted, paths of moved scans updated and
+                untracked folders holding a single scan recorded under the folder's name,
+                if that is the hash of the scan
+            check_files (bool): also check that the recorded file exists within its folder (a stat per scan)
+
+        Returns:
+            drift (Dict[str, list]):
+                `missing`: hashes of recorded scans whose folder (or file) is gone
+                `untracked`: paths in the storage not belonging to a recorded scan
+                `moved`: (hash, recorded path, actual path) of scans recorded at another path
+                `unresolved`: only when repairing, the untracked folders that could not be recorded
+        '''
+        self._refresh_layout()
+        columns = self.read_columns('storage', ['hash', 'filepath'])
+        recorded = dict(zip(columns['hash'], columns['filepath']))
+        folders: Dict[str, str] = {}
+        untracked = []
+        # the database with its journal files
+        sqlite_name = os.path.basename(self.sqlite_path)
+        for entry in self.iter_storage():
+            if entry.is_dir(follow_symlinks = False):
+                folders[entry.name] = entry.path
+            elif not (os.path.dirname(entry.path) == self.storage_dir and entry.name.startswith(sqlite_name)):
+                untracked.append(entry.path)
+        missing = recorded.keys() - folders.keys()
+        untracked += [folders[hash] for hash in folders.keys() - recorded.keys()]
+        moved = []
+        for hash in recorded.keys() & folders.keys():
+            filepath = recorded[hash]
+            if os.path.normpath(os.path.dirname(filepath)) != os.path.normpath(folders[hash]):
+                moved.append((hash, filepath, os.path.join(folders[hash], os.path.basename(filepath))))
+            elif check_files and not os.path.exists(filepath):
+                # e.g. renamed within its folder
+                scan = self._single_scan(folders[hash])
+                if scan is not None:
+                    moved.append((hash, filepath, scan.path))
+                else:
+                    missing.add(hash)
+        drift = {'missing': sorted(missing), 'untracked': sorted(untracked), 'moved': sorted(moved)}
+        if repair:
+            drift['unresolved'] = self._repair(drift)
+        return drift
+
+    @staticmethod
+    def _single_scan(folder: str) -> Scan | None:
+        '''
+        Returns the scan within a storage folder, `None` unless there is exactly one valid scan at its top level.
+        '''
+        with os.scandir(folder) as entries:
+            scans = [Scan(entry.path) for entry in entries if entry.is_file() and entry.name.endswith(tuple(scan_extensions))]
+        if len(scans) != 1 or not scans[0].is_valid():
+            return None
+        return scans[0]
+
+    def _repair(self, drift: Dict[str, list]) -> List[str]:
+        '''
+        Repairs the drift found by `reconcile` in the database.
+
+        An untracked folder is only recorded if it is named like a hash and holds a single scan with that hash,
+        so the scan is hashed first (outside of the transaction).
+
+        Returns:
+            unresolved (List[str]): the untracked folders that could not be recorded
+        '''
+        recordable, unresolved = [], []
+        for path in drift['untracked']:
+            if not os.path.isdir(path):
+                continue
+            hash = os.path.basename(path)
+            scan = self._single_scan(path)
+            if scan is None:
+                logger.warning(f"Leaving {path} untracked, it does not hold a single scan")
+            elif not is_scan_hash(hash):
+                logger.warning(f"Leaving {path} untracked, its name is not a hash")
+            elif scan.hash_scan(chunk_size = self.hash_chunk_size) != hash:
+                logger.warning(f"Leaving {path} untracked, the hash of {scan.filename} does not match its name")
+            else:
+                recordable.append(scan)
+                continue
+            unresolved.append(path)
+        self._repair_entries(drift, recordable)
+        return unresolved
+
+    @sqlite_connection
+    def _repair_entries(self, cursor, drift: Dict[str, list], recordable: List[Scan]):
+        for hash in drift['missing']:
+            logger.info(f"Deleting the entries of missing scan {hash}")
+            cursor.execute("DELETE FROM storage WHERE hash = ?", (hash, ))
+            cursor.execute("DELETE FROM fingerprints WHERE hash = ?", (hash, ))
+            # otherwise a redelivery of the scan would be deleted as already recorded in the ingress
+            cursor.execute("DELETE FROM ingress WHERE hash = ?", (hash, ))
+        for hash, _, filepath in drift['moved']:
+            if os.path.exists(filepath):
+                logger.info(f"Updating the path of scan {hash} to {filepath}")
+                scan = Scan(filepath)
+                cursor.execute(
+                    "UPDATE storage SET filepath = ?, filename = ?, scanname = ? WHERE hash = ?",
+                    (scan.path, scan.filename, scan.scanname, hash)
+                )
+        for scan in recordable:
+            logger.info(f"Recording untracked scan {scan.path}")
+            cursor.execute(
+                f"INSERT INTO storage ({storage_columns}) VALUES (?, ?, ?, ?)",
+                (scan.hash, scan.path, scan.filename, scan.scanname)
+            )
+
+    def reshard(self, layout: str, batch_size: int = 100) -> int:
+        '''
+        Moves all stored scans into a new layout while the storage stays in use.
+
+        The new layout is recorded first, so new scans go there right away,
+        also those of other processes (see `get_scan_dir`).
+        Every scan is then hard linked into its new folder (copied where hard links are not supported),
+        its path is updated in the database and only after the commit the old links are removed.
+        Thus every recorded path points at a complete scan at any time.
+        Passes are repeated until no scan is left in an old place, e.g. as a running insert
+        had journaled a move into the old layout already. An interrupted run can simply be run again.
+
+        Args:
+            layout (str): the new layout, see `parse_layout`
+            batch_size (int): number of scans moved per transaction
+
+        Returns:
+            amount (int): the number of moved scans
+        '''
+        self.shards = parse_layout(layout)
+        self.layout = format_layout(self.shards)
+        self.set_meta('storage_layout', self.layout)
+        total = 0
+        while True:
+            amount = self._reshard_pass(batch_size)
+            total += amount
+            if not amount:
+                return total
+
+    def _reshard_pass(self, batch_size: int) -> int:
+        amount = 0
+        after = None
+        while True:
+            page = self.get_storage_page(batch_size, after)
+            if not page:
+                return amount
+            after = page[-1][0]
+            linked = []
+            for hash, filepath, _, _ in page:
+                target_dir = self.get_scan_dir(hash)
+                if os.path.normpath(os.path.dirname(filepath)) == os.path.normpath(target_dir):
+                    continue
+                scan = Scan(filepath)
+                if not scan.is_valid() or not os.path.exists(filepath):
+                    logger.warning(f"Skipping missing scan {filepath}, see `reconcile`")
+                    continue
+                scan.link(target_dir)
+                linked.append((hash, filepath, os.path.join(target_dir, scan.filename)))
+            with self.session():
+                for hash, _, filepath in linked:
+                    self._update_storage_path(hash, filepath)
+            for _, filepath, _ in linked:
+                Scan(filepath).remove()
+                logger.debug(f"Moved {filepath} into the new layout")
+            self.remove_empty_parents([os.path.dirname(filepath) for _, filepath, _ in linked], root = self.storage_dir)
+            amount += len(linked)
+
+    @sqlite_connection
+    def _update_storage_path(self, cursor, hash: str, filepath: str):
+        cursor.execute("UPDATE storage SET filepath = ? WHERE hash = ?", (filepath, hash))
+
+    def add_scans_to_storage_db(self, scans: List[Scan], batch_size: int | None = None):
+        # every scan has to be moved on its own, see `add_scan_to_storage_db`
+        with self.journal.lock(), self.session(batch_size) as session:
+            for scan in scans:
+                self._store(scan)
+                session.checkpoint()
+
+    @sqlite_connection
+    def _ingress_entry_exists(self, cursor, scan: Scan) -> bool:
+        # served by the index behind UNIQUE(hash, filepath, filename)
+        cursor.execute(
+            "SELECT 1 FROM ingress WHERE hash = ? AND filepath = ? AND filename = ?",
+            (scan.hash, scan.path, scan.filename)
+        )
+        return cursor.fetchone() is not None
+
+    @sqlite_connection
+    def _storage_entry_exists(self, cursor, scan: Scan) -> bool:
+        cursor.execute("SELECT 1 FROM storage WHERE hash = ?", (scan.hash, ))
+        return cursor.fetchone() is not None
+
+    @sqlite_connection
+    def _hash_for_fingerprint(self, cursor, fingerprint: str) -> str | None:
+        cursor.execute("SELECT DISTINCT hash FROM fingerprints WHERE fingerprint = ? LIMIT 2", (fingerprint, ))
+        hashes = cursor.fetchall()
+        # ambiguous fingerprints are not trusted
+        return hashes[0][0] if len(hashes) == 1 else None
+
+    @sqlite_connection
+    def load_dedup_index(self, cursor) -> DedupIndex:
+        '''
+        Reads the keys needed for deduplication from all tables in a single pass.
+        '''
+        cursor.execute("SELECT hash FROM storage")
+        storage_hashes = {row[0] for row in cursor}
+        cursor.execute("SELECT fingerprint, hash FROM fingerprints")
+        fingerprints = cursor.fetchall()
+        cursor.execute("SELECT hash, filepath, filename FROM ingress")
+        return DedupIndex(storage_hashes, cursor, fingerprints)
 
-    def add_scans_to_storage_db(self, scans: List[Scan]):
-        for scan in scans:
-            self.add_scan_to_storage_db(scan)
+    def _identify(self, scan: Scan, index: DedupIndex | None = None) -> bool:
+        '''
+        Takes over the hash of a scan from the hash cache, the journal of an interrupted insert or,
+        if its fingerprint is trusted and known, from the stored scan.
+        The scan is only fingerprinted if neither the cache nor the journal knows it, as that reads its head and tail.
+        Both keep the fingerprint alongside the hash, so it is recorded with the scan nevertheless.
 
-    def insert(self, scan: Scan):
+        Returns:
+            needs_hash (bool): whether the scan still has to be hashed completely
+        '''
+        if scan.hash is not None:
+            return False
+        if self.hash_cache is not None and self.hash_cache.lookup_scan(scan) is not None:
+            return False
+        scan.hash = self.journal.lookup(scan)
+        if scan.hash is not None:
+            return False
+        if scan.fingerprint is None:
+            scan.fingerprint_scan()
+        if not self.trust_fingerprint or scan.fingerprint is None:
+            return True
+        if index is not None:
+            hash = index.hash_for_fingerprint(scan.fingerprint)
+        else:
+            hash = self._hash_for_fingerprint(scan.fingerprint)
+        if hash is None:
+            return True
+        logger.debug(f'Fingerprint of {scan.path} matches stored scan {hash}, skipping hashing.')
+        scan.hash = hash
+        return False
+
+    def insert(self, scan: Scan, index: DedupIndex | None = None):
         ''' 
         Inserts a single scan into the storage database.
 
@@ -124,46 +664,172 @@ class Db(Fs):
         - check wether scan is already recorded in ingress
         - record scan in storage db (if not existent)
         - move scan file to storage (if not existent)
+
+        Like `insert_many` this holds the lock of the inserts, recovers the moves an earlier insert
+        left half-done and journals the move ahead, see `IngestJournal`.
+
+        Args:
+            scan (Scan): the scan to be inserted
+            index (DedupIndex | None): index of the recorded scans, which is kept up to date.
+                If not given, the database is queried for this single scan.
         '''
-        scan.hash_scan()
-        print(f"\nStarting insert pipeline for {scan.hash}:")
-        existing_ingress_entries = self.get_entries_from_ingress_db()
-        if (scan.hash, scan.path, scan.scanname) in existing_ingress_entries:
-            print(f'Scan already recorded in the ingress table and thus scan will be deleted.')
-            os.remove(scan.path)
-            scan.path = None
+        # the scan might already be hashed or its hash cached, see `hash_many`
+        if self._identify(scan, index):
+            scan.hash_scan(chunk_size = self.hash_chunk_size)
+        # the cached hash is of no use anymore once the scan is moved or deleted
+        if self.hash_cache is not None:
+            self.hash_cache.discard(scan.path)
+        with self.journal.lock():
+            self.journal._recover()
+            self._insert_hashed(scan, index)
+
+    def _insert_hashed(self, scan: Scan, index: DedupIndex | None):
+        # the caller holds the journal's lock
+        logger.debug(f"Starting insert pipeline for {scan.hash}: {scan.path}")
+        if index is not None:
+            in_ingress = index.in_ingress(scan)
+        else:
+            in_ingress = self._ingress_entry_exists(scan)
+        if in_ingress:
+            logger.info(f'{scan.path} is already recorded in the ingress table and thus will be deleted.')
+            scan.remove()
             return
-        existing_storage_entries = self.get_entries_from_storage_db()
-        existing_storage_hashes = [entry[0] for entry in existing_storage_entries]
-        if scan.hash in existing_storage_hashes:
-            print(f'Scan already recorded in the storage table, so scan will be only recorded in ingress table and then deleted.')
+        if index is not None:
+            in_storage = index.in_storage(scan)
+        else:
+            in_storage = self._storage_entry_exists(scan)
+        # The ingress key has to be taken before the scan is moved
+        ingress_key = DedupIndex.ingress_key(scan)
+        if in_storage:
+            logger.info(f'{scan.path} is already recorded in the storage table, so it is only recorded in the ingress table and then deleted.')
             self.add_scan_to_ingress_db(scan, rec = True)
-            print(f'Deleting scan')
-            os.remove(scan.path)
-            scan.path = None
+            if index is not None:
+                index.add_to_ingress(ingress_key)
+            scan.remove()
             return
         # In this case the scan is not recorded, thus also not in storage so we run the whole pipeline
         # This will also automatically care about the storage backend recursively
-        # TODO: the scan is already hashed at this place, so we do not need to hash it again
-        self.add_scan_to_storage_db(scan)
-    
-    def insert_many(self, scans: List[Scan]):
-        for scan in scans:
-            self.insert(scan)
+        self._store(scan)
+        if index is not None:
+            index.add_to_ingress(ingress_key)
+            index.add_to_storage(scan.hash)
+            if scan.fingerprint:
+                index.add_fingerprint(scan.fingerprint, scan.hash)
+
+    def _hash_scans(self, scans: Iterable[Scan], workers: int = 1, pool: str = 'thread', index: DedupIndex | None = None):
+        '''
+        Generator hashing scans concurrently on a worker pool.
+
+        The scans are yielded in their original order as soon as their hash is available,
+        so the database writes and moves of the consumer stay ordered.
+        The scans are consumed lazily, with at most twice as many scans in flight as there are workers,
+        so hashing already starts while the ingress is still being walked.
+        The cheap fingerprints are taken on submission, so only scans that are not
+        identified by them (see `_identify`) are handed to the pool.
+
+        Yields:
+            (scan, hashed) (Tuple[Scan, bool]): the scan and whether it was hashed completely,
+                as opposed to its hash being taken over by `_identify`
+        '''
+        if pool not in hash_pools:
+            raise ValueError(f"Unknown pool {pool}, choose one of {list(hash_pools)}")
+        if workers <= 1:
+            for scan in scans:
+                hashed = self._identify(scan, index)
+                if hashed:
+                    scan.hash_scan(chunk_size = self.hash_chunk_size)
+                yield scan, hashed
+            return
+        executor = hash_pools[pool](max_workers = workers)
+
+        def submit(scan: Scan):
+            if not self._identify(scan, index):
+                return (scan, None)
+            return (scan, executor.submit(Scan.hash_scan, scan, None, self.hash_chunk_size))
+
+        scans = iter(scans)
+        try:
+            in_flight = deque(submit(scan) for scan in itertools.islice(scans, 2 * workers))
+            while in_flight:
+                scan, future = in_flight.popleft()
+                # keep the pool busy while waiting for the oldest scan
+                for next_scan in itertools.islice(scans, 1):
+                    in_flight.append(submit(next_scan))
+                # `Scan.hash_scan` sets the hash on the instance, which for a process pool is
+                # only a copy, so we set the returned hash on our own instance
+                if future is not None:
+                    scan.hash = future.result()
+                yield scan, future is not None
+        finally:
+            executor.shutdown(wait = True, cancel_futures = True)
+
+    def hash_many(self, scans: List[Scan], workers: int = 1, pool: str = 'thread'):
+        '''
+        Generator hashing scans without inserting them, e.g. for a dry run.
+
+        The hashes are stored in the hash cache, so a subsequent insert does not hash the scans again.
+        Only complete hashes are cached, one taken over from a trusted fingerprint merely indicates equal content
+        and must not be used by an insert that does not trust fingerprints.
+        '''
+        for scan, hashed in self._hash_scans(scans, workers, pool):
+            if hashed and self.hash_cache is not None:
+                self.hash_cache.store(scan.path, scan.hash, scan.fingerprint)
+            yield scan
+
+    def insert_many(
+            self, scans: Iterable[Scan], workers: int = 1, pool: str = 'thread', batch_size: int = 100,
+            move_workers: int = 1, queue_size: int | None = None
+        ):
+        '''
+        Inserts several scans into the storage database.
+
+        Hashing, recording and moving overlap, see `IngestPipeline`.
+
+        Args:
+            scans (Iterable[Scan]): the scans to be inserted, which are consumed lazily
+            workers (int): number of workers hashing the scans concurrently
+            pool (str): either `thread` or `process`, the kind of pool used for hashing
+            batch_size (int): number of scans recorded per transaction
+            move_workers (int): number of workers moving scans into the storage concurrently
+            queue_size (int | None): maximum number of scans in the pipeline, bounding its memory
+
+        Returns:
+            dirs (Set[str]): the folders scans were moved or deleted from, see `remove_empty_parents`
+        '''
+        return IngestPipeline(self, workers, pool, batch_size, move_workers, queue_size).run(scans)
     
-    def insert_from_ingress(self):
+    def insert_from_ingress(
+            self, workers: int = 1, pool: str = 'thread', batch_size: int = 100,
+            move_workers: int = 1, queue_size: int | None = None
+        ):
         ''' This is the main insert function
 
         This function retrieves valid scans from the ingress, inserts
         those into the storage and removes the resulting empty folders from the ingress.
 
+        Args:
+            workers (int): number of workers hashing the scans concurrently
+            pool (str): either `thread` or `process`, the kind of pool used for hashing
+            batch_size (int): number of scans recorded per transaction
+            move_workers (int): number of workers moving scans into the storage concurrently
+            queue_size (int | None): maximum number of scans in the pipeline, bounding its memory
+
         Return
         ------
             Valid scans (no matter if already in storage or not)
         '''
-        scans = self.get_valid_scans_from_ingress()
-        self.insert_many(scans)
-        self.remove_empty_folders()
+        scans = []
+        def discovered_scans():
+            # the ingress is walked lazily while the scans are inserted
+            for scan in self.iter_valid_scans_from_ingress():
+                scans.append(scan)
+                yield scan
+        dirs = self.insert_many(discovered_scans(), workers, pool, batch_size, move_workers, queue_size)
+        if self.hash_cache is not None:
+            self.hash_cache.evict_stale(self.ingress_dir)
+        # only the folders the scans came from, instead of walking the whole tree
+        with self.metrics.time('cleanup'):
+            self.remove_empty_parents(dirs)
         return scans
 
 
@@ -174,11 +840,63 @@ class Db(Fs):
         data = cursor.fetchall()
         return data
       
+    @sqlite_connection
+    def read_columns(self, cursor, table_name: str, columns: List[str] | None = None) -> Dict[str, list]:
+        '''
+        Reads a table column-wise, i.e. as a dict of column name -> list of values.
+
+        This is what `numpy.asarray`, `pyarrow.table` or `pandas.DataFrame` take directly,
+        without bellastore depending on any of them.
+
+        Args:
+            table_name (str): the table to read
+            columns (List[str] | None): the columns to read, all by default
+        '''
+        selected = ', '.join(f'"{column}"' for column in columns) if columns else '*'
+        cursor.execute(f"SELECT {selected} FROM {table_name}")
+        names = [description[0] for description in cursor.description]
+        values = list(zip(*cursor.fetchall())) or [()] * len(names)
+        return {name: list(column) for name, column in zip(names, values)}
+
+    @sqlite_connection
+    def table_columns(self, cursor, table_name: str) -> List[str]:
+        cursor.execute(f"PRAGMA table_info({table_name})")
+        return [column[1] for column in cursor.fetchall()]
+
+    @sqlite_connection
+    def _read_page(self, cursor, table_name: str, after: int, limit: int) -> List[tuple]:
+        cursor.execute(f"SELECT rowid, * FROM {table_name} WHERE rowid > ? ORDER BY rowid LIMIT ?", (after, limit))
+        return cursor.fetchall()
+
+    def iter_rows(self, table_name: str, batch_size: int = 1000) -> Iterator[tuple]:
+        '''
+        Generator streaming all rows of a table.
+
+        The rows are read in pages of `batch_size` continuing after the rowid of the last row,
+        so every page is a short query on the primary key, the memory stays flat and
+        a running insert is not held up in between.
+        '''
+        after = 0
+        while True:
+            page = self._read_page(table_name, after, batch_size)
+            if not page:
+                return
+            for row in page:
+                yield row[1:]
+            after = page[-1][0]
+
+    @sqlite_connection
+    def count_rows(self, cursor, table_name: str) -> int:
+        cursor.execute(f"SELECT COUNT(*) FROM {table_name}")
+        return cursor.fetchone()[0]
+
     def _read_all_pd(self, table_name: str):
-        conn = sqlite3.connect(self.sqlite_path)
-        df = pd.read_sql_query(f"SELECT * FROM {table_name}", conn)
-        conn.close()
-        return df
+        # pandas is an optional dependency, which takes long to import
+        try:
+            import pandas as pd
+        except ImportError as e:
+            raise ImportError("Reading tables into DataFrames needs pandas, install bellastore[pandas]") from e
+        return pd.DataFrame(self.read_columns(table_name))
 
 
     def get_entries_from_ingress_db(self):
@@ -186,6 +904,83 @@ class Db(Fs):
     
     def get_entries_from_storage_db(self):
         return self._read_all('storage')
+
+    # QUERIES
+    # All of these run on the indexes, so they do not scale with the size of the tables.
+    # Storage entries are returned as (hash, filepath, filename, scanname).
+
+    @sqlite_connection
+    def get_scan_by_hash(self, cursor, hash: str):
+        '''
+        Returns the storage entry of the scan with the given hash or `None`
+        '''
+        cursor.execute(f"SELECT {storage_columns} FROM storage WHERE hash = ?", (hash, ))
+        return cursor.fetchone()
+
+    @sqlite_connection
+    def get_ingress_entries_by_hash(self, cursor, hash: str):
+        '''
+        Returns all ingress entries (i.e. deliveries) of the scan with the given hash
+        '''
+        cursor.execute("SELECT hash, filepath, filename FROM ingress WHERE hash = ?", (hash, ))
+        return cursor.fetchall()
+
+    @sqlite_connection
+    def get_scans_by_scanname(self, cursor, scanname: str):
+        cursor.execute(f"SELECT {storage_columns} FROM storage WHERE scanname = ?", (scanname, ))
+        return cursor.fetchall()
+
+    @sqlite_connection
+    def get_scans_by_prefix(self, cursor, prefix: str):
+        '''
+        Returns all storage entries whose scanname starts with `prefix`.
+
+        This is done via a range on the scanname index, see `prefix_range`.
+        '''
+        if not prefix:
+            return self.get_entries_from_storage_db()
+        cursor.execute(
+            f"SELECT {storage_columns} FROM storage WHERE scanname >= ? AND scanname < ? ORDER BY scanname",
+            prefix_range(prefix)
+        )
+        return cursor.fetchall()
+
+    @sqlite_connection
+    def get_scans_by_extension(self, cursor, extension: str):
+        '''
+        Returns all storage entries with the given extension, e.g. `.ndpi` (or `ndpi`)
+        '''
+        if not extension.startswith('.'):
+            extension = f'.{extension}'
+        cursor.execute(
+            f"SELECT {storage_columns} FROM storage WHERE substr(filename, length(scanname) + 1) = ?",
+            (extension, )
+        )
+        return cursor.fetchall()
+
+    @sqlite_connection
+    def get_storage_page(self, cursor, limit: int = 1000, after: str | None = None):
+        '''
+        Returns a page of storage entries ordered by hash.
+
+        Paging is done by key, i.e. the next page starts after the last hash of the previous one,
+        so fetching a page does not get slower the further one pages.
+
+        Args:
+            limit (int): the maximum number of entries
+            after (str | None): the last hash of the previous page
+
+        Returns:
+            entries (list): the entries of the page, an empty list if there are no more
+        '''
+        if after is None:
+            cursor.execute(f"SELECT {storage_columns} FROM storage ORDER BY hash LIMIT ?", (limit, ))
+        else:
+            cursor.execute(
+                f"SELECT {storage_columns} FROM storage WHERE hash > ? ORDER BY hash LIMIT ?",
+                (after, limit)
+            )
+        return cursor.fetchall()
     
     def setup_logging(self):
         """Configure logging to both file and console"""
@@ -199,57 +994,130 @@ class Db(Fs):
         )
     
 
-    def create_backup(self, max_backups=10):
+    def create_backup(
+            self, max_backups=10, compression: str = 'none', pages: int = backup_pages,
+            progress = None, force: bool = False, retention: Dict[str, int] | None = None
+        ):
         """
         Create a backup of the SQLite database
+
+        The database is copied in steps of `pages` pages, releasing its lock in between,
+        so inserts are not blocked for the whole copy. As every commit of another connection restarts
+        the copy, a busy database is copied in a single step after `backup_restarts` restarts
+        (in WAL mode this still does not block writers). The copy is written next to the backup
+        and only renamed once complete (and compressed).
+        If nothing was recorded since the last backup (see `versioned_tables`), no backup is created.
         
         Args:
             max_backups (int): Maximum number of backup files to keep
+            compression (str): `none`, `gzip` or `zstd`, compressing the backup while writing it
+            pages (int): Number of pages copied per step, -1 copies all at once
+            progress (callable | None): Called as `progress(status, remaining, total)` after every step,
+                by default the progress is logged
+            force (bool): Back up even if nothing changed
+            retention (Dict[str, int] | None): Backups kept per period on top of the `max_backups` newest,
+                e.g. `{'daily': 7, 'weekly': 4}`, see `BackupManifest.retain`
         """
         try:
-            
-            # Generate backup filename with timestamp
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            db_name = Path(self.sqlite_path).stem
-            backup_path = Path(self.backup_dir) / f"{db_name}_backup_{timestamp}.sqlite"
-            
             # Ensure source database exists
             if not Path(self.sqlite_path).exists():
                 raise FileNotFoundError(f"Database file not found: {self.sqlite_path}")
-            
+
+            # Changes during the copy are included in it, so the backup is at least this version
+            version = self.get_meta('data_version')
+            if not force and version == self.get_meta('backup_version'):
+                logger.info(f"Database unchanged since the last backup (version {version}), skipping backup")
+                return True
+
+            # Generate backup filename with timestamp
+            created = datetime.now()
+            timestamp = created.strftime(backup_timestamp)
+            db_name = Path(self.sqlite_path).stem
+            suffix = compression_suffixes.get(compression, '')
+            backup_path = Path(self.backup_dir) / f"{db_name}_backup_{timestamp}.sqlite{suffix}"
+            # several backups within a second must not overwrite each other
+            for i in itertools.count(1):
+                if not backup_path.exists():
+                    break
+                backup_path = Path(self.backup_dir) / f"{db_name}_backup_{timestamp}_{i}.sqlite{suffix}"
+            partial_name = f"{db_name}_backup_{timestamp}.partial"
+            partial_path = Path(self.backup_dir) / partial_name
+            if progress is None:
+                progress = lambda status, remaining, total: logger.info(f"Backup progress: {total - remaining}/{total} pages")
+
             # Create backup using SQLite's backup API
-            with sqlite3.connect(self.sqlite_path) as source:
-                with sqlite3.connect(str(backup_path)) as target:
-                    source.backup(target)
+            try:
+                try:
+                    self._copy_database(partial_path, pages, progress, stepwise = True)
+                except _BackupRestarted:
+                    logger.info(f"Backup restarted {backup_restarts} times due to concurrent writes, copying in a single step")
+                    self._copy_database(partial_path, -1, progress)
+                if compression != 'none':
+                    compressed_path = partial_path.with_name(partial_path.name + suffix)
+                    with open(partial_path, 'rb') as f, open_compressed(compressed_path, 'wb', compression) as out:
+                        shutil.copyfileobj(f, out, 2**20)
+                    partial_path.unlink()
+                    partial_path = compressed_path
+                os.replace(partial_path, backup_path)
+            except BaseException:
+                for path in Path(self.backup_dir).glob(f"{partial_name}*"):
+                    path.unlink()
+                raise
+            manifest = BackupManifest(self.backup_dir, db_name)
+            manifest.add(backup_path, created, version)
+            self.set_meta('backup_version', version)
             
-            logging.info(f"Backup created successfully: {backup_path}")
+            logger.info(f"Backup created successfully: {backup_path}")
             
             # Clean up old backups if exceeding max_backups
-            self._cleanup_old_backups(max_backups)
+            self._cleanup_old_backups(max_backups, retention, manifest)
             
             return True
             
         except Exception as e:
-            logging.error(f"Backup failed: {str(e)}")
+            logger.error(f"Backup failed: {str(e)}")
             return False
 
-    def _cleanup_old_backups(self, max_backups):
-        """Remove oldest backups if exceeding max_backups limit"""
-        backups = sorted(
-            Path(self.backup_dir).glob('*_backup_*.sqlite'),
-            key=os.path.getctime
-        )
-        
-        while len(backups) > max_backups:
-            oldest_backup = backups.pop(0)
-            oldest_backup.unlink()
-            logging.info(f"Removed old backup: {oldest_backup}")    
+    def _copy_database(self, path: Path, pages: int, progress, stepwise: bool = False):
+        last = {'remaining': None, 'restarts': 0}
+        def track(status, remaining, total):
+            # the remaining pages only grow (or stay) if the copy started over
+            if stepwise and last['remaining'] is not None and remaining >= last['remaining']:
+                last['restarts'] += 1
+                if last['restarts'] >= backup_restarts:
+                    raise _BackupRestarted()
+            last['remaining'] = remaining
+            progress(status, remaining, total)
+        with contextlib.closing(sqlite3.connect(self.sqlite_path, timeout = self.timeout)) as source:
+            with contextlib.closing(sqlite3.connect(str(path))) as target:
+                source.backup(target, pages = pages, progress = track)
+                # the copy takes over WAL mode, but a backup should be a single self-contained file
+                target.execute("PRAGMA journal_mode = DELETE")
+
+    def _cleanup_old_backups(self, max_backups, retention: Dict[str, int] | None = None, manifest: BackupManifest | None = None):
+        """Remove the backups neither among the max_backups newest nor kept by the retention policy"""
+        if manifest is None:
+            manifest = BackupManifest(self.backup_dir, Path(self.sqlite_path).stem)
+        for entry in manifest.retain(max_backups, **(retention or {})):
+            logger.info(f"Removed old backup: {entry['file']}")
+
+    def verify_backups(self, workers: int = 4) -> Dict[str, List[str]]:
+        """
+        Checks all backups of the manifest (size, checksum and sqlite's quick_check) in parallel.
+
+        Returns:
+            problems (Dict[str, List[str]]): the problems per backup file, only for broken backups
+        """
+        manifest = BackupManifest(self.backup_dir, Path(self.sqlite_path).stem)
+        with ThreadPoolExecutor(max_workers = workers) as executor:
+            results = executor.map(lambda entry: verify_backup(self.backup_dir, entry), manifest.entries)
+            problems = {entry['file']: result for entry, result in zip(manifest.entries, results) if result}
+        for file, messages in problems.items():
+            for message in messages:
+                logger.error(message)
+        logger.info(f"Verified {len(manifest.entries)} backups, {len(problems)} broken")
+        return problems
 
-    
     def __str__(self):
-        # TODO: print_tree method should return a string to be passed to the return
-        print("\n")
-        self.print_tree()
-        ingress_df = self._read_all_pd('ingress')
-        storage_df = self._read_all_pd('storage')
-        return(f"Ingress DB:\n {ingress_df.to_string()}\n Storage DB:\n {storage_df.to_string()}\n")
\ No newline at end of file
+        # a summary instead of every node and entry, which takes minutes on large stores
+        return '\n'.join(format_record(record) for record in iter_report(self)) + '\n'
@@ -0,0 +1,67 @@
+from typing import Iterable, Tuple
+
+from bellastore.utils.scan import Scan
+
+
+class DedupIndex():
+    '''
+    In-memory index of everything recorded in the database that is needed
+    to decide whether a scan is a duplicate.
+
+    The index is loaded once per batch and then updated incrementally as scans get inserted,
+    so deciding on a scan is a set lookup instead of a full read of both tables.
+
+    Attributes
+    ----------
+    storage_hashes: set
+        The hashes recorded in the storage table
+    ingress_keys: set
+        The (hash, filepath, filename) keys recorded in the ingress table
+    fingerprints: dict
+        Maps the quick fingerprints of stored scans to their hash.
+        Fingerprints shared by scans with different hashes map to `None`.
+    '''
+
+    def __init__(
+            self,
+            storage_hashes: Iterable[str],
+            ingress_keys: Iterable[Tuple[str, str, str]],
+            fingerprints: Iterable[Tuple[str, str]] = ()
+        ):
+        self.storage_hashes = set(storage_hashes)
+        self.ingress_keys = set(ingress_keys)
+        self.fingerprints = {}
+        for fingerprint, hash in fingerprints:
+            self.add_fingerprint(fingerprint, hash)
+
+    @staticmethod
+    def ingress_key(scan: Scan) -> Tuple[str, str, str]:
+        '''
+        The key of a scan as recorded in the ingress table.
+        Note that this depends on the current path, so it has to be taken before moving a scan.
+        '''
+        return (scan.hash, scan.path, scan.filename)
+
+    def in_ingress(self, scan: Scan) -> bool:
+        return self.ingress_key(scan) in self.ingress_keys
+
+    def in_storage(self, scan: Scan) -> bool:
+        return scan.hash in self.storage_hashes
+
+    def add_to_ingress(self, key: Tuple[str, str, str]):
+        self.ingress_keys.add(key)
+
+    def add_to_storage(self, hash: str):
+        self.storage_hashes.add(hash)
+
+    def hash_for_fingerprint(self, fingerprint: str | None) -> str | None:
+        '''
+        Returns the hash of the stored scan with the given fingerprint, if it is unambiguous.
+        '''
+        return self.fingerprints.get(fingerprint)
+
+    def add_fingerprint(self, fingerprint: str, hash: str):
+        if fingerprint in self.fingerprints and self.fingerprints[fingerprint] != hash:
+            self.fingerprints[fingerprint] = None
+        else:
+            self.fingerprints[fingerprint] = hash
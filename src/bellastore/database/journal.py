@@ -0,0 +1,265 @@
+import os
+import glob
+import shutil
+import logging
+import contextlib
+from datetime import datetime
+from typing import Dict, List
+
+from bellastore.database.connection import SideTable, sqlite_connection, add_missing_columns
+from bellastore.utils.scan import Scan
+
+try:
+    import fcntl
+except ImportError:
+    # e.g. on Windows, inserts of several processes are not kept apart there
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+def _delete(path: str):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
+
+
+class IngestJournal(SideTable):
+    '''
+    A write-ahead journal of the scans an insert is working on, kept in a side table of the database.
+
+    A scan is journaled as `hashed` (with its hash, fingerprint and the identity of its files, see `Scan.get_identity`)
+    once it is hashed, and as `moving` (with its target) before it is moved into the storage.
+    The `moving` entry is committed before the move starts. Its entry is deleted in the transaction
+    recording the scan in the storage (or once it is removed as a duplicate).
+    Scans that are merely discovered are not journaled, the ingress itself lists them.
+
+    Every insert holds the exclusive `lock` of the database (a lock file next to the storage),
+    so an entry found while holding it can not belong to a running insert of another process.
+    If an insert dies, `recover` resolves the scans left `moving`:
+    - scans that arrived in the storage completely are recorded (rolled forward)
+    - scans that are (partially) still in the ingress are moved back (rolled back) and stay `hashed`
+
+    Scans left `hashed` are not hashed again as long as their files did not change, see `lookup`.
+
+    Only the thread inserting scans writes to the journal, so an entry is committed together with
+    the records of its scan (see `SideTable`). Any thread may read it.
+
+    Attributes
+    ----------
+    db: Db
+        The database holding the journal table, which also hands out the connections
+    lock_path: str
+        The lock file of the inserts, in the root directory
+    staging_dir: str
+        The folder the inserts copy scans from other filesystems into, only used while holding the lock
+
+    Methods
+    -------
+    lock:
+        Context manager holding the exclusive lock of the inserts
+    clear_staging:
+        Removes the copies left in the staging folder
+    hashed:
+        Journals the hash of a scan
+    moving:
+        Journals that a scan is about to be moved
+    finish:
+        Removes the entry of a scan that is dealt with
+    lookup:
+        Returns the journaled hash of an unchanged scan
+    recover:
+        Rolls half-done moves forward or back
+    '''
+
+    def __init__(self, db):
+        super().__init__(db)
+        name = os.path.splitext(os.path.basename(db.sqlite_path))[0]
+        self.lock_path = os.path.join(db.root_dir, f"{name}.lock")
+        self.staging_dir = os.path.join(db.root_dir, f"{name}.staging")
+        self._initialize_table()
+
+    @contextlib.contextmanager
+    def lock(self):
+        '''
+        Holds the exclusive lock of the inserts into the database, waiting for the insert holding it to finish.
+        The lock is taken per call, so it also keeps apart inserts of the same process.
+        '''
+        if fcntl is None:
+            yield
+            return
+        with open(self.lock_path, 'a') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                logger.info(f"Waiting for another insert into {self.db.sqlite_path} to finish")
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def clear_staging(self):
+        '''
+        Removes the copies an insert left in the staging folder, e.g. of duplicates or after it died.
+        The caller holds the lock, so no running insert is using them.
+        '''
+        try:
+            with os.scandir(self.staging_dir) as entries:
+                for entry in entries:
+                    _delete(entry.path)
+        except FileNotFoundError:
+            pass
+
+    @sqlite_connection
+    def _initialize_table(self, cursor):
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS ingest_journal (
+            ingress_path TEXT NOT NULL PRIMARY KEY,
+            state TEXT,
+            hash TEXT,
+            files INTEGER,
+            size INTEGER,
+            mtime_ns INTEGER,
+            storage_path TEXT,
+            updated_at TEXT,
+            fingerprint TEXT
+        )
+        ''')
+        add_missing_columns(cursor, 'ingest_journal', {'fingerprint': 'TEXT'})
+
+    @sqlite_connection
+    def hashed(self, cursor, scan: Scan):
+        identity = scan.identity or scan.get_identity()
+        if identity is None or scan.hash is None:
+            return
+        cursor.execute(
+            "INSERT OR REPLACE INTO ingest_journal (ingress_path, state, hash, files, size, mtime_ns, storage_path, updated_at, fingerprint) "
+            "VALUES (?, 'hashed', ?, ?, ?, ?, NULL, ?, ?)",
+            (scan.path, scan.hash, *identity, datetime.now().isoformat(timespec = 'seconds'), scan.fingerprint)
+        )
+
+    @sqlite_connection
+    def moving(self, cursor, scan: Scan) -> str:
+        '''
+        Journals that the scan is moved next, the transaction has to be committed before moving it.
+
+        Returns:
+            storage_path (str): the path the scan is moved to
+        '''
+        storage_path = os.path.join(self.db.get_scan_dir(scan.hash), scan.filename)
+        identity = scan.identity or (None, None, None)
+        cursor.execute(
+            "INSERT OR REPLACE INTO ingest_journal (ingress_path, state, hash, files, size, mtime_ns, storage_path, updated_at, fingerprint) "
+            "VALUES (?, 'moving', ?, ?, ?, ?, ?, ?, ?)",
+            (scan.path, scan.hash, *identity, storage_path, datetime.now().isoformat(timespec = 'seconds'), scan.fingerprint)
+        )
+        return storage_path
+
+    @sqlite_connection
+    def finish(self, cursor, ingress_path: str):
+        cursor.execute("DELETE FROM ingest_journal WHERE ingress_path = ?", (ingress_path, ))
+
+    @sqlite_connection
+    def lookup(self, cursor, scan: Scan) -> str | None:
+        '''
+        Returns the journaled hash of the scan or `None` if there is none or its files changed since.
+        The journaled fingerprint is set on the scan as well.
+        '''
+        cursor.execute("SELECT files, size, mtime_ns, hash, fingerprint FROM ingest_journal WHERE ingress_path = ?", (scan.path, ))
+        entry = cursor.fetchone()
+        if entry is None or entry[0] is None:
+            return None
+        if scan.get_identity() != tuple(entry[:3]):
+            return None
+        if entry[4] is not None:
+            # only single file scans are fingerprinted, so their total size is the size of the file
+            scan.size, scan.fingerprint = entry[1], entry[4]
+        return entry[3]
+
+    @sqlite_connection
+    def entries(self, cursor, state: str | None = None) -> List[tuple]:
+        '''
+        Returns the journaled scans (`ingress_path`, `state`, `hash`, `storage_path`), optionally only those in `state`.
+        '''
+        if state is None:
+            cursor.execute("SELECT ingress_path, state, hash, storage_path FROM ingest_journal ORDER BY ingress_path")
+        else:
+            cursor.execute(
+                "SELECT ingress_path, state, hash, storage_path FROM ingest_journal WHERE state = ? ORDER BY ingress_path",
+                (state, )
+            )
+        return cursor.fetchall()
+
+    @sqlite_connection
+    def _set_hashed(self, cursor, ingress_path: str):
+        cursor.execute(
+            "UPDATE ingest_journal SET state = 'hashed', storage_path = NULL, updated_at = ? WHERE ingress_path = ?",
+            (datetime.now().isoformat(timespec = 'seconds'), ingress_path)
+        )
+
+    def recover(self) -> Dict[str, List[str]]:
+        '''
+        Resolves the scans an interrupted insert left behind: half-done moves are rolled forward
+        if the scan arrived in the storage completely and back otherwise,
+        and entries of scans that vanished from the ingress are dropped.
+        Waits for a running insert to finish, see `lock`.
+
+        Returns:
+            recovered (Dict[str, List[str]]): the ingress paths `rolled_forward`, `rolled_back`,
+                `dropped` and `unresolved` (parts missing on both sides, left for manual inspection)
+        '''
+        with self.lock():
+            return self._recover()
+
+    def _recover(self) -> Dict[str, List[str]]:
+        # the caller holds the lock
+        recovered = {'rolled_forward': [], 'rolled_back': [], 'dropped': [], 'unresolved': []}
+        for ingress_path, state, hash, storage_path in self.entries():
+            if state == 'hashed':
+                if not os.path.exists(ingress_path):
+                    self.finish(ingress_path)
+                    recovered['dropped'].append(ingress_path)
+                continue
+            outcome = self._recover_move(ingress_path, hash, storage_path)
+            recovered[outcome].append(ingress_path)
+        for outcome, paths in recovered.items():
+            if paths:
+                logger.info(f"Journal recovery, {outcome}: {len(paths)} scans")
+        return recovered
+
+    def _recover_move(self, ingress_path: str, hash: str, storage_path: str) -> str:
+        source, target = Scan(ingress_path), Scan(storage_path)
+        parts = list(zip(source._top_level_paths(), target._top_level_paths()))
+        at_source = [os.path.lexists(part) for part, _ in parts]
+        at_target = [os.path.lexists(part) for _, part in parts]
+        if not any(at_source) and not all(at_target):
+            logger.error(f"Can not recover {ingress_path}, parts of it are neither in the ingress nor at {storage_path}")
+            return 'unresolved'
+        if all(at_target) and (not any(at_source) or target.hash_scan() == hash):
+            # the scan arrived completely, e.g. a copy whose source was not removed entirely
+            for part, exists in zip(source._top_level_paths(), at_source):
+                if exists:
+                    _delete(part)
+            target.hash = hash
+            if not self.db._storage_entry_exists(target):
+                self.db.record_stored_scan(target, ingress_path)
+            self.finish(ingress_path)
+            logger.info(f"Rolled forward the move of {ingress_path} to {storage_path}")
+            return 'rolled_forward'
+        for (source_part, target_part), exists, arrived in zip(parts, at_source, at_target):
+            if not arrived:
+                continue
+            if exists:
+                # an incomplete copy, the source is untouched
+                _delete(target_part)
+            else:
+                shutil.move(target_part, source_part)
+        target_dir = os.path.dirname(storage_path)
+        for partial in glob.glob(os.path.join(glob.escape(target_dir), '*.partial')):
+            os.remove(partial)
+        self.db.remove_empty_parents([target_dir], root = self.db.storage_dir)
+        self._set_hashed(ingress_path)
+        logger.info(f"Rolled back the move of {ingress_path} to {storage_path}")
+        return 'rolled_back'
@@ -0,0 +1,388 @@
+import os
+import time
+import shutil
+import tempfile
+import queue
+import logging
+import threading
+from collections import deque
+from typing import Dict, Iterable, List, Set
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from bellastore.database.index import DedupIndex
+from bellastore.utils.scan import Scan
+
+logger = logging.getLogger(__name__)
+
+# Executors available for hashing scans concurrently
+hash_pools = {
+    'thread': ThreadPoolExecutor,
+    'process': ProcessPoolExecutor,
+}
+# Seconds a blocked stage waits before checking whether the pipeline was stopped
+poll_interval = 0.1
+
+# marks the end of the discovered scans
+_done = object()
+
+
+class IngestPipeline():
+    '''
+    Inserts scans in overlapping stages, so reading, hashing and moving scans run at the same time:
+
+        discover -> hash -> record -> move -> record
+
+    - a thread consumes the (lazily discovered) scans
+    - `workers` threads fingerprint and hash them, handing the hashing to processes for `pool = 'process'`
+    - the calling thread decides about duplicates and is the only one writing to the database
+    - `move_workers` threads move new scans into the storage, which are recorded once they arrived
+
+    At most `queue_size` scans are on their way between discovery and being recorded,
+    so a stage that is ahead blocks (backpressure) and memory stays flat however large the batch is.
+
+    A scan whose hash equals the one of a scan that is still being moved is deferred
+    until that move finished, so duplicates within a batch are recorded as such.
+    If a stage fails, no new scans are taken, the moves in flight are still recorded
+    and the error is raised once the pipeline is drained.
+
+    Every hashed scan is journaled until it is dealt with, and a scan is only moved once
+    its move is committed to the journal, so an interrupted insert can be resumed, see `IngestJournal`.
+
+    A scan on another filesystem than the storage is not hashed on its own but copied into the staging
+    folder (on the storage's filesystem) while being hashed, see `Scan.stage`. Thus it is read only once:
+    its move is a rename of the copy, whereas a duplicate's copy is simply dropped.
+
+    The time spent per scan in every stage (`discover`, `hash`, `lookup`, `record`, `move`
+    and `cleanup`) and the outcomes are added to the metrics of the database, see `Metrics`.
+
+    Attributes
+    ----------
+    db: Db
+        The database to insert into
+    workers: int
+        Number of threads hashing scans
+    move_workers: int
+        Number of threads moving scans into the storage
+    queue_size: int
+        Maximum number of scans in the pipeline, by default twice the amount of workers
+    batch_size: int
+        Number of scans recorded per transaction
+
+    Methods
+    -------
+    run:
+        Inserts the given scans
+    '''
+
+    def __init__(
+            self, db, workers: int = 1, pool: str = 'thread', batch_size: int = 100,
+            move_workers: int = 1, queue_size: int | None = None
+        ):
+        if pool not in hash_pools:
+            raise ValueError(f"Unknown pool {pool}, choose one of {list(hash_pools)}")
+        self.db = db
+        self.metrics = db.metrics
+        self.workers = max(workers, 1)
+        self.pool = pool
+        self.batch_size = batch_size
+        self.move_workers = max(move_workers, 1)
+        self.queue_size = queue_size or 2 * (self.workers + self.move_workers)
+
+    def _put(self, q: queue.Queue, item) -> bool:
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout = poll_interval)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, q: queue.Queue):
+        while not self._stop.is_set():
+            try:
+                return q.get(timeout = poll_interval)
+            except queue.Empty:
+                continue
+        return _done
+
+    def _acquire(self) -> bool:
+        while not self._stop.is_set():
+            if self._slots.acquire(timeout = poll_interval):
+                return True
+        return False
+
+    def _discover(self, scans: Iterable[Scan]):
+        try:
+            start = time.perf_counter()
+            for scan in scans:
+                self.metrics.observe('discover', time.perf_counter() - start, scan.path)
+                self.metrics.count('scans_discovered')
+                if not self._put(self._discovered, scan):
+                    break
+                start = time.perf_counter()
+        except Exception as e:
+            self._events.put(('error', None, e))
+        finally:
+            for _ in range(self.workers):
+                self._put(self._discovered, _done)
+            self.db._release_connection()
+
+    def _hash(self, executor):
+        try:
+            self._hash_scans(executor)
+        finally:
+            # the thread ends with the run, its connection (for the cache and journal lookups) must not outlive it
+            self.db._release_connection()
+            self._events.put(('hashing_done', None, None))
+
+    def _hash_scans(self, executor):
+        # every scan takes a slot, which is only given back once the scan is dealt with
+        while self._acquire():
+            scan = self._get(self._discovered)
+            if scan is _done:
+                self._slots.release()
+                break
+            try:
+                start = time.perf_counter()
+                hashed = self.db._identify(scan, self.index)
+                if hashed:
+                    # taken before hashing, so a scan changing meanwhile is not journaled with a stale hash
+                    scan.get_identity()
+                    if self._staging and self.db._on_other_device(scan.path):
+                        self._stage(scan)
+                    elif executor is not None:
+                        # the process only hashes a copy of the scan
+                        scan.hash = executor.submit(Scan.hash_scan, scan, None, self.db.hash_chunk_size).result()
+                    else:
+                        scan.hash_scan(chunk_size = self.db.hash_chunk_size)
+                    self.metrics.count('scans_hashed')
+                self.metrics.observe('hash', time.perf_counter() - start, scan.path, scan.size if hashed else 0)
+                self._events.put(('hashed' if hashed else 'identified', scan, None))
+            except Exception as e:
+                self._events.put(('hashed', scan, e))
+
+    def _stage(self, scan: Scan):
+        '''
+        Copies and hashes a scan in one pass into a folder of its own in the staging folder,
+        from where it is renamed into the storage or dropped as a duplicate.
+        '''
+        staged_dir = tempfile.mkdtemp(dir = self.db.journal.staging_dir)
+        try:
+            scan.stage(staged_dir, self.db.hash_chunk_size)
+        except BaseException:
+            shutil.rmtree(staged_dir, ignore_errors = True)
+            raise
+        if scan.hash is not None:
+            # handed to the calling thread by the event of the hashed scan
+            self._staged[scan.path] = os.path.join(staged_dir, scan.filename)
+
+    def _fail(self, error: Exception):
+        logger.error(f'Stopping the insert pipeline due to: {error}')
+        if self._error is None:
+            self._error = error
+        self._stop.set()
+        # scans not moved yet stay in the ingress for the next run
+        while self._ready:
+            scan = self._ready.popleft()
+            for _ in self._pending.pop(scan.hash):
+                self._slots.release()
+            self._slots.release()
+
+    def _decide(self, scan: Scan):
+        '''
+        Deletes a duplicate scan or schedules a new one for moving, see `Db.insert`.
+        '''
+        # the cached hash is of no use anymore once the scan is moved or deleted
+        if self.db.hash_cache is not None:
+            self.db.hash_cache.discard(scan.path)
+        logger.debug(f"Starting insert pipeline for {scan.hash}: {scan.path}")
+        with self.metrics.time('lookup', scan.path):
+            in_ingress = self.index.in_ingress(scan)
+            pending = not in_ingress and scan.hash in self._pending
+            in_storage = not in_ingress and not pending and self.index.in_storage(scan)
+        if in_ingress:
+            logger.info(f'{scan.path} is already recorded in the ingress table and thus will be deleted.')
+            self._remove(scan)
+            self._slots.release()
+            return
+        if pending:
+            logger.debug('Scan with the same hash is being moved to storage, deciding once it arrived.')
+            self._pending[scan.hash].append(scan)
+            return
+        if in_storage:
+            logger.info(f'{scan.path} is already recorded in the storage table, so it is only recorded in the ingress table and then deleted.')
+            ingress_key = DedupIndex.ingress_key(scan)
+            with self.metrics.time('record', scan.path):
+                self.db.add_scan_to_ingress_db(scan, rec = True)
+                self.index.add_to_ingress(ingress_key)
+                self._session.checkpoint()
+            self._remove(scan)
+            self._slots.release()
+            return
+        self._pending[scan.hash] = []
+        self._ready.append(scan)
+
+    def _remove(self, scan: Scan):
+        self._emptied.add(os.path.dirname(scan.path))
+        self.db.journal.finish(scan.path)
+        staged = self._staged.pop(scan.path, None)
+        if staged is not None:
+            shutil.rmtree(os.path.dirname(staged), ignore_errors = True)
+        with self.metrics.time('cleanup', scan.path):
+            scan.remove()
+        self.metrics.count('duplicates_removed')
+
+    def _move(self, scan: Scan, target_dir: str, staged: str | None):
+        source = scan.path
+        with self.metrics.time('move', source, scan.size or 0):
+            if staged is None:
+                self.db.add_scan_to_storage(scan, target_dir)
+                return
+            # the copy is on the storage's filesystem already, so this is a rename
+            stored = Scan(staged)
+            stored.move(target_dir)
+            try:
+                scan.remove()
+            except OSError as e:
+                # the scan is stored nevertheless, the next insert deletes it as recorded in the ingress
+                logger.warning(f"Could not remove {source} after storing it: {e}")
+            scan.path = stored.path
+
+    def _start_moves(self, mover: ThreadPoolExecutor):
+        starting = []
+        while self._ready and self._moving < self.move_workers:
+            scan = self._ready.popleft()
+            # the scan goes where it is journaled, even if the layout changes meanwhile
+            starting.append((scan, os.path.dirname(self.db.journal.moving(scan))))
+            self._moving += 1
+        if not starting:
+            return
+        # write-ahead: the moves have to be in the journal before anything is moved
+        self._session.commit()
+        for scan, target_dir in starting:
+            # the ingress key has to be taken before the scan is moved
+            ingress_key = DedupIndex.ingress_key(scan)
+            self._emptied.add(os.path.dirname(scan.path))
+            future = mover.submit(self._move, scan, target_dir, self._staged.pop(scan.path, None))
+            future.add_done_callback(
+                lambda future, scan = scan, key = ingress_key, target_dir = target_dir:
+                    self._events.put(('moved', (scan, key, target_dir), future.exception()))
+            )
+
+    def _moved(self, scan: Scan, ingress_key: tuple, target_dir: str, error: Exception | None):
+        self._moving -= 1
+        waiting = self._pending.pop(scan.hash)
+        if error is None:
+            with self.metrics.time('record', scan.path):
+                self.db.record_stored_scan(scan, ingress_key[1])
+                self.db.journal.finish(ingress_key[1])
+                self.index.add_to_ingress(ingress_key)
+                self.index.add_to_storage(scan.hash)
+                if scan.fingerprint:
+                    self.index.add_fingerprint(scan.fingerprint, scan.hash)
+                self._session.checkpoint()
+            self.metrics.count('scans_stored')
+        else:
+            # `Scan.move` undoes a failed move, so the scan is back in the ingress
+            self.db.journal._set_hashed(ingress_key[1])
+            self.db.remove_empty_parents([target_dir], root = self.db.storage_dir)
+            self.metrics.count('scans_failed')
+            self._fail(error)
+        self._slots.release()
+        for waiting_scan in waiting:
+            if self._stop.is_set():
+                self._slots.release()
+            else:
+                # now a duplicate of the stored scan or, if the move failed, the new original
+                self._decide(waiting_scan)
+
+    def run(self, scans: Iterable[Scan]) -> Set[str]:
+        '''
+        Inserts the scans, which are consumed lazily, and returns once all of them are dealt with.
+        Only one insert runs at a time, see `IngestJournal.lock`.
+
+        Returns:
+            dirs (Set[str]): the folders scans were moved or deleted from, which might be empty now
+        '''
+        self._stop = threading.Event()
+        self._discovered = queue.Queue(maxsize = self.queue_size)
+        self._slots = threading.Semaphore(self.queue_size)
+        # the scans handed to the calling thread are limited by the slots
+        self._events = queue.Queue()
+        self._ready: deque[Scan] = deque()
+        # hash -> deferred scans with that hash, for all scans scheduled for moving
+        self._pending: Dict[str, List[Scan]] = {}
+        self._moving = 0
+        self._error = None
+        self._emptied: Set[str] = set()
+        # ingress path -> copy in the staging folder, see `_stage`
+        self._staged: Dict[str, str] = {}
+        with self.db.journal.lock():
+            # moves an earlier insert left half-done, before anything is looked up
+            self.db.journal._recover()
+            self.db.journal.clear_staging()
+            os.makedirs(self.db.journal.staging_dir, exist_ok = True)
+            # a copy in the staging folder is only moved by a rename if it is on the storage's filesystem
+            self._staging = not self.db._on_other_device(self.db.journal.staging_dir)
+            try:
+                return self._insert(scans)
+            except BaseException:
+                # the folders emptied before the failure are not handed to the caller
+                if self.db.ingress_dir is not None:
+                    self.db.remove_empty_parents(self._emptied)
+                raise
+            finally:
+                # copies of duplicates or of scans not moved due to a failure
+                self.db.journal.clear_staging()
+
+    def _insert(self, scans: Iterable[Scan]) -> Set[str]:
+        executor = hash_pools[self.pool](max_workers = self.workers) if self.pool == 'process' else None
+        mover = ThreadPoolExecutor(max_workers = self.move_workers)
+        threads = []
+        try:
+            with self.db.session(self.batch_size) as session:
+                self._session = session
+                with self.metrics.time('lookup'):
+                    self.index = self.db.load_dedup_index()
+                threads.append(threading.Thread(target = self._discover, args = (scans, ), daemon = True))
+                threads += [threading.Thread(target = self._hash, args = (executor, ), daemon = True) for _ in range(self.workers)]
+                for thread in threads:
+                    thread.start()
+                hashing = self.workers
+                while hashing or self._moving:
+                    if self._events.empty():
+                        # waiting for a hash or move might take long, meanwhile the write lock is not held
+                        session.commit()
+                    kind, scan, error = self._events.get()
+                    if kind == 'hashing_done':
+                        hashing -= 1
+                    elif kind == 'error':
+                        self._fail(error)
+                    elif kind == 'moved':
+                        self._moved(*scan, error)
+                    elif self._stop.is_set():
+                        self._slots.release()
+                    elif error is not None:
+                        self.metrics.count('scans_failed')
+                        self._slots.release()
+                        self._fail(error)
+                    elif scan.hash is None:
+                        logger.warning(f'{scan.path} could not be hashed, it stays in the ingress.')
+                        self.metrics.count('scans_failed')
+                        self._slots.release()
+                    else:
+                        if kind == 'hashed':
+                            # a hash only indicated by a trusted fingerprint must not be taken over from the journal later
+                            self.db.journal.hashed(scan)
+                        self._decide(scan)
+                    self._start_moves(mover)
+        finally:
+            self._stop.set()
+            mover.shutdown(wait = True)
+            for thread in threads:
+                thread.join()
+            if executor is not None:
+                executor.shutdown(wait = True, cancel_futures = True)
+        if self._error is not None:
+            raise self._error
+        return self._emptied
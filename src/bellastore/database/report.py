@@ -0,0 +1,71 @@
+import os
+import json
+from typing import Dict, Iterator
+
+from bellastore.utils.table import format_bytes
+
+# tables summarized by the report, the entries of these are streamed with `entries = True`
+report_tables = ['ingress', 'storage']
+
+
+def iter_report(db, depth: int = 1, entries: bool = False, batch_size: int = 1000) -> Iterator[Dict]:
+    '''
+    Generator yielding the inventory of a database and its filesystem as records (dicts).
+
+    Nothing is loaded at once: the tables are counted and (optionally) paged through,
+    and the tree is summarized per directory and format instead of listing every node.
+    Every record has a `type`, one of `table`, `directory`, `format`, `total` and `entry`.
+
+    Args:
+        db (Db): the database to report on
+        depth (int): the number of directory levels summarized separately, see `Fs.summarize_tree`
+        entries (bool): also yield every entry of the tables
+        batch_size (int): number of entries read at once
+    '''
+    for table in report_tables:
+        yield {'type': 'table', 'table': table, 'entries': db.count_rows(table)}
+    summary = db.summarize_tree(depth = depth)
+    for directory, counts in sorted(summary['directories'].items()):
+        yield {'type': 'directory', 'path': os.path.normpath(os.path.join(db.root_dir, directory)), **counts}
+    for format, counts in sorted(summary['formats'].items()):
+        yield {'type': 'format', 'format': format, **counts}
+    yield {
+        'type': 'total',
+        'files': sum(counts['files'] for counts in summary['formats'].values()),
+        'bytes': sum(counts['bytes'] for counts in summary['formats'].values()),
+    }
+    if not entries:
+        return
+    for table in report_tables:
+        columns = db.table_columns(table)
+        for row in db.iter_rows(table, batch_size):
+            yield {'type': 'entry', 'table': table, **dict(zip(columns, row))}
+
+
+def format_record(record: Dict) -> str:
+    '''
+    Renders a record of `iter_report` as a line of plain text.
+    '''
+    kind = record['type']
+    if kind == 'table':
+        return f"{record['table']} table: {record['entries']} entries"
+    if kind == 'entry':
+        return '\t'.join([record['table']] + [str(value) for key, value in record.items() if key not in ('type', 'table')])
+    counts = f"{record['files']} files, {format_bytes(record['bytes'])}"
+    if kind == 'directory':
+        return f"{record['path']}: {counts}"
+    if kind == 'format':
+        return f"{record['format'] or '(no extension)'}: {counts}"
+    return f"total: {counts}"
+
+
+def write_report(db, out, format: str = 'text', **kwargs):
+    '''
+    Writes the report line by line to the file object `out`, either as `text` or as JSON Lines (`jsonl`).
+    The keyword arguments are passed on to `iter_report`.
+    '''
+    if format not in ('text', 'jsonl'):
+        raise ValueError(f"Unknown format {format}, choose one of ['text', 'jsonl']")
+    for record in iter_report(db, **kwargs):
+        line = json.dumps(record) if format == 'jsonl' else format_record(record)
+        out.write(line + '\n')
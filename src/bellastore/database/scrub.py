@@ -0,0 +1,155 @@
+import os
+import itertools
+from collections import deque
+from datetime import datetime
+from typing import Dict, Iterator
+from concurrent.futures import ThreadPoolExecutor
+
+from bellastore.filesystem.fs import Fs
+from bellastore.database.connection import SideTable, sqlite_connection
+from bellastore.utils.scan import Scan
+from bellastore.utils.hashing import RateLimiter
+
+
+class Scrubber(SideTable):
+    '''
+    Checks that the stored scans still match their recorded hashes, e.g. to detect bitrot.
+
+    The scans are re-hashed (bypassing the hash cache) on a pool of threads, optionally capped
+    to a total read bandwidth so the storage stays responsive. They are visited in the order of
+    their hashes, and the last verified hash is kept in the meta table. An interrupted or
+    limited run therefore resumes where the previous one stopped, and a completed pass starts over.
+    The outcome per scan is kept in the `scrub` table together with the time of the check.
+    Every outcome is committed on its own, so inserts are not locked out while scans are hashed.
+
+    Attributes
+    ----------
+    db: Db
+        The database whose storage is checked
+    workers: int
+        Number of threads hashing scans
+    limiter: RateLimiter | None
+        The bandwidth cap shared by all workers, if any
+    batch_size: int
+        Number of stored scans read from the database at once
+
+    Methods
+    -------
+    run:
+        Generator checking the scans and yielding a record per scan and orphan
+    get_status:
+        Returns the last check of a scan
+    '''
+
+    def __init__(self, db, workers: int = 4, bandwidth: float | None = None, batch_size: int = 100):
+        super().__init__(db)
+        self.workers = workers
+        self.limiter = RateLimiter(bandwidth) if bandwidth else None
+        self.batch_size = batch_size
+        self._initialize_table()
+
+    @sqlite_connection
+    def _initialize_table(self, cursor):
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS scrub (
+            hash TEXT NOT NULL PRIMARY KEY,
+            verified_at TEXT,
+            status TEXT,
+            actual_hash TEXT
+        )
+        ''')
+
+    @sqlite_connection
+    def _record(self, cursor, result: Dict):
+        # the result and the position to resume from in one short transaction, the write lock is not held while hashing
+        cursor.execute(
+            "INSERT OR REPLACE INTO scrub (hash, verified_at, status, actual_hash) VALUES (?, ?, ?, ?)",
+            (result['hash'], result['verified_at'], result['status'], result.get('actual_hash'))
+        )
+        self.db.set_meta('scrub_after', result['hash'])
+
+    @sqlite_connection
+    def get_status(self, cursor, hash: str) -> Dict | None:
+        '''
+        Returns the last check of the scan with the given hash (`verified_at`, `status`, `actual_hash`) or `None`.
+        '''
+        cursor.execute("SELECT verified_at, status, actual_hash FROM scrub WHERE hash = ?", (hash, ))
+        entry = cursor.fetchone()
+        if entry is None:
+            return None
+        return dict(zip(['verified_at', 'status', 'actual_hash'], entry))
+
+    def _iter_storage(self, after: str | None) -> Iterator[tuple]:
+        while True:
+            page = self.db.get_storage_page(self.batch_size, after)
+            if not page:
+                return
+            yield from page
+            after = page[-1][0]
+
+    def _check(self, entry: tuple) -> Dict:
+        hash, filepath, _, _ = entry
+        scan = Scan(filepath)
+        try:
+            actual_hash = scan.hash_scan(chunk_size = self.db.hash_chunk_size, limiter = self.limiter)
+        except (OSError, ValueError):
+            # vanished or not a file anymore
+            actual_hash = None
+        result = {'type': 'scan', 'hash': hash, 'filepath': filepath}
+        if actual_hash is None:
+            result['status'] = 'missing'
+        elif actual_hash != hash:
+            result['status'] = 'mismatch'
+            result['actual_hash'] = actual_hash
+        else:
+            result['status'] = 'ok'
+        result['verified_at'] = datetime.now().isoformat(timespec = 'seconds')
+        # files within the folder of the scan that do not belong to it
+        files = set(scan.get_files()) if result['status'] != 'missing' else set()
+        result['orphans'] = sorted(file for file in Fs._iter_files(os.path.dirname(filepath)) if file not in files)
+        return result
+
+    def run(self, limit: int | None = None, restart: bool = False, orphans: bool = True) -> Iterator[Dict]:
+        '''
+        Generator checking the stored scans and yielding a record per scan (`type` `scan`, with the
+        `status` `ok`, `mismatch` or `missing`) and per orphan file (`type` `orphan`).
+
+        Args:
+            limit (int | None): the maximum number of scans checked in this run
+            restart (bool): start from the first scan instead of where the last run stopped
+            orphans (bool): also look for files in the storage not belonging to a recorded scan
+        '''
+        after = None if restart else self.db.get_meta('scrub_after') or None
+        entries = self._iter_storage(after)
+        if limit is not None:
+            entries = itertools.islice(entries, limit)
+        checked = 0
+        with ThreadPoolExecutor(max_workers = self.workers) as executor:
+            # a bounded window of scans in flight, completed in order so the checkpoint never skips a scan
+            in_flight = deque(executor.submit(self._check, entry) for entry in itertools.islice(entries, 2 * self.workers))
+            while in_flight:
+                result = in_flight.popleft().result()
+                for entry in itertools.islice(entries, 1):
+                    in_flight.append(executor.submit(self._check, entry))
+                self._record(result)
+                checked += 1
+                for orphan in result.pop('orphans'):
+                    yield {'type': 'orphan', 'filepath': orphan}
+                yield result
+            if limit is None or checked < limit:
+                # the pass is complete, the next run starts over
+                self.db.set_meta('scrub_after', '')
+        if orphans:
+            for orphan in self.db.reconcile()['untracked']:
+                yield {'type': 'orphan', 'filepath': orphan}
+
+
+def format_result(record: Dict) -> str:
+    '''
+    Renders a record of `Scrubber.run` as a line of plain text.
+    '''
+    if record['type'] == 'orphan':
+        return f"orphan: {record['filepath']}"
+    if record['status'] == 'mismatch':
+        return f"mismatch: {record['filepath']} (recorded {record['hash']}, now {record['actual_hash']})"
+    return f"{record['status']}: {record['filepath']}"
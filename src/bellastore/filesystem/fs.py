@@ -1,9 +1,31 @@
 import os
+import logging
 from os.path import join as _j
 from pathlib import Path
-from typing import List
+from typing import Dict, List, Iterator, Iterable
 
 from bellastore.utils.scan import Scan
+from bellastore.utils.constants import scan_extensions
+
+logger = logging.getLogger(__name__)
+
+def parse_layout(layout: str | None) -> List[int]:
+    '''
+    Parses a storage layout, i.e. the widths of the hash prefixes the scan folders are sharded by.
+    E.g. `2/2` stores a scan under `storage/ab/cd/<hash>/`, whereas `flat` (or an empty layout)
+    stores it directly under `storage/<hash>/`.
+    '''
+    if not layout or layout == 'flat':
+        return []
+    shards = [int(width) for width in layout.split('/')]
+    if any(width <= 0 for width in shards):
+        raise ValueError(f"Invalid storage layout {layout}, the widths have to be positive")
+    return shards
+
+
+def format_layout(shards: List[int]) -> str:
+    return '/'.join(str(width) for width in shards) or 'flat'
+
 
 # blueprint fs
 class Fs:
@@ -24,6 +46,8 @@ class Fs:
         The directory holding all already recorded scans
     backup_dir: str
         The directory holding database backups
+    shards: List[int]
+        The widths of the hash prefixes the scan folders in the storage are sharded by, see `parse_layout`
     
     Methods
     -------
@@ -35,8 +59,14 @@ class Fs:
         The recording in the databse will be handled by the Db class
     get_valid_scans_from_ingress:
         Method that scans the ingress directory for valid scans
+    iter_valid_scans_from_ingress:
+        Generator version of `get_valid_scans_from_ingress` yielding scans while walking the ingress
     remove_empty_folders:
         Method to remove empty folders, resulting from moving scans to storage
+    remove_empty_parents:
+        Method to remove only the given folders (and their parents) within the ingress if empty
+    summarize_tree:
+        Method counting files and bytes per directory and format, without listing every node
     '''
 
     def __init__(self, root_dir, ingress_dir: None|str):
@@ -50,30 +80,99 @@ class Fs:
             os.makedirs(self.ingress_dir, exist_ok = True)
         self.backup_dir = _j(root_dir, "backup")
         os.makedirs(self.backup_dir, exist_ok=True)
+        self.shards: List[int] = []
+
+    def get_scan_dir(self, hash: str) -> str:
+        '''
+        Returns the folder of a scan within the storage according to the layout.
+        '''
+        prefixes = []
+        start = 0
+        for width in self.shards:
+            prefixes.append(hash[start:start + width])
+            start += width
+        return _j(self.storage_dir, *prefixes, hash)
+
+    def iter_storage(self) -> Iterator[os.DirEntry]:
+        '''
+        Generator yielding the scan folders of the storage and the files lying outside of them.
+
+        On the levels of the layout, folders named as wide as the shard are descended into,
+        all other folders are taken as scan folders, e.g. those of a flat layout while resharding.
+        '''
+        stack = [(self.storage_dir, 0)]
+        while stack:
+            current, level = stack.pop()
+            try:
+                with os.scandir(current) as entries:
+                    for entry in entries:
+                        if not entry.is_dir(follow_symlinks = False):
+                            yield entry
+                        elif level < len(self.shards) and len(entry.name) == self.shards[level]:
+                            stack.append((entry.path, level + 1))
+                        else:
+                            yield entry
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+
+    @staticmethod
+    def _iter_entries(dir) -> Iterator[os.DirEntry]:
+        '''
+        Generator walking `dir` recursively and yielding the `os.DirEntry` of all files.
+
+        The walk uses `os.scandir`, whose entries already know their type in most cases,
+        so no extra stat per file is needed.
+        Symlinks to directories are not followed, like `Path.rglob`.
+        Directories that vanish during the walk (e.g. as scans are moved meanwhile) are skipped.
+        '''
+        stack = [str(dir)]
+        while stack:
+            current = stack.pop()
+            try:
+                with os.scandir(current) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks = False):
+                            stack.append(entry.path)
+                        elif entry.is_file():
+                            yield entry
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+
+    @staticmethod
+    def _iter_files(dir, extensions: List[str] | None = None) -> Iterator[str]:
+        '''
+        Generator yielding the paths of all files below `dir`, see `_iter_entries`.
+        Filtering by `extensions` happens on the names.
+        '''
+        endings = tuple(extensions) if extensions is not None else None
+        for entry in Fs._iter_entries(dir):
+            if endings is None or entry.name.endswith(endings):
+                yield entry.path
 
     @staticmethod
     def _get_files(dir):
-        files = Path(dir).rglob("*")
-        file_paths = list(files)
-        file_paths = [str(file) for file in file_paths if file.is_file()]
-        return file_paths
+        return list(Fs._iter_files(dir))
     
-    def get_valid_scans_from_ingress(self) -> List[Scan]:
-        '''
-        Method that scans the ingress directory for valid scans
+    def iter_valid_scans_from_ingress(self) -> Iterator[Scan]:
         '''
+        Generator yielding the valid scans of the ingress directory while walking it.
 
-        scans = []
-        print(f'Reading files from ingress directory {self.ingress_dir}')
-        files = self._get_files(self.ingress_dir)
-        for file in files:
+        Only files with a scan extension are turned into `Scan` objects, so sidecar files are cheap.
+        '''
+        logger.info(f'Reading files from ingress directory {self.ingress_dir}')
+        for file in self._iter_files(self.ingress_dir, scan_extensions):
             scan = Scan(file)
             if not scan.is_valid():
                 # print(f'Non-valid {scan.path}')
                 continue
-            print(f'Valid scan: {scan.path}')
-            scans.append(scan)
-        return scans
+            logger.debug(f'Valid scan: {scan.path}')
+            yield scan
+
+    def get_valid_scans_from_ingress(self) -> List[Scan]:
+        '''
+        Method that scans the ingress directory for valid scans
+        '''
+        return list(self.iter_valid_scans_from_ingress())
 
     
     def _add_scan_to_ingress(self, scan: Scan):
@@ -81,16 +180,30 @@ class Fs:
         Method that adds a scan to the ingress, i.e. hashes the scan.
         '''
 
-        # Moving to ingress is equivalent to hashing
-        scan.hash_scan()
-    def add_scan_to_storage(self, scan: Scan):
+        # Moving to ingress is equivalent to hashing (if not already done)
+        if scan.hash is None:
+            scan.hash_scan()
+    def _on_other_device(self, path: str) -> bool:
+        '''
+        Checks whether `path` is on another filesystem than the storage, so moving it there means copying it.
+        '''
+        try:
+            return os.stat(path).st_dev != os.stat(self.storage_dir).st_dev
+        except OSError:
+            return False
+
+    def add_scan_to_storage(self, scan: Scan, target_dir: str | None = None):
         '''
         Main function moving scans from ingress to storage
+
+        Within a filesystem the scan is renamed, across filesystems it is copied
+        and the copy is verified against the scan's hash before the source is removed.
+        The scan goes to `target_dir` if given (e.g. as journaled) and to its folder in the layout otherwise.
         '''
         
         # self._add_scan_to_ingress(scan)
-        target_dir = os.path.join(self.storage_dir, scan.hash)
-        scan.move(target_dir)
+        target_dir = target_dir or self.get_scan_dir(scan.hash)
+        scan.move(target_dir, verify = True)
     def _add_scans_to_ingress(self, scans: List[Scan]):
         for scan in scans:
             self.add_scan_to_ingress(scan)
@@ -119,13 +232,68 @@ class Fs:
                     # If directory is empty, remove it
                     if not os.listdir(full_path):
                         os.rmdir(full_path)
-                        print(f"Removed empty folder: {full_path}")
+                        logger.debug(f"Removed empty folder: {full_path}")
                 except OSError as e:
-                    print(f"Error removing {full_path}: {e}")
+                    logger.warning(f"Error removing {full_path}: {e}")
+
+    def remove_empty_parents(self, dirs: Iterable[str], root: str | None = None):
+        '''
+        Removes the given folders and then their parents as long as they are empty.
+
+        Only folders strictly within `root` (by default the ingress directory) are touched, the root itself is kept.
+        As opposed to `remove_empty_folders` this does not walk any tree, so the cost
+        only depends on the amount of given folders.
+        '''
+        root = os.path.abspath(root or self.ingress_dir)
+        # deepest folders first, so their parents might become empty
+        for dir in sorted({os.path.abspath(dir) for dir in dirs}, key = len, reverse = True):
+            while dir.startswith(root + os.sep):
+                try:
+                    # this fails for non-empty folders, which is cheaper than listing them
+                    os.rmdir(dir)
+                    logger.debug(f"Removed empty folder: {dir}")
+                except FileNotFoundError:
+                    pass
+                except OSError:
+                    break
+                dir = os.path.dirname(dir)
 
     
 
 
+    def summarize_tree(self, path = None, depth: int = 1) -> Dict[str, Dict[str, Dict[str, int]]]:
+        '''
+        Summarizes a tree instead of listing every node.
+
+        The files are walked once and only their amount and size are kept, per directory
+        up to `depth` levels below `path` (deeper files count towards their ancestor) and per format.
+        So the memory does not grow with the amount of files, e.g. the hash folders of the storage.
+
+        Args:
+            path (str | None): the root of the tree, the root of the fs by default
+            depth (int): the number of directory levels to summarize separately
+
+        Returns:
+            summary (Dict): `directories` and `formats`, each mapping to {'files': ..., 'bytes': ...}
+        '''
+        root = str(path or self.root_dir)
+        directories: Dict[str, Dict[str, int]] = {}
+        formats: Dict[str, Dict[str, int]] = {}
+        for entry in self._iter_entries(root):
+            try:
+                size = entry.stat(follow_symlinks = False).st_size
+            except FileNotFoundError:
+                continue
+            relative = os.path.relpath(os.path.dirname(entry.path), root)
+            parts = [] if relative == os.curdir else relative.split(os.sep)
+            directory = os.sep.join(parts[:depth]) or os.curdir
+            format = os.path.splitext(entry.name)[1].lower()
+            for totals, key in ((directories, directory), (formats, format)):
+                counts = totals.setdefault(key, {'files': 0, 'bytes': 0})
+                counts['files'] += 1
+                counts['bytes'] += size
+        return {'directories': directories, 'formats': formats}
+
     def print_tree(self, path=None, prefix=''):
         if path is None:
             path = Path(self.root_dir)
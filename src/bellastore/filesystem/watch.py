@@ -0,0 +1,268 @@
+import os
+import sys
+import time
+import errno
+import logging
+import select
+import struct
+import ctypes
+import ctypes.util
+import threading
+from os.path import join as _j
+from typing import Dict, List, Set, Tuple
+
+from bellastore.filesystem.fs import Fs
+from bellastore.utils.scan import Scan
+from bellastore.utils.constants import scan_extensions
+
+logger = logging.getLogger(__name__)
+
+# inotify event masks, see `man 7 inotify`
+IN_MODIFY       = 0x00000002
+IN_ATTRIB       = 0x00000004
+IN_CLOSE_WRITE  = 0x00000008
+IN_MOVED_TO     = 0x00000080
+IN_CREATE       = 0x00000100
+IN_Q_OVERFLOW   = 0x00004000
+IN_IGNORED      = 0x00008000
+IN_ISDIR        = 0x40000000
+_event = struct.Struct('iIII')
+# Seconds the retry of a scan whose insert failed is delayed at most
+max_backoff = 3600.0
+
+
+class Inotify():
+    '''
+    A minimal recursive inotify watch on a directory tree (linux only).
+
+    New subdirectories are watched as they appear. Reading events returns the
+    directories that changed, rather than the single events.
+
+    Methods
+    -------
+    read:
+        Waits for events and returns the changed directories
+    close:
+        Closes the inotify instance
+    '''
+    mask = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+    def __init__(self, root: str):
+        if not sys.platform.startswith('linux'):
+            raise OSError(errno.ENOSYS, 'inotify is only available on linux')
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno = True)
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.watches: Dict[int, str] = {}
+        self._add_tree(root)
+
+    def _add(self, path: str):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), self.mask)
+        if wd < 0:
+            error = ctypes.get_errno()
+            # the directory might be gone already
+            if error in (errno.ENOENT, errno.ENOTDIR):
+                return
+            raise OSError(error, f'inotify_add_watch failed for {path}')
+        self.watches[wd] = path
+
+    def _add_tree(self, root: str):
+        for dir, _, _ in os.walk(root):
+            self._add(dir)
+
+    def read(self, timeout: float) -> Tuple[Set[str], Set[str], bool]:
+        '''
+        Waits up to `timeout` seconds for events.
+
+        Returns:
+            dirs (Set[str]): directories whose direct content changed
+            trees (Set[str]): new directories, whose whole tree has to be looked at
+            overflow (bool): whether events were lost, so everything has to be looked at
+        '''
+        dirs, trees, overflow = set(), set(), False
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return dirs, trees, overflow
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = _event.unpack_from(data, offset)
+                name = data[offset + _event.size:offset + _event.size + length].rstrip(b'\0')
+                offset += _event.size + length
+                if mask & IN_Q_OVERFLOW:
+                    overflow = True
+                    continue
+                if mask & IN_IGNORED:
+                    self.watches.pop(wd, None)
+                    continue
+                dir = self.watches.get(wd)
+                if dir is None:
+                    continue
+                dirs.add(dir)
+                if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                    # files might have been created before the watch was added
+                    path = _j(dir, os.fsdecode(name))
+                    self._add_tree(path)
+                    trees.add(path)
+        return dirs, trees, overflow
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Watcher():
+    '''
+    Watches the ingress of a database and inserts new scans once they are complete.
+
+    A scan is considered complete once its identity (amount of files, size and latest
+    modification, see `Scan.get_identity`) did not change for `settle` seconds,
+    so scans that are still being copied into the ingress are not hashed prematurely.
+    Changes are picked up by inotify, falling back to walking the ingress every `interval` seconds.
+
+    Attributes
+    ----------
+    db: Db
+        The database to insert into
+    settle: float
+        Seconds a scan has to stay unchanged before it is inserted
+    interval: float
+        Seconds between two checks of the pending scans
+    inotify: Inotify | None
+        The inotify watch, `None` if polling
+    failures: Dict[str, int]
+        Number of failed inserts per scan, retrying a scan waits longer after every failure
+    metrics_path: str | None
+        If given, the metrics of the database are written there after every insert, see `Metrics.write`
+
+    Methods
+    -------
+    tick:
+        Runs a single check and inserts the complete scans
+    run:
+        Runs checks until stopped
+    '''
+
+    def __init__(
+            self, db, settle: float = 30.0, interval: float = 5.0, use_inotify: bool = True,
+            workers: int = 1, pool: str = 'thread', batch_size: int = 100, move_workers: int = 1,
+            metrics_path: str | None = None
+        ):
+        self.db = db
+        self.settle = settle
+        self.interval = interval
+        self.workers = workers
+        self.pool = pool
+        self.batch_size = batch_size
+        self.move_workers = move_workers
+        self.metrics_path = metrics_path
+        # path -> (identity, time since which the identity did not change)
+        self.pending: Dict[str, Tuple[tuple, float]] = {}
+        self.failures: Dict[str, int] = {}
+        self.inotify = None
+        if use_inotify:
+            try:
+                self.inotify = Inotify(db.ingress_dir)
+            except OSError as e:
+                logger.warning(f'Inotify not available ({e}), falling back to polling every {interval}s')
+        # everything that is already there has to be looked at once
+        self._rescan = True
+
+    def _discover(self, timeout: float) -> List[str]:
+        '''
+        Returns the scan files that might have changed, waiting up to `timeout` seconds for changes.
+        '''
+        if self.inotify is None or self._rescan:
+            self._rescan = False
+            if self.inotify is None:
+                time.sleep(timeout)
+            return list(Fs._iter_files(self.db.ingress_dir, scan_extensions))
+        dirs, trees, overflow = self.inotify.read(timeout)
+        if overflow:
+            return list(Fs._iter_files(self.db.ingress_dir, scan_extensions))
+        files = []
+        for dir in dirs:
+            try:
+                with os.scandir(dir) as entries:
+                    files += [entry.path for entry in entries if entry.name.endswith(tuple(scan_extensions))]
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+        for tree in trees:
+            files += Fs._iter_files(tree, scan_extensions)
+        return files
+
+    def _ready_scans(self, files: List[str]) -> List[Scan]:
+        now = time.monotonic()
+        for file in files:
+            if file not in self.pending:
+                self.pending[file] = (None, now)
+        ready = []
+        for file, (identity, since) in list(self.pending.items()):
+            scan = Scan(file)
+            current = scan.get_identity() if scan.is_valid() else None
+            if current is None:
+                # gone or not (yet) valid, e.g. a `.mrxs` file without its folder
+                if not os.path.exists(file):
+                    del self.pending[file]
+                continue
+            if current != identity:
+                self.pending[file] = (current, now)
+            elif now - since >= self.settle:
+                del self.pending[file]
+                ready.append(scan)
+        return ready
+
+    def tick(self, timeout: float = 0.0) -> List[Scan]:
+        '''
+        Looks for changes (waiting up to `timeout` seconds) and inserts the scans that are complete.
+
+        Returns:
+            scans (List[Scan]): the inserted scans
+        '''
+        scans = self._ready_scans(self._discover(timeout))
+        if not scans:
+            return scans
+        paths = [scan.path for scan in scans]
+        try:
+            dirs = self.db.insert_many(scans, self.workers, self.pool, self.batch_size, self.move_workers)
+            for path in paths:
+                self.failures.pop(path, None)
+        except Exception as e:
+            logger.error(f'Inserting scans failed: {e}')
+            dirs = {os.path.dirname(scan.path) for scan in scans if scan.path is not None}
+            self._retry([path for path in paths if os.path.exists(path)])
+        with self.db.metrics.time('cleanup'):
+            self.db.remove_empty_parents(dirs)
+        if self.metrics_path is not None:
+            # the totals since the start of the watcher
+            self.db.metrics.write(self.metrics_path)
+        return scans
+
+    def _retry(self, paths: List[str]):
+        '''
+        Puts scans whose insert failed back into `pending`, so they are retried even without a change.
+        The wait before the retry doubles with every failure, up to `max_backoff` seconds.
+        '''
+        now = time.monotonic()
+        for path in paths:
+            failures = self.failures.get(path, 0) + 1
+            self.failures[path] = failures
+            backoff = min(max(self.settle, self.interval) * 2 ** (failures - 1), max_backoff)
+            # the scan is ready once it did not change for `settle` seconds after the backoff
+            self.pending[path] = (Scan(path).get_identity(), now + backoff)
+
+    def run(self, stop: threading.Event | None = None):
+        '''
+        Watches the ingress until `stop` is set (or forever).
+        '''
+        logger.info(f'Watching {self.db.ingress_dir}')
+        while stop is None or not stop.is_set():
+            self.tick(self.interval)
+
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
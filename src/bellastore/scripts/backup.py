@@ -1,5 +1,7 @@
 from bellastore.database.db import Db
+from bellastore.database.backup import retention_periods
 import argparse
+import sys
 
 def main():
     cli = argparse.ArgumentParser()
@@ -11,14 +13,56 @@ def main():
         '--sqlite_name', type = str, default = 'scans.sqlite',
         help = 'Name of the sqlite database file'
     )
+    cli.add_argument(
+        '--journal_mode', type = str, default = 'WAL', choices = ['WAL', 'DELETE'],
+        help = 'Journal mode of the database, WAL lets readers run concurrently but does not work on network filesystems'
+    )
+    cli.add_argument(
+        '--compression', type = str, default = 'none', choices = ['none', 'gzip', 'zstd'],
+        help = 'Compress the backup while writing it, zstd needs python >= 3.14 or the zstandard package'
+    )
+    cli.add_argument(
+        '--pages', type = int, default = 1024,
+        help = 'Number of database pages copied per step, inserts may continue between the steps'
+    )
+    cli.add_argument(
+        '--force', action=argparse.BooleanOptionalAction,
+        help = 'Create a backup even if nothing changed since the last one'
+    )
+    cli.add_argument(
+        '--keep_last', type = int, default = 10,
+        help = 'Number of newest backups to keep'
+    )
+    for period in retention_periods:
+        cli.add_argument(
+            f'--keep_{period}', type = int, default = 0,
+            help = f'Additionally keep the newest backup of this many {period} periods'
+        )
+    cli.add_argument(
+        '--verify', action=argparse.BooleanOptionalAction,
+        help = 'Instead of creating a backup, check all backups against their checksums and for integrity'
+    )
+    cli.add_argument(
+        '--workers', type = int, default = 4,
+        help = 'Number of backups verified concurrently'
+    )
     args = cli.parse_args()
     root_dir = args.root_dir
     sqlite_name = args.sqlite_name
+    journal_mode = args.journal_mode
 
-    db = Db(root_dir=root_dir, ingress_dir=None, filename=sqlite_name)
+    db = Db(root_dir=root_dir, ingress_dir=None, filename=sqlite_name, journal_mode=journal_mode)
 
     db.setup_logging()
-    db.create_backup()
+    if args.verify:
+        problems = db.verify_backups(workers = args.workers)
+        sys.exit(1 if problems else 0)
+    retention = {period: getattr(args, f'keep_{period}') for period in retention_periods}
+    created = db.create_backup(
+        max_backups = args.keep_last, compression = args.compression, pages = args.pages,
+        force = bool(args.force), retention = retention
+    )
+    sys.exit(0 if created else 1)
 
 
 if __name__ == '__main__':
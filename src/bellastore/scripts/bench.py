@@ -0,0 +1,104 @@
+from bellastore.database.bench import run_benchmarks, format_result, compare_results
+import argparse
+import logging
+import tempfile
+import shutil
+import json
+import sys
+import os
+
+def main():
+    cli = argparse.ArgumentParser(description = 'Benchmarks the hot paths of bellastore on synthetic scans')
+    cli.add_argument(
+        '--work_dir', type = str, default = None,
+        help = 'Directory the synthetic ingress and database are created in, by default a temporary one. Should be on the filesystem to be benchmarked'
+    )
+    cli.add_argument(
+        '--scans', type = int, default = 20,
+        help = 'Number of (sparse) single file scans'
+    )
+    cli.add_argument(
+        '--size', type = int, default = 64 * 2**20,
+        help = 'Size of every scan in bytes, the files are sparse so this costs no disk space'
+    )
+    cli.add_argument(
+        '--depth', type = int, default = 3,
+        help = 'Number of folder levels of the ingress tree'
+    )
+    cli.add_argument(
+        '--fanout', type = int, default = 4,
+        help = 'Number of subfolders per folder of the ingress tree'
+    )
+    cli.add_argument(
+        '--mrxs', type = int, default = 2,
+        help = 'Number of MIRAX scans'
+    )
+    cli.add_argument(
+        '--mrxs_files', type = int, default = 10,
+        help = 'Number of data files per MIRAX scan, sharing its size'
+    )
+    cli.add_argument(
+        '--rows', type = int, default = 100000,
+        help = 'Number of synthetic entries recorded in the database for the query and backup stages'
+    )
+    cli.add_argument(
+        '--lookups', type = int, default = 1000,
+        help = 'Number of lookups by hash'
+    )
+    cli.add_argument(
+        '--workers', type = int, default = 1,
+        help = 'Number of workers hashing scans during the insert'
+    )
+    cli.add_argument(
+        '--move_workers', type = int, default = 1,
+        help = 'Number of workers moving scans into the storage during the insert'
+    )
+    cli.add_argument(
+        '--seed', type = int, default = 0,
+        help = 'Seed of the synthetic content'
+    )
+    cli.add_argument(
+        '--format', type = str, default = 'text', choices = ['text', 'jsonl'],
+        help = 'Output plain text or one JSON object per line, the latter can be used as --baseline'
+    )
+    cli.add_argument(
+        '--baseline', type = str, default = None,
+        help = 'JSON Lines output of a previous run, stages that got slower than --tolerance fail the run'
+    )
+    cli.add_argument(
+        '--tolerance', type = float, default = 0.2,
+        help = 'Fraction of the baseline throughput a stage may lose'
+    )
+    args = cli.parse_args()
+
+    if args.work_dir is None:
+        work_dir = tempfile.mkdtemp(prefix = 'bellastore-bench-')
+    else:
+        work_dir = os.path.join(args.work_dir, 'bellastore-bench')
+    records = run_benchmarks(
+        work_dir, scans = args.scans, size = args.size, depth = args.depth, fanout = args.fanout,
+        mrxs = args.mrxs, mrxs_files = args.mrxs_files, rows = args.rows, lookups = args.lookups,
+        workers = args.workers, move_workers = args.move_workers, seed = args.seed
+    )
+    # the messages per scan would drown the results, warnings are still shown
+    logging.getLogger('bellastore').setLevel(logging.WARNING)
+    results = []
+    try:
+        for record in records:
+            results.append(record)
+            print(json.dumps(record) if args.format == 'jsonl' else format_result(record), flush = True)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors = True)
+
+    if args.baseline is not None:
+        with open(args.baseline, encoding = 'utf-8') as f:
+            baseline = [json.loads(line) for line in f if line.strip()]
+        regressions = compare_results(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f'Regression: {regression}', file = sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
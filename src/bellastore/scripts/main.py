@@ -1,4 +1,5 @@
 from bellastore.database.db import Db
+from bellastore.utils.metrics import configure_logging
 import argparse
 
 def main():
@@ -15,6 +16,10 @@ def main():
         '--sqlite_name', type = str, default = 'scans.sqlite',
         help = 'Name of the sqlite database file'
     )
+    cli.add_argument(
+        '--journal_mode', type = str, default = 'WAL', choices = ['WAL', 'DELETE'],
+        help = 'Journal mode of the database, WAL lets readers run concurrently but does not work on network filesystems'
+    )
     cli.add_argument(
         '--verbose', action=argparse.BooleanOptionalAction,
         help = 'This will log the whole content of the database and the storage which might clutter the output'
@@ -23,24 +28,85 @@ def main():
         '--move', action=argparse.BooleanOptionalAction,
         help = 'This needs to be explicitly set in order to mess with the filesystem, otherwise only dry run will be done.'
     )
+    cli.add_argument(
+        '--hash', action=argparse.BooleanOptionalAction,
+        help = 'In a dry run also hash the scans to tell how many are new, the hashes are cached for the subsequent insert'
+    )
+    cli.add_argument(
+        '--workers', type = int, default = 1,
+        help = 'Number of workers hashing scans concurrently'
+    )
+    cli.add_argument(
+        '--pool', type = str, default = 'thread', choices = ['thread', 'process'],
+        help = 'Kind of pool used for hashing, threads suffice as hashlib releases the GIL'
+    )
+    cli.add_argument(
+        '--move_workers', type = int, default = 1,
+        help = 'Number of workers moving scans into the storage concurrently, worth raising if the storage is on another device'
+    )
+    cli.add_argument(
+        '--queue_size', type = int, default = None,
+        help = 'Maximum number of scans between discovery and being recorded, by default twice the amount of workers'
+    )
+    cli.add_argument(
+        '--trust_fingerprint', action=argparse.BooleanOptionalAction,
+        help = 'Take scans whose size, head and tail match a stored scan as duplicates without hashing them completely'
+    )
+    cli.add_argument(
+        '--chunk_size', type = int, default = None,
+        help = 'Bytes read at once when hashing, by default python chooses'
+    )
+    cli.add_argument(
+        '--batch_size', type = int, default = 100,
+        help = 'Number of scans recorded in the database per transaction'
+    )
+    cli.add_argument(
+        '--layout', type = str, default = None,
+        help = 'Layout of a new storage, e.g. 2/2 for storage/ab/cd/<hash>/, by default the recorded one (or flat)'
+    )
+    cli.add_argument(
+        '--log_level', type = str, default = 'INFO', choices = ['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+        help = 'Level of the log messages, DEBUG includes a message and the timings per scan'
+    )
+    cli.add_argument(
+        '--metrics', type = str, default = None,
+        help = 'File the timings and counters per stage are written to, in the Prometheus text format if it ends with .prom (e.g. for the textfile collector of the node exporter) and as JSON otherwise'
+    )
 
     args = cli.parse_args()
     root_dir = args.root_dir
     ingress_dir = args.ingress_dir
     sqlite_name = args.sqlite_name
+    journal_mode = args.journal_mode
     verbose = args.verbose
     move = args.move
+    hash_scans = args.hash
+    workers = args.workers
+    pool = args.pool
+    move_workers = args.move_workers
+    queue_size = args.queue_size
+    batch_size = args.batch_size
+    chunk_size = args.chunk_size
+    trust_fingerprint = bool(args.trust_fingerprint)
+    layout = args.layout
+    configure_logging(args.log_level)
     
 
-    db = Db(root_dir, ingress_dir, sqlite_name)
+    db = Db(root_dir, ingress_dir, sqlite_name, journal_mode = journal_mode, trust_fingerprint = trust_fingerprint,
+            hash_chunk_size = chunk_size, layout = layout)
 
     if move:
-        db.insert_from_ingress()
+        db.insert_from_ingress(
+            workers = workers, pool = pool, batch_size = batch_size,
+            move_workers = move_workers, queue_size = queue_size
+        )
+        db.metrics.log_summary()
+        if args.metrics is not None:
+            db.metrics.write(args.metrics)
         if verbose:
             print('Done, your final storage looks like:')
             print(str(db))
     else:
-        db = Db(root_dir, ingress_dir, sqlite_name)
         if verbose:
             print('The storage currently looks like this')
             print(str(db))
@@ -49,6 +115,11 @@ def main():
         print(formats)
         print(f'Total amount of valid scans to be moved {len(valid_scans)}.')
         print(f'Formats present {formats}')
+        if hash_scans:
+            index = db.load_dedup_index()
+            hashed_scans = db.hash_many(valid_scans, workers = workers, pool = pool)
+            new_hashes = {scan.hash for scan in hashed_scans if not index.in_storage(scan)}
+            print(f'Amount of new scans not yet in storage {len(new_hashes)}.')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,54 @@
+from bellastore.database.db import Db
+from bellastore.utils.metrics import configure_logging
+import argparse
+import json
+import sys
+
+def main():
+    cli = argparse.ArgumentParser()
+    cli.add_argument(
+        '--root_dir', type = str, default = '/data/deep-learning/test',
+       help = 'Directory where sqlite and storage will be initialized under, in particular root_dir/storage/scans.sqlite'
+    )
+    cli.add_argument(
+        '--sqlite_name', type = str, default = 'scans.sqlite',
+        help = 'Name of the sqlite database file'
+    )
+    cli.add_argument(
+        '--journal_mode', type = str, default = 'WAL', choices = ['WAL', 'DELETE'],
+        help = 'Journal mode of the database, WAL lets readers run concurrently but does not work on network filesystems'
+    )
+    cli.add_argument(
+        '--check_files', action=argparse.BooleanOptionalAction,
+        help = 'Also check that every recorded file exists, which needs a stat per scan'
+    )
+    cli.add_argument(
+        '--repair', action=argparse.BooleanOptionalAction,
+        help = 'Fix the drift in the database, files are never touched. Untracked folders are hashed before they are recorded'
+    )
+    cli.add_argument(
+        '--format', type = str, default = 'text', choices = ['text', 'jsonl'],
+        help = 'Output plain text or one JSON object per line'
+    )
+    args = cli.parse_args()
+    configure_logging()
+
+    db = Db(root_dir = args.root_dir, ingress_dir = None, filename = args.sqlite_name, journal_mode = args.journal_mode)
+    try:
+        drift = db.reconcile(repair = bool(args.repair), check_files = bool(args.check_files))
+    finally:
+        db.close()
+    for kind, items in drift.items():
+        for item in items:
+            if args.format == 'jsonl':
+                print(json.dumps({'type': kind, 'item': item}))
+            else:
+                print(f"{kind}: {' -> '.join(item[1:]) if kind == 'moved' else item}")
+    if args.format == 'text':
+        print(', '.join(f"{len(items)} {kind}" for kind, items in drift.items()))
+    # after a repair only the unresolved folders are left
+    sys.exit(1 if (drift['unresolved'] if args.repair else any(drift.values())) else 0)
+
+
+if __name__ == '__main__':
+    main()
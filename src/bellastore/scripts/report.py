@@ -0,0 +1,52 @@
+from bellastore.database.db import Db
+from bellastore.database.report import write_report
+import argparse
+import sys
+
+def main():
+    cli = argparse.ArgumentParser()
+    cli.add_argument(
+        '--root_dir', type = str, default = '/data/deep-learning/test',
+       help = 'Directory where sqlite and storage will be initialized under, in particular root_dir/storage/scans.sqlite'
+    )
+    cli.add_argument(
+        '--sqlite_name', type = str, default = 'scans.sqlite',
+        help = 'Name of the sqlite database file'
+    )
+    cli.add_argument(
+        '--journal_mode', type = str, default = 'WAL', choices = ['WAL', 'DELETE'],
+        help = 'Journal mode of the database, WAL lets readers run concurrently but does not work on network filesystems'
+    )
+    cli.add_argument(
+        '--format', type = str, default = 'text', choices = ['text', 'jsonl'],
+        help = 'Output plain text or one JSON object per line'
+    )
+    cli.add_argument(
+        '--depth', type = int, default = 1,
+        help = 'Number of directory levels below the root summarized separately'
+    )
+    cli.add_argument(
+        '--entries', action=argparse.BooleanOptionalAction,
+        help = 'Also list every entry of the ingress and storage tables'
+    )
+    cli.add_argument(
+        '--batch_size', type = int, default = 1000,
+        help = 'Number of entries read from the database at once'
+    )
+    args = cli.parse_args()
+
+    db = Db(root_dir = args.root_dir, ingress_dir = None, filename = args.sqlite_name, journal_mode = args.journal_mode)
+    try:
+        write_report(
+            db, sys.stdout, format = args.format,
+            depth = args.depth, entries = bool(args.entries), batch_size = args.batch_size
+        )
+    except BrokenPipeError:
+        # e.g. piped into `head`
+        pass
+    finally:
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+from bellastore.database.db import Db
+from bellastore.utils.metrics import configure_logging
+import argparse
+
+def main():
+    cli = argparse.ArgumentParser()
+    cli.add_argument(
+        '--root_dir', type = str, default = '/data/deep-learning/test',
+       help = 'Directory where sqlite and storage will be initialized under, in particular root_dir/storage/scans.sqlite'
+    )
+    cli.add_argument(
+        '--sqlite_name', type = str, default = 'scans.sqlite',
+        help = 'Name of the sqlite database file'
+    )
+    cli.add_argument(
+        '--journal_mode', type = str, default = 'WAL', choices = ['WAL', 'DELETE'],
+        help = 'Journal mode of the database, WAL lets readers run concurrently but does not work on network filesystems'
+    )
+    cli.add_argument(
+        '--layout', type = str, required = True,
+        help = 'The new layout, the widths of the hash prefixes, e.g. 2/2 for storage/ab/cd/<hash>/, or flat'
+    )
+    cli.add_argument(
+        '--batch_size', type = int, default = 100,
+        help = 'Number of scans moved per transaction'
+    )
+    args = cli.parse_args()
+    configure_logging()
+
+    db = Db(root_dir = args.root_dir, ingress_dir = None, filename = args.sqlite_name, journal_mode = args.journal_mode)
+    try:
+        print(f'Resharding the storage from {db.layout} to {args.layout}')
+        moved = db.reshard(args.layout, batch_size = args.batch_size)
+        print(f'Moved {moved} scans')
+    finally:
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+from bellastore.database.db import Db
+from bellastore.database.scrub import Scrubber, format_result
+import argparse
+import json
+import sys
+
+def main():
+    cli = argparse.ArgumentParser()
+    cli.add_argument(
+        '--root_dir', type = str, default = '/data/deep-learning/test',
+       help = 'Directory where sqlite and storage will be initialized under, in particular root_dir/storage/scans.sqlite'
+    )
+    cli.add_argument(
+        '--sqlite_name', type = str, default = 'scans.sqlite',
+        help = 'Name of the sqlite database file'
+    )
+    cli.add_argument(
+        '--journal_mode', type = str, default = 'WAL', choices = ['WAL', 'DELETE'],
+        help = 'Journal mode of the database, WAL lets readers run concurrently but does not work on network filesystems'
+    )
+    cli.add_argument(
+        '--workers', type = int, default = 4,
+        help = 'Number of workers hashing stored scans concurrently'
+    )
+    cli.add_argument(
+        '--bandwidth', type = float, default = None,
+        help = 'Maximum MiB per second read by all workers together, unlimited by default'
+    )
+    cli.add_argument(
+        '--limit', type = int, default = None,
+        help = 'Maximum number of scans checked in this run, the next run continues after them'
+    )
+    cli.add_argument(
+        '--restart', action=argparse.BooleanOptionalAction,
+        help = 'Start from the first scan instead of where the last run stopped'
+    )
+    cli.add_argument(
+        '--orphans', action=argparse.BooleanOptionalAction, default = True,
+        help = 'Also report files in the storage that do not belong to a recorded scan'
+    )
+    cli.add_argument(
+        '--all', action=argparse.BooleanOptionalAction,
+        help = 'Also report the intact scans, not only the problems'
+    )
+    cli.add_argument(
+        '--format', type = str, default = 'text', choices = ['text', 'jsonl'],
+        help = 'Output plain text or one JSON object per line'
+    )
+    args = cli.parse_args()
+
+    db = Db(root_dir = args.root_dir, ingress_dir = None, filename = args.sqlite_name, journal_mode = args.journal_mode)
+    bandwidth = args.bandwidth * 2**20 if args.bandwidth else None
+    scrubber = Scrubber(db, workers = args.workers, bandwidth = bandwidth)
+    problems = 0
+    try:
+        for record in scrubber.run(limit = args.limit, restart = bool(args.restart), orphans = args.orphans):
+            intact = record.get('status') == 'ok'
+            problems += not intact
+            if intact and not args.all:
+                continue
+            print(json.dumps(record) if args.format == 'jsonl' else format_result(record), flush = True)
+    except KeyboardInterrupt:
+        print('Stopped, the next run continues from here', file = sys.stderr)
+    finally:
+        db.close()
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == '__main__':
+    main()
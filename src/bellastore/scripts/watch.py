@@ -0,0 +1,76 @@
+from bellastore.database.db import Db
+from bellastore.filesystem.watch import Watcher
+from bellastore.utils.metrics import configure_logging
+import argparse
+
+def main():
+    cli = argparse.ArgumentParser()
+    cli.add_argument(
+        '--root_dir', type = str, default = '/data/deep-learning/test',
+       help = 'Directory where sqlite and storage will be initialized under, in particular root_dir/storage/scans.sqlite'
+    )
+    cli.add_argument(
+        '--ingress_dir', type = str, default = '/data/deep-learning/test/slides',
+        help = 'Directory to be watched for new scans to be inserted into storage.'
+    )
+    cli.add_argument(
+        '--sqlite_name', type = str, default = 'scans.sqlite',
+        help = 'Name of the sqlite database file'
+    )
+    cli.add_argument(
+        '--journal_mode', type = str, default = 'WAL', choices = ['WAL', 'DELETE'],
+        help = 'Journal mode of the database, WAL lets readers run concurrently but does not work on network filesystems'
+    )
+    cli.add_argument(
+        '--settle', type = float, default = 30.0,
+        help = 'Seconds a scan has to stay unchanged (size and modification time) before it is inserted'
+    )
+    cli.add_argument(
+        '--interval', type = float, default = 5.0,
+        help = 'Seconds between two checks for changes'
+    )
+    cli.add_argument(
+        '--polling', action=argparse.BooleanOptionalAction,
+        help = 'Walk the ingress every interval instead of using inotify'
+    )
+    cli.add_argument(
+        '--workers', type = int, default = 1,
+        help = 'Number of workers hashing scans concurrently'
+    )
+    cli.add_argument(
+        '--pool', type = str, default = 'thread', choices = ['thread', 'process'],
+        help = 'Kind of pool used for hashing, threads suffice as hashlib releases the GIL'
+    )
+    cli.add_argument(
+        '--move_workers', type = int, default = 1,
+        help = 'Number of workers moving scans into the storage concurrently'
+    )
+    cli.add_argument(
+        '--log_level', type = str, default = 'INFO', choices = ['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+        help = 'Level of the log messages, DEBUG includes a message and the timings per scan'
+    )
+    cli.add_argument(
+        '--metrics', type = str, default = None,
+        help = 'File the timings and counters per stage are rewritten to after every insert, in the Prometheus text format if it ends with .prom and as JSON otherwise'
+    )
+
+    args = cli.parse_args()
+    configure_logging(args.log_level)
+
+    db = Db(args.root_dir, args.ingress_dir, args.sqlite_name, journal_mode = args.journal_mode)
+    watcher = Watcher(
+        db, settle = args.settle, interval = args.interval, use_inotify = not args.polling,
+        workers = args.workers, pool = args.pool, move_workers = args.move_workers,
+        metrics_path = args.metrics
+    )
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        print('Stopped watching')
+    finally:
+        watcher.close()
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,32 @@
+import gzip
+
+# compressions available for backups and the suffix of their files
+compression_suffixes = {
+    'gzip': '.gz',
+    'zstd': '.zst',
+}
+
+
+def open_compressed(path, mode: str = 'rb', compression: str | None = None):
+    '''
+    Opens a file for streaming (de)compression, by default guessing the compression from the suffix.
+
+    zstd is taken from the standard library (python >= 3.14) or the `zstandard` package,
+    which are only imported when needed.
+    '''
+    if compression is None:
+        compression = next((name for name, suffix in compression_suffixes.items() if str(path).endswith(suffix)), 'none')
+    if compression == 'none':
+        return open(path, mode)
+    if compression == 'gzip':
+        return gzip.open(path, mode)
+    if compression == 'zstd':
+        try:
+            from compression import zstd
+        except ImportError:
+            try:
+                import zstandard as zstd
+            except ImportError as e:
+                raise ImportError("zstd compression needs python >= 3.14 or zstandard, install bellastore[zstd]") from e
+        return zstd.open(path, mode)
+    raise ValueError(f"Unknown compression {compression}, choose one of {['none'] + list(compression_suffixes)}")
@@ -1,6 +1,9 @@
 from typing import List
 
-# TODO: currently .mrxs is not supported, this needs some implementation in the Scans.move function
+scan_extensions         : List[str]     = [".ndpi", ".svs",  ".tif", ".tiff", ".mrxs"]           # Used in `scan.py` for simply checking via `endswith` if the file is valid
+scan_extensions_glob    : List[str]     = ["*.ndpi", "*.svs", "*.tif", "*.tiff", "*.mrxs"]      # Used in `scan_database.py` to find all scanner files using globs
+multi_file_extensions   : List[str]     = [".mrxs"]                                 # Scans consisting of an index file and a companion folder of the same name
+mrxs_hash_workers       : int           = 8                                         # Threads hashing the files of a multi-file scan concurrently
 
-scan_extensions         : List[str]     = [".ndpi", ".svs",  ".tif", ".tiff"]        # Used in `scan.py` for simply checking via `endswith` if the file is valid
-scan_extensions_glob    : List[str]     = ["*.ndpi", "*.svs", "*.tif", "*.tiff"]    # Used in `scan_database.py` to find all scanner files using globs
\ No newline at end of file
+fingerprint_span        : int           = 4 * 2**20                                 # Bytes read from the head and the tail of a scan for its quick fingerprint, see `Scan.fingerprint_scan`
+hash_chunk_size         : int           = 2**20                                     # Bytes read at once when hashing with an explicit buffer, see `hashing.hash_file`
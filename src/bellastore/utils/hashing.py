@@ -0,0 +1,136 @@
+import os
+import time
+import hashlib
+import shutil
+import threading
+
+from .constants import hash_chunk_size
+
+
+def _advise_sequential(f):
+    '''
+    Hints the kernel that the file is read sequentially, so it reads ahead more aggressively.
+    '''
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        except OSError:
+            # e.g. not supported by the filesystem, it is only a hint anyway
+            pass
+
+
+class RateLimiter():
+    '''
+    A token bucket limiting the bytes read per second, shared by all threads reading through it.
+
+    Bursts of up to one second worth of bytes are allowed, reads beyond that wait.
+    '''
+
+    def __init__(self, bytes_per_second: float):
+        self.rate = bytes_per_second
+        self.tokens = bytes_per_second
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, amount: int):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            # going into debt keeps the lock short, the next readers wait for it to be paid off
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait:
+            time.sleep(wait)
+
+
+def hash_file(path: str, chunk_size: int | None = None, limiter: RateLimiter | None = None) -> bytes:
+    """
+    Hashes a single file using `sha256`.
+
+    The file is read unbuffered into a single reused buffer, so no bytes object
+    is allocated per chunk. Without an explicit chunk size `hashlib.file_digest`
+    is used where available (python >= 3.11), which does the same in C.
+
+    Args:
+        path (str): the path to the file
+        chunk_size (int | None): the number of bytes read at once
+        limiter (RateLimiter | None): if given, reading is throttled to its rate
+
+    Returns:
+        digest (bytes): the raw digest
+    """
+    if not os.path.isfile(path):
+        raise ValueError(f"{path} is not a file")
+    with open(path, "rb", buffering = 0) as f:
+        _advise_sequential(f)
+        if chunk_size is None and limiter is None and hasattr(hashlib, "file_digest"):
+            return hashlib.file_digest(f, "sha256").digest()
+        hash = hashlib.sha256()
+        buffer = bytearray(chunk_size or hash_chunk_size)
+        view = memoryview(buffer)
+        while True:
+            size = f.readinto(buffer)
+            if not size:
+                break
+            if limiter is not None:
+                limiter.consume(size)
+            hash.update(view[:size])
+        return hash.digest()
+
+
+def fsync_dir(path: str):
+    '''
+    Flushes a directory, so renames and new files within are durable.
+    '''
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        # not supported on every platform/filesystem
+        pass
+    finally:
+        os.close(fd)
+
+
+def copy_file(source: str, target: str, chunk_size: int | None = None) -> bytes:
+    """
+    Copies a single file while hashing it using `sha256` in the same pass.
+
+    The copy is written to a temporary file next to the target, flushed to disk
+    and only then renamed to the target, so the target never holds a partial copy.
+
+    Args:
+        source (str): the path to the file to be copied
+        target (str): the path of the copy
+        chunk_size (int | None): the number of bytes read at once
+
+    Returns:
+        digest (bytes): the raw digest of the copied content
+    """
+    partial = f"{target}.partial"
+    hash = hashlib.sha256()
+    buffer = bytearray(chunk_size or hash_chunk_size)
+    view = memoryview(buffer)
+    try:
+        with open(source, "rb", buffering = 0) as src, open(partial, "wb", buffering = 0) as dst:
+            _advise_sequential(src)
+            while True:
+                size = src.readinto(buffer)
+                if not size:
+                    break
+                hash.update(view[:size])
+                written = 0
+                while written < size:
+                    written += dst.write(view[written:size])
+            os.fsync(dst.fileno())
+        shutil.copystat(source, partial)
+        os.replace(partial, target)
+    except BaseException:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+    return hash.digest()
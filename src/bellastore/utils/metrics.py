@@ -0,0 +1,131 @@
+import os
+import json
+import time
+import logging
+import threading
+import contextlib
+from typing import Dict
+
+logger = logging.getLogger(__name__)
+
+# Stages of an insert, see `IngestPipeline`
+insert_stages = ['discover', 'hash', 'lookup', 'record', 'move', 'cleanup']
+# Prefix of the metric names in the Prometheus textfile
+metrics_prefix = 'bellastore'
+
+
+class Metrics():
+    '''
+    Thread-safe timings and counters of the stages of an insert.
+
+    Every timed unit of work (e.g. hashing a scan) is logged on debug level and added to the totals
+    of its stage: the number of units, their time, the slowest one and the bytes processed.
+    The totals are logged by `log_summary` and can be written as JSON or as a Prometheus textfile
+    (for the node exporter's textfile collector).
+
+    Attributes
+    ----------
+    stages: Dict[str, Dict]
+        Per stage the `count`, `seconds`, `max_seconds` and `bytes`
+    counters: Dict[str, int]
+        Named counters, e.g. `scans_stored`
+
+    Methods
+    -------
+    time:
+        Context manager timing a unit of work of a stage
+    observe:
+        Adds a unit of work of a stage
+    count:
+        Increments a counter
+    snapshot:
+        Returns the totals including the throughput per stage
+    write:
+        Writes the totals as JSON or, for a `.prom` path, in the Prometheus text format
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages: Dict[str, Dict] = {}
+        self.counters: Dict[str, int] = {}
+        self.started = time.time()
+
+    @contextlib.contextmanager
+    def time(self, stage: str, item: str | None = None, bytes: int = 0):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start, item, bytes)
+
+    def observe(self, stage: str, seconds: float, item: str | None = None, bytes: int = 0):
+        if item is not None:
+            logger.debug(f"{stage} {item}: {seconds:.3f}s")
+        with self.lock:
+            totals = self.stages.setdefault(stage, {'count': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'bytes': 0})
+            totals['count'] += 1
+            totals['seconds'] += seconds
+            totals['max_seconds'] = max(totals['max_seconds'], seconds)
+            totals['bytes'] += bytes or 0
+
+    def count(self, counter: str, amount: int = 1):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def snapshot(self) -> Dict:
+        with self.lock:
+            stages = {stage: dict(totals) for stage, totals in self.stages.items()}
+            counters = dict(self.counters)
+        for totals in stages.values():
+            totals['bytes_per_second'] = totals['bytes'] / totals['seconds'] if totals['seconds'] else 0.0
+        return {'started': self.started, 'seconds': time.time() - self.started, 'stages': stages, 'counters': counters}
+
+    def log_summary(self):
+        snapshot = self.snapshot()
+        # the stages of an insert in their order, followed by any others
+        order = lambda stage: insert_stages.index(stage) if stage in insert_stages else len(insert_stages)
+        for stage, totals in sorted(snapshot['stages'].items(), key = lambda item: order(item[0])):
+            line = f"{stage}: {totals['count']} in {totals['seconds']:.2f}s (max {totals['max_seconds']:.2f}s)"
+            if totals['bytes']:
+                line += f", {totals['bytes_per_second'] / 2**20:.1f} MiB/s"
+            logger.info(line)
+        for counter, value in sorted(snapshot['counters'].items()):
+            logger.info(f"{counter}: {value}")
+
+    def to_prometheus(self) -> str:
+        snapshot = self.snapshot()
+        lines = []
+        for name, key, kind, help in [
+            ('stage_seconds_total', 'seconds', 'counter', 'Time spent per stage'),
+            ('stage_max_seconds', 'max_seconds', 'gauge', 'Slowest unit of work per stage'),
+            ('stage_items_total', 'count', 'counter', 'Units of work per stage'),
+            ('stage_bytes_total', 'bytes', 'counter', 'Bytes processed per stage'),
+        ]:
+            lines.append(f"# HELP {metrics_prefix}_{name} {help}")
+            lines.append(f"# TYPE {metrics_prefix}_{name} {kind}")
+            for stage, totals in sorted(snapshot['stages'].items()):
+                lines.append(f'{metrics_prefix}_{name}{{stage="{stage}"}} {totals[key]}')
+        for counter, value in sorted(snapshot['counters'].items()):
+            lines.append(f"# TYPE {metrics_prefix}_{counter}_total counter")
+            lines.append(f"{metrics_prefix}_{counter}_total {value}")
+        lines.append(f"# TYPE {metrics_prefix}_last_run_timestamp_seconds gauge")
+        lines.append(f"{metrics_prefix}_last_run_timestamp_seconds {snapshot['started']}")
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path: str):
+        '''
+        Writes the totals to `path`, in the Prometheus text format if it ends with `.prom` and as JSON otherwise.
+        The file is replaced atomically, so a collector never reads a partial file.
+        '''
+        content = self.to_prometheus() if path.endswith('.prom') else json.dumps(self.snapshot(), indent = 1)
+        partial = f"{path}.partial"
+        with open(partial, 'w', encoding = 'utf-8') as f:
+            f.write(content)
+        os.replace(partial, path)
+
+
+def configure_logging(level: str = 'INFO'):
+    '''
+    Logs to the console with timestamps, as done by the scripts. The messages per scan are on `DEBUG` level.
+    '''
+    logging.basicConfig(level = getattr(logging, level.upper()), format = '%(asctime)s - %(levelname)s - %(message)s')
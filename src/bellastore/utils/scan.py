@@ -1,11 +1,21 @@
 import os
+import re
 import glob
 import hashlib
 import base64
 import shutil
+import errno
+import logging
 from typing import List
+from concurrent.futures import ThreadPoolExecutor
 
-from .constants import scan_extensions
+from .constants import scan_extensions, multi_file_extensions, fingerprint_span, mrxs_hash_workers
+from .hashing import hash_file, copy_file, fsync_dir
+
+logger = logging.getLogger(__name__)
+
+# The 32 bytes of a sha256 digest in url-safe base64, the last character only carries 4 bits
+scan_hash_pattern = re.compile(r"[A-Za-z0-9_-]{42}[AEIMQUYcgkosw048]=")
 
 
 class Scan():
@@ -20,13 +30,24 @@ class Scan():
         path (str): the full path to the scan, including the filename and ending
         filename (str): just the filename, without the extension
         hash (str | None, default = None): the hash of the file, empty per default
+        size (int | None, default = None): the size of the file in bytes, set by `fingerprint_scan`
+        fingerprint (str | None, default = None): the quick fingerprint of the file, empty per default
+        identity (tuple | None, default = None): the identity of the files, set by `get_identity`
 
     Methods
     -------
     <p>
         **get_filename**<em>(self, path) -> str</em><br>constructs the filename out of the full path<br>
         **is_valid**<em>(self) -> bool</em><br>checks if a given file file has a scanner-file ending<br>
-        **hash_scan**<em>(self) -> str | None</em><br>creates an unique hash for a scan using `sha256`
+        **is_multi_file**<em>(self) -> bool</em><br>checks if the scan consists of an index file and a companion folder (`.mrxs`)<br>
+        **get_files**<em>(self) -> List[str]</em><br>lists all files of a scan in a deterministic order<br>
+        **get_identity**<em>(self) -> tuple | None</em><br>amount, size and latest modification of all files of a scan<br>
+        **move**<em>(self, target_dir)</em><br>moves all files of a scan into the target directory<br>
+        **link**<em>(self, target_dir)</em><br>hard links all files of a scan into the target directory<br>
+        **stage**<em>(self, target_dir) -> str | None</em><br>copies a scan into the target directory while hashing it<br>
+        **remove**<em>(self)</em><br>deletes all files of a scan<br>
+        **hash_scan**<em>(self) -> str | None</em><br>creates an unique hash for a scan using `sha256`<br>
+        **fingerprint_scan**<em>(self) -> str | None</em><br>creates a cheap fingerprint out of the size, head and tail of a scan
     </p>
     """
     def __init__(self, path : str):
@@ -34,6 +55,9 @@ class Scan():
         self.scanname = self.get_scanname(path = self.path)
         self.filename = self.get_filename(path = self.path)
         self.hash : None | str = None
+        self.size : None | int = None
+        self.fingerprint : None | str = None
+        self.identity : None | tuple = None
 
 
     def get_scanname(self, path : str) -> str:
@@ -47,22 +71,159 @@ class Scan():
             filename (str): the filename without extension
         """
         return os.path.splitext(os.path.basename(path))[0]
-    # TODO: extend this for mxrs, currently this only works for files
-    def move(self, target_dir):
+    def get_mrxs_folder(self) -> str:
+        """
+        Returns the companion folder of a multi-file scan, which is named like the scan.
+        """
+        return os.path.splitext(self.path)[0]
+
+    def _top_level_paths(self) -> List[str]:
+        # the companion folder goes first, so the index file only appears once the scan is complete
+        if self.is_multi_file():
+            return [self.get_mrxs_folder(), self.path]
+        return [self.path]
+
+    def _rename(self, target_dir):
+        '''
+        Atomically renames the scan into the target directory, which only works within a filesystem.
+        '''
+        renamed = []
+        try:
+            for source in self._top_level_paths():
+                target = os.path.join(target_dir, os.path.basename(source))
+                if os.path.exists(target):
+                    raise FileExistsError(errno.EEXIST, "Target already exists", target)
+                os.rename(source, target)
+                renamed.append((source, target))
+        except OSError:
+            for source, target in reversed(renamed):
+                os.rename(target, source)
+            raise
+
+    def _copy(self, target_dir, verify: bool = False, chunk_size: int | None = None):
+        '''
+        Copies the scan into the target directory while hashing it in the same pass.
+        The source is only removed once all copies are flushed to disk (and verified).
         '''
-        Moves a scan file into the target directory
+        self._copy_files(target_dir, chunk_size, self.hash if verify else None)
+        if self.is_multi_file():
+            shutil.rmtree(self.get_mrxs_folder())
+        os.remove(self.path)
+
+    def _copy_files(self, target_dir, chunk_size: int | None = None, expected: str | None = None) -> List[bytes]:
         '''
+        Copies all files of the scan into the target directory and flushes them, keeping the source.
+        If the hash of the copy is not `expected`, the copy is dropped again.
+
+        Returns:
+            digests (List[bytes]): the raw digests of the files, see `_encode_digests`
+        '''
+        source_dir = os.path.dirname(self.path)
+        files = self.get_files()
+        targets = [os.path.join(target_dir, os.path.relpath(file, source_dir)) for file in files]
+        for target in targets:
+            if os.path.exists(target):
+                raise FileExistsError(errno.EEXIST, "Target already exists", target)
+        digests = []
+        try:
+            for file, target in zip(files, targets):
+                os.makedirs(os.path.dirname(target), exist_ok = True)
+                digests.append(copy_file(file, target, chunk_size))
+            if expected is not None and self._encode_digests(digests) != expected:
+                raise ValueError(f"Copy of {self.path} does not match the hash {expected}")
+        except BaseException:
+            # the source is untouched, so just drop what has been copied so far
+            for target in targets[:len(digests)]:
+                os.remove(target)
+            if self.is_multi_file():
+                shutil.rmtree(os.path.join(target_dir, os.path.basename(self.get_mrxs_folder())), ignore_errors = True)
+            raise
+        for dir in {os.path.dirname(target) for target in targets}:
+            fsync_dir(dir)
+        return digests
+
+    def stage(self, target_dir, chunk_size: int | None = None) -> str | None:
+        """
+        Copies the scan into the target directory and hashes it in the same pass, keeping the scan in place.
+        E.g. a scan on another filesystem than the storage is thus read only once, instead of once for
+        hashing and once more for copying it (see `move`).
+
+        Args:
+            target_dir (str): the directory to copy the scan into, which has to be empty
+            chunk_size (int | None): the number of bytes read at once
+
+        Returns:
+            hash (str | None): the scan's hash (if non-hashable this is `None` and nothing is copied)
+        """
+        if not self.is_valid():
+            logger.warning(f"{self.path} is not a valid slide and thus can not be hashed.")
+            return None
+        self.hash = self._encode_digests(self._copy_files(target_dir, chunk_size))
+        return self.hash
+
+    def link(self, target_dir):
+        '''
+        Hard links all files of the scan into the target directory, keeping the scan in place.
+        Where hard links are not supported the files are copied.
+        Existing files in the target directory are replaced, so an interrupted link can be repeated.
+        '''
+        source_dir = os.path.dirname(self.path)
+        target_dirs = set()
+        for file in self.get_files():
+            target = os.path.join(target_dir, os.path.relpath(file, source_dir))
+            os.makedirs(os.path.dirname(target), exist_ok = True)
+            partial = target + ".partial"
+            if os.path.lexists(partial):
+                os.remove(partial)
+            try:
+                os.link(file, partial)
+            except OSError:
+                shutil.copy2(file, partial)
+            os.replace(partial, target)
+            target_dirs.add(os.path.dirname(target))
+        for dir in target_dirs:
+            fsync_dir(dir)
+
+    def move(self, target_dir, verify: bool = False, chunk_size: int | None = None):
+        '''
+        Moves a scan into the target directory.
+        For multi-file scans the companion folder is moved alongside the index file.
+
+        Within a filesystem this is an atomic rename. Across filesystems (e.g. from a scanner share
+        to the storage) the files are copied and hashed in a single pass and the source is only removed
+        once the copy is flushed to disk.
+
+        Args:
+            target_dir (str): the directory to move the scan into
+            verify (bool): if the scan is copied, check the copy against the scan's hash before removing the source
+            chunk_size (int | None): the number of bytes read at once when copying
+        '''
+        source_path = self.path
+        target_path = os.path.join(target_dir, self.filename)
         try:
-            source_path = self.path
-            # It is crucial to create the target dir before shutil.move
             os.makedirs(target_dir, exist_ok = True)
-            shutil.move(self.path, target_dir)
-            self.path = os.path.join(target_dir, self.filename)
-            print(f"Successfully moved {source_path} into {self.path}")
+            try:
+                self._rename(target_dir)
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise e
+                logger.debug(f"{source_path} is on another device than {target_dir}, copying it")
+                self._copy(target_dir, verify, chunk_size)
+            fsync_dir(target_dir)
+            self.path = target_path
+            logger.debug(f"Successfully moved {source_path} into {self.path}")
         except Exception as e:
-            raise RuntimeError(f"File can not be moved from {self.path} into {self.path} due to: {e}")
+            raise RuntimeError(f"File can not be moved from {source_path} into {target_path} due to: {e}")
+
+    def remove(self):
+        '''
+        Deletes a scan, for multi-file scans including its companion folder.
+        '''
+        if self.is_multi_file():
+            shutil.rmtree(self.get_mrxs_folder(), ignore_errors = True)
+        os.remove(self.path)
+        self.path = None
 
-    
     def get_filename(self, path : str) -> str:
         """
         Returns the filename without the extension of a given path.
@@ -80,69 +241,151 @@ class Scan():
         """
         Checks if the slide has a scanner-file ending.
         These are `.mrxs`, `.svs`, `.ndpi` and `.tif`.
+        A `.mrxs` scan is only valid if its companion folder exists.
 
         Returns:
             is_valid (bool): bool indicating if the scan's path has a valid ending
         """
-        #scan_extensions = [".ndpi", ".svs", ".mrxs", ".tif"] # CARE
-        return any(self.path.endswith(ending) for ending in scan_extensions)
+        if not any(self.path.endswith(ending) for ending in scan_extensions):
+            return False
+        if self.is_multi_file():
+            return os.path.isdir(self.get_mrxs_folder())
+        return True
+
+    def is_multi_file(self) -> bool:
+        return any(self.path.endswith(ending) for ending in multi_file_extensions)
+
+    def get_files(self) -> List[str]:
+        """
+        Lists all files of a scan, i.e. the scan file itself followed by the files of
+        the companion folder for multi-file scans.
+
+        The companion files are sorted by their relative path (using `/` as separator),
+        as the order of `os.walk` differs between filesystems.
+
+        Returns:
+            files (List[str]): the full paths of all files of the scan
+        """
+        if not self.is_multi_file():
+            return [self.path]
+        mrxs_folder = self.get_mrxs_folder()
+        files = []
+        for root, _, filenames in os.walk(mrxs_folder):
+            for filename in filenames:
+                file_path = os.path.join(root, filename)
+                files.append((os.path.relpath(file_path, mrxs_folder).replace(os.sep, '/'), file_path))
+        return [self.path] + [file_path for _, file_path in sorted(files)]
 
-    # TODO: Lukas integrate and test for mxrs, more modular would also be nicer, e.g. _create_raw_hash,_hash_mxrs ...
-    def hash_scan(self) -> str | None:
+    def get_identity(self) -> tuple | None:
+        """
+        Returns the amount of files, their total size and the latest modification time (in ns) of a scan.
+        This changes as long as a scan is still being written, e.g. copied into the ingress.
+
+        Returns:
+            identity (tuple | None): the identity or `None` if (some of) the scan is gone
+        """
+        try:
+            files = self.get_files()
+            stats = [os.stat(file) for file in files]
+        except OSError:
+            return None
+        self.identity = (len(stats), sum(stat.st_size for stat in stats), max(stat.st_mtime_ns for stat in stats))
+        return self.identity
+
+    def hash_scan(
+            self, cache = None, chunk_size: int | None = None, workers: int = mrxs_hash_workers,
+            limiter = None
+        ) -> str | None:
         """
         Creates an url-safe, base64, utf-8 encoded hash for a scan.
         For scans that consist of more than a single file it hashes the whole directory.
         For non-hashable files it will return `None`.
 
+        Args:
+            cache (HashCache | None): if given, the hash is taken from the cache as long as
+                the file did not change and freshly computed hashes are stored in it
+            chunk_size (int | None): the number of bytes read at once, see `hashing.hash_file`
+            workers (int): the number of threads hashing the files of a multi-file scan
+            limiter (RateLimiter | None): if given, reading is throttled to its rate, see `hashing.RateLimiter`
+
         Returns:
             hash (str | None): the scan's hash (if non-hashable this is `None`)
         """
-        def hash_file(path) -> bytes:
-            """
-            Hashes a single file in chunks of 64kb
-            """
-            hash = hashlib.sha256()
-            if not os.path.isfile(path):
-                raise ValueError(f"{path} is not a file")
-            with open(path, "rb") as f:
-                while True:
-                    data = f.read(65536)
-                    if not data:
-                        break
-                    hash.update(data)
-            return hash.digest()
+        if cache is not None and self.is_valid():
+            hash = cache.lookup(self.path)
+            if hash is not None:
+                self.hash = hash
+                return hash
+            hash = self.hash_scan(chunk_size = chunk_size, workers = workers, limiter = limiter)
+            cache.store(self.path, hash)
+            return hash
 
         # Check if the slide even is hashable
         if not self.is_valid():
-            print(f"Slide is not valid and thus can not be hashed.")
-            return None
-        is_mrxs = self.path.endswith(".mrxs")
-        if not is_mrxs:
-            raw_hash = hash_file(self.path)
-            hash = base64.urlsafe_b64encode(raw_hash).decode("utf-8")
-            self.hash = hash
-            return base64.urlsafe_b64encode(raw_hash).decode("utf-8")
-
-        # For `.mrxs` files check if they are structured correctly
-        (mrxs_folder, _) = os.path.splitext(self.path)
-        if not os.path.isdir(mrxs_folder):
-            print(f"Invalid slide {self.path}: {mrxs_folder} is not a directory")
+            logger.warning(f"{self.path} is not a valid slide and thus can not be hashed.")
             return None
-
-        # For `.mrxs` files hash all the files one by one
-        hash = hashlib.sha256()
-        for root, _, files in os.walk(mrxs_folder):
-            for file in files:
-                file_path = os.path.join(root, file)
-                raw_hash = hash_file(file_path)
-                hash.update(raw_hash)
-        hash.update(hash_file(self.path))
-        hash = base64.urlsafe_b64encode(hash.digest()).decode("utf-8")
+        files = self.get_files()
+        if not self.is_multi_file():
+            digests = [hash_file(self.path, chunk_size, limiter)]
+        else:
+            # For `.mrxs` files hash all the files of the companion folder concurrently
+            with ThreadPoolExecutor(max_workers = workers) as executor:
+                digests = list(executor.map(lambda file_path: hash_file(file_path, chunk_size, limiter), files))
+        hash = self._encode_digests(digests)
         self.hash = hash
         return hash
 
+    def _encode_digests(self, digests: List[bytes]) -> str:
+        """
+        Combines the raw digests of all files of a scan (in the order of `get_files`) into its hash.
 
+        A single file scan is encoded directly, whereas for `.mrxs` files the digests
+        of the companion folder in sorted order are hashed, finally followed by the `.mrxs` file.
+        """
+        if not self.is_multi_file():
+            raw_hash = digests[0]
+        else:
+            hash = hashlib.sha256()
+            for digest in digests[1:]:
+                hash.update(digest)
+            hash.update(digests[0])
+            raw_hash = hash.digest()
+        return base64.urlsafe_b64encode(raw_hash).decode("utf-8")
+
+    def fingerprint_scan(self, span: int = fingerprint_span) -> str | None:
+        """
+        Creates a quick fingerprint of a scan out of its size and the first and last `span` bytes.
 
+        In contrast to `hash_scan` this reads at most `2 * span` bytes, independent of the size of the scan.
+        Two scans with different fingerprints are guaranteed to differ, whereas equal fingerprints
+        only indicate (but do not prove) equal content, see `Db.trust_fingerprint`.
+        For multi-file scans (`.mrxs`) and non-valid slides it will return `None`.
+
+        Args:
+            span (int): the number of bytes read from the head and the tail
+
+        Returns:
+            fingerprint (str | None): the scan's fingerprint
+        """
+        if not self.is_valid() or self.is_multi_file():
+            return None
+        size = os.path.getsize(self.path)
+        hash = hashlib.sha256(size.to_bytes(8, "little"))
+        with open(self.path, "rb") as f:
+            hash.update(f.read(span))
+            if size > span:
+                # for small files the tail simply continues right after the head
+                f.seek(max(size - span, span))
+                hash.update(f.read(span))
+        self.size = size
+        self.fingerprint = base64.urlsafe_b64encode(hash.digest()).decode("utf-8")
+        return self.fingerprint
 
     def __repr__(self) -> str:
-        return f"\nCurrent Path: {self.path}\nCurrent Filename: {self.filename}"
\ No newline at end of file
+        return f"\nCurrent Path: {self.path}\nCurrent Filename: {self.filename}"
+
+def is_scan_hash(name: str) -> bool:
+    """
+    Checks if `name` has the format of a scan's hash, i.e. an url-safe, base64 encoded sha256 digest.
+    """
+    return scan_hash_pattern.fullmatch(name) is not None
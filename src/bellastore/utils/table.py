@@ -0,0 +1,12 @@
+def format_bytes(amount: int) -> str:
+    '''
+    Renders an amount of bytes human readable, e.g. `1.5 GiB`.
+    '''
+    units = ['B', 'KiB', 'MiB', 'GiB', 'TiB', 'PiB']
+    for unit in units[:-1]:
+        if amount < 1024:
+            break
+        amount /= 1024
+    else:
+        unit = units[-1]
+    return f"{amount:.0f} {unit}" if unit == 'B' else f"{amount:.1f} {unit}"
@@ -5,7 +5,6 @@ import pytest
 import sqlite3
 from typing import List
 import functools
-import pandas as pd
 
 from bellastore.utils.scan import Scan
     
@@ -31,6 +30,20 @@ def create_scans_in_subfolders(path: Path, amount = 4) -> List[Scan]:
         scans.append(scan)
     return scans
 
+def create_mrxs_scan(path: Path, name = "mrxs_scan", amount = 4) -> Scan:
+    '''
+    A MIRAX scan consists of an index file and a companion folder of the same name
+    '''
+    p = path / f"{name}.mrxs"
+    p.write_text(f"Content of {name}.mrxs", encoding="utf-8")
+    folder = path / name
+    os.makedirs(folder / "sub", exist_ok = True)
+    (folder / "Slidedat.ini").write_text(f"Index of {name}", encoding="utf-8")
+    for i in range(amount):
+        (folder / f"Data{i:04d}.dat").write_text(f"Data {i} of {name}", encoding="utf-8")
+    (folder / "sub" / "Data.dat").write_text(f"Nested data of {name}", encoding="utf-8")
+    return Scan(str(p))
+
 def create_additional_files_in_subfolders(path: Path, amount = 4) -> List[Scan]:
     for i in range(amount):
         p = path / f"scan_{i}"
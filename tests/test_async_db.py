@@ -0,0 +1,48 @@
+import os
+import time
+import asyncio
+import threading
+
+from bellastore.database.db import Db
+from bellastore.database.async_db import AsyncDb
+
+
+def test_async_insert_and_queries(root_dir, ingress_dir):
+    async def run():
+        async with AsyncDb.open(root_dir, ingress_dir, 'scans.sqlite') as db:
+            scans = await db.insert_from_ingress()
+            entries = await db.get_entries_from_storage_db()
+            assert len(entries) == len(scans)
+            found = await asyncio.gather(*[db.get_scan_by_hash(entry[0]) for entry in entries])
+            assert found == entries
+            assert len(await db.get_scans_by_extension('.ndpi')) == len(entries)
+            assert await db.get_storage_page(limit = 2) == sorted(entries)[:2]
+            assert await db.create_backup()
+            return db.db
+    db = asyncio.run(run())
+    assert len([file for file in os.listdir(db.backup_dir) if '_backup_' in file]) == 1
+
+def test_async_queries_during_insert(root_dir, ingress_dir, monkeypatch):
+    # a slow insert neither blocks the event loop nor the queries
+    moving = threading.Event()
+    release = threading.Event()
+    move = Db.add_scan_to_storage
+    def slow_move(self, scan, target_dir = None):
+        moving.set()
+        release.wait()
+        move(self, scan, target_dir)
+    monkeypatch.setattr(Db, "add_scan_to_storage", slow_move)
+
+    async def run():
+        async with AsyncDb.open(root_dir, ingress_dir, 'scans.sqlite') as db:
+            inserting = asyncio.create_task(db.insert_from_ingress())
+            while not moving.is_set():
+                await asyncio.sleep(0.01)
+            start = time.monotonic()
+            assert await db.get_entries_from_storage_db() == []
+            assert time.monotonic() - start < 1.0
+            assert not inserting.done()
+            release.set()
+            scans = await inserting
+            assert len(await db.get_entries_from_storage_db()) == len(scans)
+    asyncio.run(run())
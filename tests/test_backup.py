@@ -0,0 +1,141 @@
+import gzip
+import shutil
+import sqlite3
+import pytest
+from os.path import join as _j
+from pathlib import Path
+from datetime import datetime, timedelta
+
+from bellastore.database.db import Db
+from bellastore.database.backup import BackupManifest, backup_timestamp
+
+
+def read_backup(path: Path, tmp_path: Path, table_name: str):
+    if path.suffix == '.gz':
+        with gzip.open(path, 'rb') as f:
+            (tmp_path / 'restored.sqlite').write_bytes(f.read())
+        path = tmp_path / 'restored.sqlite'
+    with sqlite3.connect(path) as conn:
+        return conn.execute(f"SELECT * FROM {table_name}").fetchall()
+
+def backups(db: Db):
+    return sorted(Path(db.backup_dir).glob('*_backup_*'))
+
+def test_backup_in_steps(root_dir, ingress_dir, tmp_path):
+    db = Db(root_dir, ingress_dir, 'scans.sqlite')
+    db.insert_from_ingress()
+    steps = []
+    assert db.create_backup(pages = 1, progress = lambda status, remaining, total: steps.append(remaining))
+    assert len(steps) > 1 and steps[-1] == 0
+    [backup] = backups(db)
+    assert read_backup(backup, tmp_path, 'storage') == db.get_entries_from_storage_db()
+
+def test_backup_with_concurrent_writer(root_dir, ingress_dir, tmp_path):
+    db = Db(root_dir, ingress_dir, 'scans.sqlite')
+    db.insert_from_ingress()
+    writer = sqlite3.connect(db.sqlite_path, isolation_level = None)
+    steps = []
+    def write_in_between(status, remaining, total):
+        # every commit of another connection restarts a stepwise copy
+        steps.append(remaining)
+        writer.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('writes', ?)", (len(steps), ))
+    try:
+        assert db.create_backup(pages = 1, progress = write_in_between)
+    finally:
+        writer.close()
+    assert len(steps) < 20 and steps[-1] == 0
+    [backup] = backups(db)
+    assert read_backup(backup, tmp_path, 'storage') == db.get_entries_from_storage_db()
+
+def test_backup_skipped_if_unchanged(root_dir, ingress_dir):
+    db = Db(root_dir, ingress_dir, 'scans.sqlite')
+    steps = []
+    progress = lambda status, remaining, total: steps.append(remaining)
+    assert db.create_backup(progress = progress)
+    assert len(steps) == 1
+    assert db.create_backup(progress = progress)
+    assert len(steps) == 1
+    # recording scans changes the version
+    version = db.get_meta('data_version')
+    db.insert_from_ingress()
+    assert db.get_meta('data_version') > version
+    assert db.create_backup(progress = progress)
+    assert len(steps) == 2
+    assert db.create_backup(progress = progress, force = True)
+    assert len(steps) == 3
+
+@pytest.mark.parametrize("compression", ["gzip", "zstd"])
+def test_compressed_backup(root_dir, ingress_dir, tmp_path, compression):
+    if compression == 'zstd':
+        try:
+            from compression import zstd
+        except ImportError:
+            pytest.importorskip('zstandard')
+    db = Db(root_dir, ingress_dir, 'scans.sqlite')
+    db.insert_from_ingress()
+    assert db.create_backup(compression = compression)
+    [backup] = backups(db)
+    assert backup.name.endswith({'gzip': '.sqlite.gz', 'zstd': '.sqlite.zst'}[compression])
+    if compression == 'gzip':
+        assert read_backup(backup, tmp_path, 'ingress') == db.get_entries_from_ingress_db()
+
+def test_failed_backup_leaves_nothing(root_dir, ingress_dir):
+    db = Db(root_dir, ingress_dir, 'scans.sqlite')
+    assert not db.create_backup(compression = 'lz4')
+    assert backups(db) == []
+    assert db.get_meta('backup_version') is None
+
+def test_backup_manifest(root_dir, ingress_dir):
+    db = Db(root_dir, ingress_dir, 'scans.sqlite')
+    for _ in range(3):
+        assert db.create_backup(force = True, max_backups = 2)
+    manifest = BackupManifest(db.backup_dir, 'scans')
+    # backups within the same second get distinct names
+    assert [entry['file'] for entry in manifest.entries] == [backup.name for backup in backups(db)][-2:]
+    for entry, backup in zip(manifest.entries, backups(db)):
+        assert entry['size'] == backup.stat().st_size
+    assert db.verify_backups() == {}
+
+def test_legacy_backups_are_adopted(root_dir, ingress_dir):
+    db = Db(root_dir, ingress_dir, 'scans.sqlite')
+    for day in range(1, 4):
+        shutil.copy(db.sqlite_path, _j(db.backup_dir, f"scans_backup_202401{day:02d}_120000.sqlite"))
+    manifest = BackupManifest(db.backup_dir, 'scans')
+    assert [entry['created'] for entry in manifest.entries] == [f"2024-01-{day:02d}T12:00:00" for day in range(1, 4)]
+
+def test_grandfather_father_son(tmp_path):
+    manifest = BackupManifest(tmp_path, 'scans')
+    start = datetime(2024, 1, 1)
+    # a backup every 6 hours for 60 days
+    for i in range(4 * 60):
+        created = start + timedelta(hours = 6 * i)
+        path = tmp_path / f"scans_backup_{created.strftime(backup_timestamp)}.sqlite"
+        path.write_bytes(b'backup')
+        manifest.add(path, created)
+    removed = manifest.retain(last = 2, daily = 7, weekly = 4, monthly = 3)
+    kept = [datetime.fromisoformat(entry['created']) for entry in manifest.entries]
+    assert len(removed) + len(kept) == 4 * 60
+    # the 2 newest, the newest of the last 7 days (6 more), of the last 4 weeks (2 more, the others
+    # are among the days) and of the last 3 months (1 more, january, as there is no backup in december)
+    assert len(kept) == len(set(kept)) == 2 + 6 + 2 + 1
+    assert datetime(2024, 2, 11, 18) in kept and datetime(2024, 2, 18, 18) in kept
+    assert kept[-1] == start + timedelta(hours = 6 * (4 * 60 - 1))
+    assert kept[0] == datetime(2024, 1, 31, 18)
+    assert sorted(path.name for path in tmp_path.glob('*.sqlite')) == sorted(entry['file'] for entry in manifest.entries)
+    assert BackupManifest(tmp_path, 'scans').entries == manifest.entries
+
+def test_verify_detects_broken_backups(root_dir, ingress_dir):
+    db = Db(root_dir, ingress_dir, 'scans.sqlite')
+    db.insert_from_ingress()
+    assert db.create_backup(max_backups = 3)
+    db.insert_from_ingress()
+    assert db.create_backup(max_backups = 3, compression = 'gzip', force = True)
+    [plain, compressed] = backups(db)
+    with open(plain, 'r+b') as f:
+        f.seek(200)
+        f.write(b'bitrot')
+    problems = db.verify_backups(workers = 2)
+    assert list(problems) == [plain.name]
+    assert 'checksum' in problems[plain.name][0]
+    compressed.unlink()
+    assert set(db.verify_backups()) == {plain.name, compressed.name}
@@ -0,0 +1,28 @@
+import os
+
+from bellastore.database.bench import create_sparse_scan, run_benchmarks, format_result, compare_results
+
+
+def test_sparse_scan(tmp_path):
+    scan = create_sparse_scan(tmp_path / "a" / "scan.ndpi", 2**20, seed = 1)
+    other = create_sparse_scan(tmp_path / "b" / "scan.ndpi", 2**20, seed = 2)
+    assert os.path.getsize(scan.path) == 2**20
+    assert scan.hash_scan() != other.hash_scan()
+
+def test_benchmark_smoke(tmp_path):
+    records = list(run_benchmarks(
+        tmp_path, scans = 5, size = 2**16, depth = 2, fanout = 2,
+        mrxs = 1, mrxs_files = 3, rows = 100, lookups = 10
+    ))
+    assert records[0]['scans'] == 6
+    stages = {record['stage']: record for record in records[1:]}
+    assert list(stages) == ['walk', 'hash', 'insert', 'fill', 'lookup', 'page', 'backup']
+    assert stages['insert']['items'] == 6
+    assert stages['page']['items'] == 106
+    assert stages['lookup']['latency_p95'] >= stages['lookup']['latency_p50']
+    for record in records:
+        assert format_result(record)
+    # only stages losing more than the tolerance are reported
+    slower = [dict(stages['hash'], items_per_second = stages['hash']['items_per_second'] / 2)]
+    assert compare_results(slower, [stages['hash']]) != []
+    assert compare_results([stages['hash']], [stages['hash']]) == []
@@ -1,8 +1,16 @@
 import os
 from os.path import join as _j
 import sqlite3
+import subprocess
+import sys
+import pytest
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 
 from bellastore.database.db import Db
+from bellastore.database.journal import IngestJournal
+from bellastore.utils.scan import Scan
+from bellastore.utils.constants import fingerprint_span
 
 
 def table_exists(sqlite_path, table_name: str):
@@ -25,4 +33,281 @@ def test_initialization(root_dir, ingress_dir):
     db = Db(root_dir, ingress_dir, 'scans.sqlite')
     check_tables_exists(db.sqlite_path)
 
-    
\ No newline at end of file
+    
+def test_dedup_index(root_dir, ingress_dir):
+    db = Db(root_dir, ingress_dir, 'scans.sqlite')
+    scans = db.insert_from_ingress()
+    index = db.load_dedup_index()
+    assert index.storage_hashes == {scan.hash for scan in scans}
+    assert {entry for entry in db.get_entries_from_ingress_db()} == index.ingress_keys
+
+def test_redelivered_scan_is_deleted(root_dir, ingress_dir):
+    # a scan that is dropped again at the very same path is recorded in ingress already
+    db = Db(root_dir, ingress_dir, 'scans.sqlite')
+    path = _j(ingress_dir, 'scan_0.ndpi')
+    db.insert_from_ingress()
+    for index in [None, db.load_dedup_index()]:
+        # empty ingress folders get cleaned up after inserting
+        os.makedirs(ingress_dir, exist_ok = True)
+        with open(path, 'w', encoding = 'utf-8') as f:
+            f.write('Content of scan_0.ndpi')
+        scan = Scan(path)
+        db.insert(scan, index)
+        assert scan.path is None
+        assert not os.path.exists(path)
+    assert len(db.get_entries_from_ingress_db()) == 4
+
+def count_rows(sqlite_path, table_name: str):
+    with sqlite3.connect(sqlite_path) as conn:
+        return conn.execute(f"SELECT COUNT(*) FROM {table_name}").fetchone()[0]
+
+def test_session_rolls_back_failing_scan(root_dir, ingress_dir):
+    db = Db(root_dir, ingress_dir, 'scans.sqlite')
+    scans = db.get_valid_scans_from_ingress()
+    for scan in scans:
+        scan.hash_scan()
+    # the third scan vanishes before it can be moved
+    os.remove(scans[2].path)
+    with pytest.raises(RuntimeError):
+        db.add_scans_to_storage_db(scans)
+    recorded = {entry[0] for entry in db.get_entries_from_storage_db()}
+    assert recorded == {scans[0].hash, scans[1].hash}
+    assert {entry[0] for entry in db.get_entries_from_ingress_db()} == recorded
+
+def test_session_commits_batches(root_dir, ingress_dir):
+    db = Db(root_dir, ingress_dir, 'scans.sqlite')
+    scans = db.get_valid_scans_from_ingress()
+    with db.session(batch_size = 2) as session:
+        db.add_scans_to_ingress_db(scans[0:2])
+        session.checkpoint()
+        assert count_rows(db.sqlite_path, 'ingress') == 0
+        session.checkpoint()
+        assert count_rows(db.sqlite_path, 'ingress') == 2
+        db.add_scans_to_ingress_db(scans[2:4])
+    assert count_rows(db.sqlite_path, 'ingress') == 4
+
+def test_wal_mode(root_dir, ingress_dir):
+    db = Db(root_dir, ingress_dir, 'scans.sqlite')
+    with sqlite3.connect(db.sqlite_path) as conn:
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0] == 'wal'
+    db.close()
+
+def test_connection_per_thread(root_dir, ingress_dir):
+    db = Db(root_dir, ingress_dir, 'scans.sqlite')
+    conn = db._connection()
+    assert conn is db._connection()
+    with ThreadPoolExecutor(max_workers = 1) as executor:
+        other = executor.submit(db._connection).result()
+    assert other is not conn
+    db.close()
+    with pytest.raises(sqlite3.ProgrammingError):
+        conn.execute("SELECT 1")
+
+def test_reader_during_ingest(root_dir, ingress_dir):
+    # a reader is neither blocked by nor sees the uncommitted batch of a running insert
+    db = Db(root_dir, ingress_dir, 'scans.sqlite')
+    reader = Db(root_dir, None, 'scans.sqlite', timeout = 0.1)
+    scans = db.get_valid_scans_from_ingress()
+    with db.session():
+        db.add_scans_to_ingress_db(scans[0:2])
+        assert reader.get_entries_from_ingress_db() == []
+    assert len(reader.get_entries_from_ingress_db()) == 2
+    reader.close()
+    db.close()
+
+@pytest.fixture(scope="function")
+def queried_db(root_dir, ingress_dir):
+    for filename in ['lung_1.svs', 'lung_2.tiff', 'liver_1.svs']:
+        with open(_j(ingress_dir, filename), 'w', encoding = 'utf-8') as f:
+            f.write(f'Content of {filename}')
+    db = Db(root_dir, ingress_dir, 'scans.sqlite')
+    db.insert_from_ingress()
+    return db
+
+def test_open_while_locked(root_dir, ingress_dir):
+    db = Db(root_dir, ingress_dir, 'scans.sqlite')
+    # another process holds the write lock, e.g. a running insert
+    writer = sqlite3.connect(db.sqlite_path, isolation_level = None)
+    writer.execute("BEGIN IMMEDIATE")
+    try:
+        reader = Db(root_dir, None, 'scans.sqlite', timeout = 0.5)
+        assert reader.get_entries_from_storage_db() == []
+        reader.close()
+    finally:
+        writer.execute("ROLLBACK")
+        writer.close()
+
+def test_queries(queried_db):
+    db = queried_db
+    entries = db.get_entries_from_storage_db()
+    assert len(entries) == 7
+    for entry in entries:
+        assert db.get_scan_by_hash(entry[0]) == entry
+        assert len(db.get_ingress_entries_by_hash(entry[0])) == 1
+    assert db.get_scan_by_hash('unknown') is None
+    assert [entry[3] for entry in db.get_scans_by_scanname('lung_1')] == ['lung_1']
+    assert [entry[3] for entry in db.get_scans_by_prefix('lung')] == ['lung_1', 'lung_2']
+    assert len(db.get_scans_by_prefix('')) == 7
+    assert {entry[2] for entry in db.get_scans_by_extension('.svs')} == {'lung_1.svs', 'liver_1.svs'}
+    assert len(db.get_scans_by_extension('ndpi')) == 4
+
+def test_pagination(queried_db):
+    db = queried_db
+    pages = []
+    page = db.get_storage_page(limit = 3)
+    while page:
+        pages.append(page)
+        page = db.get_storage_page(limit = 3, after = page[-1][0])
+    assert [len(page) for page in pages] == [3, 3, 1]
+    assert sorted(db.get_entries_from_storage_db()) == [entry for page in pages for entry in page]
+
+def test_queries_use_indexes(queried_db):
+    with sqlite3.connect(queried_db.sqlite_path) as conn:
+        for query in [
+            "SELECT * FROM storage WHERE scanname = 'a'",
+            "SELECT * FROM storage WHERE scanname >= 'a' AND scanname < 'b'",
+            "SELECT * FROM storage WHERE substr(filename, length(scanname) + 1) = '.svs'",
+            "SELECT * FROM ingress WHERE filepath = 'a'",
+        ]:
+            plan = ' '.join(str(row) for row in conn.execute(f"EXPLAIN QUERY PLAN {query}"))
+            assert 'USING INDEX' in plan
+
+def test_trusted_fingerprint_skips_hashing(root_dir, ingress_dir, monkeypatch):
+    db = Db(root_dir, ingress_dir, 'scans.sqlite', trust_fingerprint = True)
+    scans = db.insert_from_ingress()
+    assert len(db._read_all('fingerprints')) == 4
+    scan = [scan for scan in scans if scan.filename == 'scan_0.ndpi'][0]
+    # the same scan is delivered again under another name
+    os.makedirs(ingress_dir, exist_ok = True)
+    path = _j(ingress_dir, 'scan_0_again.ndpi')
+    with open(path, 'w', encoding = 'utf-8') as f:
+        f.write('Content of scan_0.ndpi')
+    def hash_scan(self):
+        raise AssertionError('Scan should not be hashed')
+    monkeypatch.setattr(Scan, 'hash_scan', hash_scan)
+    redelivered = db.insert_from_ingress()
+    assert redelivered[0].hash == scan.hash
+    assert redelivered[0].path is None
+    assert len(db.get_ingress_entries_by_hash(scan.hash)) == 2
+
+# The fingerprints taken by a dry run are recorded by the insert
+def test_dry_run_keeps_fingerprints(root_dir, ingress_dir, monkeypatch):
+    db = Db(root_dir, ingress_dir, 'scans.sqlite', trust_fingerprint = True)
+    list(db.hash_many(db.get_valid_scans_from_ingress()))
+    db.insert_from_ingress()
+    assert len(db._read_all('fingerprints')) == 4
+    # so the same scan delivered again under another name is identified by its fingerprint
+    path = _j(ingress_dir, 'scan_0_again.ndpi')
+    with open(path, 'w', encoding = 'utf-8') as f:
+        f.write('Content of scan_0.ndpi')
+    def hash_scan(self, *args, **kwargs):
+        raise AssertionError('Scan should not be hashed')
+    monkeypatch.setattr(Scan, 'hash_scan', hash_scan)
+    redelivered = db.insert_from_ingress()
+    assert redelivered[0].path is None
+    assert len(db.get_ingress_entries_by_hash(redelivered[0].hash)) == 2
+
+# A hash taken over from a trusted fingerprint is not cached, as another insert might not trust it
+def test_trusted_fingerprint_not_cached(root_dir, ingress_dir, monkeypatch):
+    paths = []
+    for name, middle in [('original', b'A'), ('lookalike', b'B')]:
+        # same size, head and tail, so the fingerprints are equal
+        path = _j(root_dir, f'{name}.svs')
+        with open(path, 'wb') as f:
+            f.truncate(3 * fingerprint_span)
+            f.seek(int(1.5 * fingerprint_span))
+            f.write(middle)
+        paths.append(path)
+    assert Scan(paths[0]).fingerprint_scan() == Scan(paths[1]).fingerprint_scan()
+    db = Db(root_dir, ingress_dir, 'scans.sqlite', trust_fingerprint = True)
+    shutil.move(paths[0], ingress_dir)
+    stored = len(db.insert_from_ingress())
+    shutil.move(paths[1], ingress_dir)
+    lookalike = _j(ingress_dir, 'lookalike.svs')
+    list(db.hash_many([Scan(lookalike)]))
+    assert db.hash_cache.lookup(lookalike) is None
+    # nor journaled by the pipeline, where an interrupted insert would leave it behind
+    journaled = []
+    hashed = IngestJournal.hashed
+    monkeypatch.setattr(IngestJournal, 'hashed', lambda self, scan: journaled.append(scan.path) or hashed(self, scan))
+    shutil.copy(lookalike, _j(root_dir, 'lookalike.svs'))
+    db.insert_from_ingress(workers = 2)
+    assert lookalike not in journaled
+    shutil.move(_j(root_dir, 'lookalike.svs'), ingress_dir)
+    db.close()
+
+    db = Db(root_dir, ingress_dir, 'scans.sqlite')
+    db.insert_from_ingress()
+    assert len(db.get_entries_from_storage_db()) == stored + 1
+    assert db.get_scans_by_scanname('lookalike')
+
+def test_fingerprint_storage(root_dir, ingress_dir, classic_db):
+    db = Db(root_dir, ingress_dir, 'scans.sqlite')
+    assert db.fingerprint_storage() == 2
+    assert db.fingerprint_storage() == 0
+    assert {entry[0] for entry in db._read_all('fingerprints')} == {entry[0] for entry in db.get_entries_from_storage_db()}
+
+def test_hash_cache(root_dir, ingress_dir, monkeypatch):
+    db = Db(root_dir, ingress_dir, 'scans.sqlite')
+    # a dry run fills the cache
+    hashes = {scan.path: scan.hash for scan in db.hash_many(db.get_valid_scans_from_ingress(), workers = 2)}
+    assert len(db.hash_cache) == 4
+    for path, hash in hashes.items():
+        assert db.hash_cache.lookup(path) == hash
+    # a changed file is not taken from the cache
+    changed = list(hashes)[0]
+    with open(changed, 'a', encoding = 'utf-8') as f:
+        f.write(' changed')
+    assert db.hash_cache.lookup(changed) is None
+    # so the insert only fingerprints and hashes the changed scan
+    hashed, fingerprinted = [], []
+    hash_scan, fingerprint_scan = Scan.hash_scan, Scan.fingerprint_scan
+    def counting_hash_scan(self, *args, **kwargs):
+        hashed.append(self.path)
+        return hash_scan(self, *args, **kwargs)
+    def counting_fingerprint_scan(self, *args, **kwargs):
+        fingerprinted.append(self.path)
+        return fingerprint_scan(self, *args, **kwargs)
+    monkeypatch.setattr(Scan, 'hash_scan', counting_hash_scan)
+    monkeypatch.setattr(Scan, 'fingerprint_scan', counting_fingerprint_scan)
+    db.insert_from_ingress()
+    assert hashed == [changed]
+    assert fingerprinted == [changed]
+    # entries of moved scans are gone
+    assert len(db.hash_cache) == 0
+
+def test_hash_cache_eviction(root_dir, ingress_dir):
+    db = Db(root_dir, ingress_dir, 'scans.sqlite')
+    scans = db.get_valid_scans_from_ingress()
+    for scan in scans:
+        scan.hash_scan(db.hash_cache)
+    os.remove(scans[0].path)
+    assert db.hash_cache.evict_stale(ingress_dir) == 1
+    assert db.hash_cache.evict_stale() == 0
+    assert len(db.hash_cache) == 3
+
+def test_read_columns(queried_db):
+    db = queried_db
+    columns = db.read_columns('storage')
+    assert list(columns) == ['hash', 'filepath', 'filename', 'scanname']
+    assert list(zip(*columns.values())) == db.get_entries_from_storage_db()
+    assert sorted(db.read_columns('storage', ['scanname'])['scanname']) == sorted(columns['scanname'])
+    assert db.read_columns('fingerprints', ['hash'])['hash'] != []
+
+def test_read_columns_empty(root_dir, ingress_dir):
+    db = Db(root_dir, ingress_dir, 'scans.sqlite')
+    assert db.read_columns('storage') == {'hash': [], 'filepath': [], 'filename': [], 'scanname': []}
+
+def test_pandas_is_optional():
+    # importing the database must not pay for importing pandas
+    result = subprocess.run(
+        [sys.executable, '-c', 'import sys, bellastore.database.db; print("pandas" in sys.modules)'],
+        capture_output = True, text = True, check = True
+    )
+    assert result.stdout.strip() == 'False'
+
+def test_read_all_pd(queried_db):
+    pd = pytest.importorskip('pandas')
+    df = queried_db._read_all_pd('storage')
+    assert isinstance(df, pd.DataFrame)
+    assert len(df) == 7
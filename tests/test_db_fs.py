@@ -5,10 +5,15 @@ from os.path import join as _j
 from pathlib import Path
 from typing import List
 import sqlite3
+import pytest
+import threading
+import time
+import shutil
 
+import bellastore.utils.scan
 from bellastore.utils.scan import Scan
 from bellastore.database.db import Db
-from conftest import get_files
+from conftest import get_files, create_scans, create_mrxs_scan
 
 def get_files_dirs(dir):
     files = Path(dir).rglob("*")
@@ -171,3 +176,402 @@ def test_classic_subfolder(root_dir, ingress_dir_with_subfolders, classic_db_sub
 
 
 
+# Hashing on a worker pool must yield the same result as the serial pipeline
+@pytest.mark.parametrize("pool", ["thread", "process"])
+def test_classic_parallel(root_dir, ingress_dir, classic_db, pool):
+    db = Db(root_dir, ingress_dir, 'scans.sqlite')
+    storage_scans = get_scans(_j(root_dir,'storage'))
+    scans = db.insert_from_ingress(workers = 3, pool = pool)
+
+    for scan in scans:
+        check_ingress_db(db, scan)
+    check_empty_ingress(db)
+
+    for scan in scans:
+        if scan.path:
+            storage_scans.append(scan)
+        else:
+            check_not_in_storage(db, [scan])
+
+    check_storage(db, storage_scans)
+    check_storage_db(db, storage_scans)
+
+def test_unknown_pool(root_dir, ingress_dir):
+    db = Db(root_dir, ingress_dir, 'scans.sqlite')
+    with pytest.raises(ValueError):
+        db.insert_from_ingress(workers = 2, pool = 'gpu')
+def test_mrxs(root_dir, ingress_dir):
+    create_mrxs_scan(Path(ingress_dir))
+    # the same slide delivered a second time
+    os.makedirs(_j(ingress_dir, "again"))
+    create_mrxs_scan(Path(ingress_dir) / "again")
+    db = Db(root_dir, ingress_dir, 'scans.sqlite')
+    scans = db.insert_from_ingress()
+    mrxs_scans = [scan for scan in scans if scan.filename == 'mrxs_scan.mrxs']
+    assert len(mrxs_scans) == 2
+    stored = [scan for scan in mrxs_scans if scan.path]
+    assert len(stored) == 1
+    check_storage_db(db, stored)
+    assert os.path.isfile(_j(db.storage_dir, stored[0].hash, 'mrxs_scan', 'Slidedat.ini'))
+    check_empty_ingress(db)
+
+# Duplicates within a batch have to wait for the move of their original
+def test_pipeline_duplicates(root_dir, ingress_dir):
+    for i in range(6):
+        folder = Path(ingress_dir) / f"delivery_{i}"
+        os.makedirs(folder)
+        create_scans(folder, amount = 3)
+    db = Db(root_dir, ingress_dir, 'scans.sqlite')
+    scans = db.insert_from_ingress(workers = 3, move_workers = 4, queue_size = 2)
+    assert len(scans) == 4 + 6 * 3
+    stored = [scan for scan in scans if scan.path]
+    assert len(stored) == 4
+    check_storage_db(db, stored)
+    assert len(db.get_entries_from_ingress_db()) == len(scans)
+    check_empty_ingress(db)
+
+# A slow stage blocks the stages before it instead of piling up scans
+def test_pipeline_backpressure(root_dir, ingress_dir, monkeypatch):
+    for i in range(10):
+        folder = Path(ingress_dir) / f"delivery_{i}"
+        os.makedirs(folder)
+        create_scans(folder, amount = 2)
+    db = Db(root_dir, ingress_dir, 'scans.sqlite')
+    release = threading.Event()
+    move = Db.add_scan_to_storage
+    def blocked_move(self, scan, target_dir = None):
+        release.wait()
+        move(self, scan, target_dir)
+    monkeypatch.setattr(Db, "add_scan_to_storage", blocked_move)
+    consumed = []
+    def discovered_scans():
+        for scan in db.iter_valid_scans_from_ingress():
+            consumed.append(scan)
+            yield scan
+    inserting = threading.Thread(target = db.insert_many, args = (discovered_scans(), ), kwargs = {'queue_size': 2})
+    inserting.start()
+    time.sleep(0.5)
+    # the slots, the queue and the scan waiting to be queued
+    assert len(consumed) <= 2 + 2 + 1
+    release.set()
+    inserting.join()
+    assert len(consumed) == 24
+    assert len(db.get_entries_from_storage_db()) == 4
+
+# Scans on another filesystem are copied and hashed in one pass, so they are read only once
+def test_pipeline_stages_other_device(root_dir, ingress_dir, monkeypatch):
+    create_mrxs_scan(Path(ingress_dir))
+    with open(_j(ingress_dir, 'scan_0_again.ndpi'), 'w', encoding = 'utf-8') as f:
+        f.write('Content of scan_0.ndpi')
+    db = Db(root_dir, ingress_dir, 'scans.sqlite', use_hash_cache = False)
+    expected = {Scan(scan.path).hash_scan() for scan in db.get_valid_scans_from_ingress()}
+    monkeypatch.setattr(Db, '_on_other_device', lambda self, path: path.startswith(ingress_dir))
+    read = []
+    copy_file = bellastore.utils.scan.copy_file
+    def counting_copy_file(source, target, chunk_size = None):
+        read.append(source)
+        return copy_file(source, target, chunk_size)
+    def hash_file(*args, **kwargs):
+        raise AssertionError('Scan should not be hashed on its own')
+    monkeypatch.setattr(bellastore.utils.scan, 'copy_file', counting_copy_file)
+    monkeypatch.setattr(bellastore.utils.scan, 'hash_file', hash_file)
+    scans = db.insert_from_ingress(workers = 2)
+    assert len(read) == len(set(read)) > 0
+    assert {scan.hash for scan in scans} == expected
+    assert len(db.get_entries_from_storage_db()) == 5
+    assert len(db.get_entries_from_ingress_db()) == 6
+    check_empty_ingress(db)
+    assert os.listdir(db.journal.staging_dir) == []
+    monkeypatch.undo()
+    for hash, filepath, filename, _ in db.get_entries_from_storage_db():
+        assert filepath == _j(db.get_scan_dir(hash), filename)
+        assert Scan(filepath).hash_scan() == hash
+
+# The connections of the threads of a run are closed with it, e.g. for a long running watcher
+def test_pipeline_closes_connections(root_dir, ingress_dir):
+    db = Db(root_dir, ingress_dir, 'scans.sqlite')
+    for i in range(5):
+        folder = Path(ingress_dir) / f"delivery_{i}"
+        os.makedirs(folder)
+        create_scans(folder, amount = 1)
+        db.insert_from_ingress(workers = 4)
+    # only the connection of the calling thread is left
+    assert len(db._connections) == 1
+
+# While waiting for a slow scan the pipeline does not hold the write lock
+def test_pipeline_releases_lock(root_dir, ingress_dir, monkeypatch):
+    db = Db(root_dir, ingress_dir, 'scans.sqlite')
+    release = threading.Event()
+    hash_scan = Scan.hash_scan
+    def slow_hash(self, *args, **kwargs):
+        if self.path.endswith('scan_3.ndpi'):
+            release.wait()
+        return hash_scan(self, *args, **kwargs)
+    monkeypatch.setattr(Scan, "hash_scan", slow_hash)
+    inserting = threading.Thread(target = db.insert_from_ingress)
+    inserting.start()
+    try:
+        time.sleep(0.5)
+        conn = sqlite3.connect(db.sqlite_path, timeout = 1)
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('other_writer', 1)")
+        conn.commit()
+        conn.close()
+    finally:
+        release.set()
+        inserting.join()
+    assert len(db.get_entries_from_storage_db()) == 4
+
+# Scans moved before a failure are still recorded and their folders cleaned up
+def test_pipeline_failure(root_dir, ingress_dir, monkeypatch):
+    nested = _j(ingress_dir, 'nested')
+    os.makedirs(nested)
+    with open(_j(nested, 'nested.ndpi'), 'w') as f:
+        f.write('nested')
+    db = Db(root_dir, ingress_dir, 'scans.sqlite')
+    move = Db.add_scan_to_storage
+    nested_moved = threading.Event()
+    def failing_move(self, scan, target_dir = None):
+        if scan.filename == 'scan_2.ndpi':
+            nested_moved.wait(5)
+            raise RuntimeError("Storage unavailable")
+        move(self, scan, target_dir)
+        if scan.filename == 'nested.ndpi':
+            nested_moved.set()
+    monkeypatch.setattr(Db, "add_scan_to_storage", failing_move)
+    with pytest.raises(RuntimeError):
+        db.insert_many(db.iter_valid_scans_from_ingress(), move_workers = 2)
+    for hash, filepath, filename, _ in db.get_entries_from_storage_db():
+        assert os.path.isfile(filepath)
+    assert not os.path.exists(nested)
+    failed = Scan(_j(ingress_dir, 'scan_2.ndpi'))
+    assert os.path.isfile(failed.path)
+    # the failed move is not left for recovery
+    assert (failed.path, 'hashed', failed.hash_scan(), None) in db.journal.entries()
+    assert not os.path.exists(db.get_scan_dir(failed.hash))
+    # nothing is lost, the next run inserts the rest
+    monkeypatch.undo()
+    db.insert_from_ingress()
+    assert len(db.get_entries_from_storage_db()) == 5
+    check_empty_ingress(db)
+
+# The folder names are enough to find drift between the storage table and the disk
+def test_reconcile(root_dir, ingress_dir):
+    db = Db(root_dir, ingress_dir, 'scans.sqlite')
+    scans = sorted(db.insert_from_ingress(), key = lambda scan: scan.hash)
+    assert db.reconcile() == {'missing': [], 'untracked': [], 'moved': []}
+    # a folder deleted, a scan renamed within its folder and a scan copied in by hand
+    shutil.rmtree(_j(db.storage_dir, scans[0].hash))
+    renamed = _j(db.storage_dir, scans[1].hash, 'renamed.ndpi')
+    os.rename(scans[1].path, renamed)
+    os.remove(scans[2].path)
+    manual = _j(ingress_dir, 'manual.svs')
+    with open(manual, 'w') as f:
+        f.write('manual')
+    untracked = _j(db.storage_dir, Scan(manual).hash_scan())
+    # neither named like a hash nor by the hash of the scan it holds
+    misnamed = [_j(db.storage_dir, 'untrackedhash'), _j(db.storage_dir, scans[0].hash[:-2] + 'A=')]
+    for folder in [untracked, *misnamed]:
+        os.makedirs(folder)
+        shutil.copy(manual, folder)
+    os.remove(manual)
+    with open(_j(db.storage_dir, 'notes.txt'), 'w') as f:
+        f.write('notes')
+
+    drift = db.reconcile()
+    assert drift['missing'] == [scans[0].hash]
+    assert drift['untracked'] == sorted([untracked, *misnamed, _j(db.storage_dir, 'notes.txt')])
+    # missing files within an existing folder are only found by checking the files
+    drift = db.reconcile(check_files = True)
+    assert drift['missing'] == sorted([scans[0].hash, scans[2].hash])
+    assert drift['moved'] == [(scans[1].hash, scans[1].path, renamed)]
+
+    drift = db.reconcile(repair = True, check_files = True)
+    assert drift['unresolved'] == sorted(misnamed)
+    assert db.get_scan_by_hash(scans[0].hash) is None
+    assert db.get_scan_by_hash(scans[1].hash) == (scans[1].hash, renamed, 'renamed.ndpi', 'renamed')
+    assert db.get_scan_by_hash(os.path.basename(untracked))[1] == _j(untracked, 'manual.svs')
+    assert db.get_scan_by_hash('untrackedhash') is None
+    # what is left can not be repaired in the database
+    drift = db.reconcile(check_files = True)
+    left = [*misnamed, _j(db.storage_dir, scans[2].hash), _j(db.storage_dir, 'notes.txt')]
+    assert drift == {'missing': [], 'untracked': sorted(left), 'moved': []}
+
+# A lost scan can be delivered again after the repair
+def test_reconcile_redelivery(root_dir, ingress_dir, tmp_path):
+    db = Db(root_dir, ingress_dir, 'scans.sqlite')
+    scan = db.insert_from_ingress()[0]
+    (_, ingress_path, _), = db.get_ingress_entries_by_hash(scan.hash)
+    shutil.copy(scan.path, tmp_path)
+    shutil.rmtree(os.path.dirname(scan.path))
+    db.reconcile(repair = True)
+    assert db.get_ingress_entries_by_hash(scan.hash) == []
+    shutil.copy(_j(tmp_path, scan.filename), ingress_path)
+    db.insert_from_ingress()
+    assert db.get_scan_by_hash(scan.hash)[1] == scan.path
+    assert os.path.isfile(scan.path)
+
+def test_reconcile_moved_root(root_dir, ingress_dir, tmp_path):
+    db = Db(root_dir, ingress_dir, 'scans.sqlite')
+    scans = db.insert_from_ingress()
+    db.close()
+    moved_root = str(tmp_path / 'moved')
+    shutil.move(root_dir, moved_root)
+    db = Db(moved_root, None, 'scans.sqlite')
+    drift = db.reconcile(repair = True)
+    assert len(drift['moved']) == len(scans)
+    assert db.reconcile() == {'missing': [], 'untracked': [], 'moved': []}
+    for hash, filepath, _, _ in db.get_entries_from_storage_db():
+        assert filepath.startswith(moved_root) and os.path.isfile(filepath)
+
+def test_sharded_layout(root_dir, ingress_dir):
+    db = Db(root_dir, ingress_dir, 'scans.sqlite', layout = '2/2')
+    scans = db.insert_from_ingress()
+    for scan in scans:
+        assert scan.path == _j(db.storage_dir, scan.hash[:2], scan.hash[2:4], scan.hash, scan.filename)
+    check_storage_db(db, scans)
+    assert db.reconcile(check_files = True) == {'missing': [], 'untracked': [], 'moved': []}
+    # the layout is recorded in the database
+    assert Db(root_dir, None, 'scans.sqlite').shards == [2, 2]
+    with pytest.raises(ValueError):
+        Db(root_dir, None, 'scans.sqlite', layout = 'flat')
+
+def test_reshard(root_dir, ingress_dir):
+    create_mrxs_scan(Path(ingress_dir))
+    db = Db(root_dir, ingress_dir, 'scans.sqlite')
+    scans = db.insert_from_ingress()
+    assert db.layout == 'flat'
+    for layout, prefix in [('1/2', lambda hash: [hash[:1], hash[1:3]]), ('flat', lambda hash: [])]:
+        assert db.reshard(layout, batch_size = 2) == len(scans)
+        for hash, filepath, filename, _ in db.get_entries_from_storage_db():
+            assert filepath == _j(db.storage_dir, *prefix(hash), hash, filename)
+            assert Scan(filepath).hash_scan() == hash
+        assert db.reconcile(check_files = True) == {'missing': [], 'untracked': [], 'moved': []}
+        assert Db(root_dir, None, 'scans.sqlite').layout == layout
+        # nothing left to do
+        assert db.reshard(layout) == 0
+
+# Other processes pick up the new layout of a reshard, so nothing is stored in the old one afterwards
+def test_reshard_elsewhere(root_dir, ingress_dir):
+    db = Db(root_dir, ingress_dir, 'scans.sqlite')
+    other = Db(root_dir, None, 'scans.sqlite')
+    assert other.reshard('2') == 0
+    scans = db.insert_from_ingress()
+    assert db.layout == '2'
+    for scan in scans:
+        assert scan.path == _j(db.storage_dir, scan.hash[:2], scan.hash, scan.filename)
+    assert other.reconcile(check_files = True) == {'missing': [], 'untracked': [], 'moved': []}
+    db.close()
+    other.close()
+
+def test_scoped_cleanup(root_dir, ingress_dir_with_subfolders):
+    db = Db(root_dir, ingress_dir_with_subfolders, 'scans.sqlite')
+    # empty folders the insert did not empty are kept, e.g. one prepared for the next delivery
+    prepared = _j(db.ingress_dir, 'prepared', 'nested')
+    os.makedirs(prepared)
+    outside = _j(db.root_dir, 'unrelated')
+    os.makedirs(outside)
+    folders = {os.path.dirname(scan.path) for scan in get_scans(db.ingress_dir)}
+    # the scan folders also hold a file not belonging to the scan, one of them is emptied
+    emptied = sorted(folders)[0]
+    for file in os.listdir(emptied):
+        if not file.endswith('.ndpi'):
+            os.remove(_j(emptied, file))
+    dirs = db.insert_many(get_scans(db.ingress_dir))
+    assert dirs == folders
+    db.remove_empty_parents(dirs)
+    assert not os.path.exists(emptied)
+    for folder in folders - {emptied}:
+        assert os.listdir(folder)
+    assert os.path.isdir(prepared)
+    assert os.path.isdir(outside)
+    assert os.path.isdir(db.ingress_dir)
+
+def test_journal_roll_forward(root_dir, ingress_dir):
+    # the insert died after moving a scan but before recording it
+    db = Db(root_dir, ingress_dir, 'scans.sqlite')
+    scan = get_scans(db.ingress_dir)[0]
+    ingress_path = scan.path
+    storage_path = db.journal.moving(scan)
+    scan.move(db.get_scan_dir(scan.hash))
+    assert db.journal.entries('moving') == [(ingress_path, 'moving', scan.hash, storage_path)]
+
+    db = Db(root_dir, ingress_dir, 'scans.sqlite')
+    scans = db.insert_from_ingress()
+    assert len(scans) == 3
+    assert db.get_scan_by_hash(scan.hash) == (scan.hash, storage_path, scan.filename, scan.scanname)
+    assert db.get_ingress_entries_by_hash(scan.hash) == [(scan.hash, ingress_path, scan.filename)]
+    assert db.journal.entries() == []
+    assert db.reconcile(check_files = True) == {'missing': [], 'untracked': [], 'moved': []}
+
+# The half-done move of a running insert is not rolled back by another one
+def test_journal_lock(root_dir, ingress_dir):
+    db = Db(root_dir, ingress_dir, 'scans.sqlite')
+    other = Db(root_dir, ingress_dir, 'scans.sqlite')
+    scan = Scan(_j(ingress_dir, 'scan_1.ndpi'))
+    scan.hash_scan()
+    with db.journal.lock():
+        db.journal.moving(scan)
+        inserted = []
+        thread = threading.Thread(target = lambda: inserted.extend(other.insert_from_ingress()))
+        thread.start()
+        thread.join(0.5)
+        assert thread.is_alive()
+        assert other.journal.entries() == [(scan.path, 'moving', scan.hash, _j(db.get_scan_dir(scan.hash), scan.filename))]
+        assert os.path.isfile(scan.path)
+    thread.join()
+    assert len(inserted) == 4
+    assert other.journal.entries() == []
+    db.close()
+    other.close()
+
+# A single insert is journaled as well, so a crash after its move leaves no orphan
+def test_journal_single_insert(root_dir, ingress_dir, monkeypatch):
+    db = Db(root_dir, ingress_dir, 'scans.sqlite')
+    scan = Scan(_j(ingress_dir, 'scan_1.ndpi'))
+    def crash(self, scan, ingress_path):
+        raise KeyboardInterrupt
+    monkeypatch.setattr(Db, 'record_stored_scan', crash)
+    with pytest.raises(KeyboardInterrupt):
+        db.insert(scan)
+    assert db.get_entries_from_storage_db() == []
+    (ingress_path, state, hash, storage_path), = db.journal.entries()
+    assert state == 'moving' and os.path.isfile(storage_path)
+    monkeypatch.undo()
+    db.insert_from_ingress()
+    assert db.get_scan_by_hash(hash)[1] == storage_path
+    assert db.get_ingress_entries_by_hash(hash) == [(hash, ingress_path, 'scan_1.ndpi')]
+    assert db.journal.entries() == []
+
+def test_journal_roll_back(root_dir, ingress_dir):
+    # the insert died halfway through renaming a MIRAX scan, only its folder arrived
+    scan = create_mrxs_scan(Path(ingress_dir))
+    db = Db(root_dir, ingress_dir, 'scans.sqlite')
+    scan.hash_scan()
+    db.journal.hashed(scan)
+    db.journal.moving(scan)
+    target_dir = db.get_scan_dir(scan.hash)
+    os.makedirs(target_dir)
+    os.rename(scan.get_mrxs_folder(), _j(target_dir, 'mrxs_scan'))
+
+    db = Db(root_dir, ingress_dir, 'scans.sqlite')
+    assert db.journal.recover()['rolled_back'] == [scan.path]
+    assert os.path.isdir(scan.get_mrxs_folder())
+    assert not os.path.exists(target_dir)
+    assert db.journal.entries() == [(scan.path, 'hashed', scan.hash, None)]
+    scans = db.insert_from_ingress()
+    assert len(scans) == 5
+    assert db.get_scan_by_hash(scan.hash)[1] == _j(target_dir, 'mrxs_scan.mrxs')
+    assert Scan(_j(target_dir, 'mrxs_scan.mrxs')).hash_scan() == scan.hash
+    assert db.journal.entries() == []
+
+def test_journal_resume_without_hashing(root_dir, ingress_dir, monkeypatch):
+    db = Db(root_dir, ingress_dir, 'scans.sqlite', use_hash_cache = False)
+    scans = get_scans(db.ingress_dir)
+    for scan in scans:
+        db.journal.hashed(scan)
+    def no_hashing(*args, **kwargs):
+        raise AssertionError('hashed again')
+    monkeypatch.setattr(Scan, "hash_scan", no_hashing)
+    db.insert_from_ingress()
+    assert {entry[0] for entry in db.get_entries_from_storage_db()} == {scan.hash for scan in scans}
+    assert db.journal.entries() == []
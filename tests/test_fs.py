@@ -3,9 +3,11 @@ from os.path import join as _j
 from pathlib import Path
 from typing import List
 import sqlite3
+import shutil
 
 from bellastore.utils.scan import Scan
 from bellastore.database.db import Db
+from bellastore.filesystem.fs import Fs
 from conftest import get_files
 
 def test_fs(root_dir, ingress_dir):
@@ -18,3 +20,37 @@ def test_fs_with_subfolders(root_dir, ingress_dir_with_subfolders):
     valid_scan_paths = {scan.path for scan in db.get_valid_scans_from_ingress()}
     assert valid_scan_paths.issubset(get_files(ingress_dir_with_subfolders))
 
+
+def test_iter_files(root_dir, ingress_dir_with_subfolders):
+    files = get_files(ingress_dir_with_subfolders)
+    assert set(Fs._iter_files(ingress_dir_with_subfolders)) == files
+    assert set(Fs._get_files(ingress_dir_with_subfolders)) == files
+    assert set(Fs._iter_files(ingress_dir_with_subfolders, ['.ndpi'])) == {file for file in files if file.endswith('.ndpi')}
+
+def test_iter_files_skips_vanished_dirs(root_dir, ingress_dir_with_subfolders):
+    # scans are moved while the ingress is still walked
+    files = Fs._iter_files(ingress_dir_with_subfolders)
+    first = next(files)
+    for folder in os.listdir(ingress_dir_with_subfolders):
+        if folder != os.path.basename(os.path.dirname(first)):
+            shutil.rmtree(_j(ingress_dir_with_subfolders, folder))
+    assert {first, *files} == get_files(ingress_dir_with_subfolders)
+
+def test_discovery_is_lazy(root_dir, ingress_dir):
+    db = Db(root_dir, ingress_dir, 'scans.sqlite')
+    scans = db.iter_valid_scans_from_ingress()
+    scan = next(scans)
+    assert scan.is_valid()
+    assert len(list(scans)) == 3
+
+def test_summarize_tree(root_dir, ingress_dir_with_subfolders):
+    fs = Fs(root_dir, ingress_dir_with_subfolders)
+    files = get_files(root_dir)
+    summary = fs.summarize_tree(depth = 1)
+    assert sum(counts['files'] for counts in summary['directories'].values()) == len(files)
+    assert sum(counts['bytes'] for counts in summary['directories'].values()) == sum(os.path.getsize(file) for file in files)
+    # deeper folders count towards their ancestor
+    ingress = os.path.relpath(ingress_dir_with_subfolders, root_dir).split(os.sep)[0]
+    assert summary['directories'][ingress]['files'] == len(get_files(ingress_dir_with_subfolders))
+    assert summary['formats']['.ndpi']['files'] == len([file for file in files if file.endswith('.ndpi')])
+    assert len(fs.summarize_tree(depth = 0)['directories']) == 1
@@ -0,0 +1,43 @@
+import json
+import logging
+
+from bellastore.database.db import Db
+from bellastore.utils.metrics import Metrics
+
+
+def test_metrics_totals(tmp_path):
+    metrics = Metrics()
+    metrics.observe('hash', 2.0, 'a.ndpi', 100)
+    metrics.observe('hash', 1.0, 'b.ndpi', 300)
+    metrics.count('scans_stored')
+    metrics.count('scans_stored')
+    with metrics.time('move'):
+        pass
+    snapshot = metrics.snapshot()
+    assert snapshot['stages']['hash'] == {
+        'count': 2, 'seconds': 3.0, 'max_seconds': 2.0, 'bytes': 400, 'bytes_per_second': 400 / 3.0
+    }
+    assert snapshot['stages']['move']['count'] == 1
+    assert snapshot['counters'] == {'scans_stored': 2}
+
+    metrics.write(str(tmp_path / 'metrics.json'))
+    assert json.loads((tmp_path / 'metrics.json').read_text())['counters'] == {'scans_stored': 2}
+    metrics.write(str(tmp_path / 'metrics.prom'))
+    lines = (tmp_path / 'metrics.prom').read_text().splitlines()
+    assert 'bellastore_stage_seconds_total{stage="hash"} 3.0' in lines
+    assert 'bellastore_stage_bytes_total{stage="hash"} 400' in lines
+    assert 'bellastore_scans_stored_total 2' in lines
+    assert not (tmp_path / 'metrics.prom.partial').exists()
+
+def test_insert_metrics(root_dir, ingress_dir, caplog):
+    db = Db(root_dir, ingress_dir, 'scans.sqlite')
+    with caplog.at_level(logging.DEBUG, logger = 'bellastore'):
+        scans = db.insert_from_ingress()
+    snapshot = db.metrics.snapshot()
+    for stage in ['discover', 'hash', 'lookup', 'record', 'move', 'cleanup']:
+        assert stage in snapshot['stages']
+    assert snapshot['stages']['hash']['count'] == len(scans)
+    assert snapshot['stages']['move']['bytes'] > 0
+    assert snapshot['counters']['scans_stored'] == len(scans)
+    # the timings per scan are logged on debug level
+    assert any(record.levelno == logging.DEBUG and record.getMessage().startswith('hash ') for record in caplog.records)
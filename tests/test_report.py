@@ -0,0 +1,37 @@
+import io
+import json
+
+from bellastore.database.db import Db
+from bellastore.database.report import iter_report, write_report
+
+
+def test_report(root_dir, ingress_dir):
+    db = Db(root_dir, ingress_dir, 'scans.sqlite')
+    scans = db.insert_from_ingress()
+    records = list(iter_report(db, entries = True, batch_size = 2))
+    tables = {record['table']: record['entries'] for record in records if record['type'] == 'table'}
+    assert tables == {'ingress': len(scans), 'storage': len(scans)}
+    entries = [record for record in records if record['type'] == 'entry' and record['table'] == 'storage']
+    assert sorted((entry['hash'], entry['filepath']) for entry in entries) == sorted((scan.hash, scan.path) for scan in scans)
+    total = [record for record in records if record['type'] == 'total'][0]
+    assert total['files'] >= len(scans)
+    # without entries only the summary is reported
+    assert [record['type'] for record in iter_report(db)].count('entry') == 0
+
+def test_report_formats(root_dir, ingress_dir):
+    db = Db(root_dir, ingress_dir, 'scans.sqlite')
+    db.insert_from_ingress()
+    out = io.StringIO()
+    write_report(db, out, format = 'jsonl')
+    records = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert records == list(iter_report(db))
+    out = io.StringIO()
+    write_report(db, out, format = 'text')
+    assert out.getvalue() == str(db)
+    assert 'storage table: 4 entries' in str(db)
+
+def test_iter_rows(root_dir, ingress_dir):
+    db = Db(root_dir, ingress_dir, 'scans.sqlite')
+    db.insert_from_ingress()
+    for table in ['ingress', 'storage']:
+        assert list(db.iter_rows(table, batch_size = 3)) == db._read_all(table)
@@ -2,6 +2,14 @@ import pytest
 from os.path import join as _j
 from pathlib import Path
 from bellastore.utils.scan import Scan
+from bellastore.utils.hashing import hash_file, RateLimiter
+import hashlib
+import errno
+import base64
+import os
+import shutil
+import time
+from conftest import create_mrxs_scan
 
 
 # Helpers
@@ -61,3 +69,122 @@ def test_hashing(ndpi_scan_path):
 def test_move_scan(ndpi_scan, target_dir):
     ndpi_scan.move(target_dir)
     assert [ndpi_scan.path] == get_all_files(target_dir)
+
+def test_fingerprint(root_dir):
+    paths = []
+    for i, middle in enumerate([b'a', b'a', b'b']):
+        path = _j(root_dir, f'scan_{i}.svs')
+        with open(path, 'wb') as f:
+            f.write(b'headhead' + middle * 100 + b'tailtail')
+        paths.append(path)
+    scans = [Scan(path) for path in paths]
+    fingerprints = [scan.fingerprint_scan(span = 8) for scan in scans]
+    assert scans[0].size == 116
+    # the fingerprint only covers head and tail, so it can not tell the middle apart
+    assert fingerprints[0] == fingerprints[1] == fingerprints[2]
+    assert scans[0].hash_scan() == scans[1].hash_scan() != scans[2].hash_scan()
+    # if the whole file is covered the fingerprint is exact
+    assert scans[0].fingerprint_scan() != scans[2].fingerprint_scan()
+
+def test_fingerprint_invalid(txt_scan_path):
+    assert Scan(txt_scan_path).fingerprint_scan() is None
+
+@pytest.mark.parametrize("chunk_size", [None, 1, 7, 2**20])
+def test_hash_file_chunk_size(root_dir, chunk_size):
+    path = _j(root_dir, 'test_scan.svs')
+    content = bytes(range(256)) * 100
+    with open(path, 'wb') as f:
+        f.write(content)
+    assert hash_file(path, chunk_size) == hashlib.sha256(content).digest()
+    scan = Scan(path)
+    assert scan.hash_scan(chunk_size = chunk_size) == Scan(path).hash_scan()
+
+@pytest.fixture(scope="function")
+def mrxs_scan(root_dir):
+    return create_mrxs_scan(root_dir)
+
+def test_mrxs_is_valid(mrxs_scan):
+    assert mrxs_scan.is_valid()
+    assert mrxs_scan.is_multi_file()
+    shutil.rmtree(mrxs_scan.get_mrxs_folder())
+    assert not mrxs_scan.is_valid()
+
+def test_mrxs_hashing_is_deterministic(mrxs_scan, monkeypatch):
+    files = mrxs_scan.get_files()
+    assert files[0] == mrxs_scan.path
+    assert [os.path.relpath(file, mrxs_scan.get_mrxs_folder()) for file in files[1:]] == [
+        'Data0000.dat', 'Data0001.dat', 'Data0002.dat', 'Data0003.dat', 'Slidedat.ini', _j('sub', 'Data.dat')
+    ]
+    expected = hashlib.sha256()
+    for file in files[1:] + files[:1]:
+        expected.update(hash_file(file))
+    expected = base64.urlsafe_b64encode(expected.digest()).decode("utf-8")
+    assert mrxs_scan.hash_scan() == expected
+    # the hash does not depend on the order the filesystem lists the files in
+    walk = os.walk
+    def reversed_walk(top):
+        for root, dirs, filenames in reversed(list(walk(top))):
+            yield root, dirs, filenames[::-1]
+    monkeypatch.setattr(os, 'walk', reversed_walk)
+    assert Scan(mrxs_scan.path).hash_scan(workers = 1) == expected
+
+def test_move_mrxs(mrxs_scan, target_dir):
+    files = {os.path.relpath(file, os.path.dirname(mrxs_scan.path)) for file in mrxs_scan.get_files()}
+    hash = mrxs_scan.hash_scan()
+    mrxs_scan.move(target_dir)
+    assert mrxs_scan.path == _j(target_dir, 'mrxs_scan.mrxs')
+    assert set(get_all_files(target_dir)).issuperset({_j(target_dir, file) for file in files})
+    assert Scan(mrxs_scan.path).hash_scan() == hash
+    mrxs_scan.remove()
+    assert get_all_files(target_dir) == []
+
+@pytest.fixture(scope="function")
+def across_devices(monkeypatch):
+    '''
+    Pretends that every rename crosses filesystems
+    '''
+    def rename(source, target):
+        raise OSError(errno.EXDEV, 'Invalid cross-device link')
+    monkeypatch.setattr(os, 'rename', rename)
+
+def test_move_renames_within_device(root_dir, target_dir):
+    path = create_scan_file(root_dir, 'test_scan.svs')
+    inode = os.stat(path).st_ino
+    scan = Scan(path)
+    scan.move(target_dir, verify = True)
+    assert os.stat(scan.path).st_ino == inode
+
+@pytest.mark.parametrize("multi_file", [False, True])
+def test_move_across_devices(root_dir, target_dir, across_devices, multi_file):
+    if multi_file:
+        scan = create_mrxs_scan(root_dir)
+    else:
+        path = _j(root_dir, 'test_scan.svs')
+        with open(path, 'wb') as f:
+            f.write(bytes(range(256)) * 1000)
+        scan = Scan(path)
+    source_files = scan.get_files()
+    hash = scan.hash_scan()
+    scan.move(target_dir, verify = True)
+    assert not any(os.path.exists(file) for file in source_files)
+    assert not any(file.endswith('.partial') for file in get_all_files(target_dir))
+    assert Scan(scan.path).hash_scan() == hash
+
+def test_move_across_devices_verifies(root_dir, target_dir, across_devices):
+    path = create_scan_file(root_dir, 'test_scan.svs')
+    scan = Scan(path)
+    scan.hash = 'not the hash of the scan'
+    with pytest.raises(RuntimeError):
+        scan.move(target_dir, verify = True)
+    # nothing is lost and nothing is left behind
+    assert scan.path == path and os.path.isfile(path)
+    assert get_all_files(target_dir) == []
+
+def test_rate_limiter():
+    limiter = RateLimiter(1000)
+    start = time.monotonic()
+    # a burst of one second worth of bytes passes right away
+    limiter.consume(1000)
+    assert time.monotonic() - start < 0.1
+    limiter.consume(500)
+    assert time.monotonic() - start >= 0.45
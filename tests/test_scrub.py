@@ -0,0 +1,50 @@
+import os
+from os.path import join as _j
+
+from bellastore.database.db import Db
+from bellastore.database.scrub import Scrubber
+
+
+def test_scrub(root_dir, ingress_dir):
+    db = Db(root_dir, ingress_dir, 'scans.sqlite')
+    scans = sorted(db.insert_from_ingress(), key = lambda scan: scan.hash)
+    corrupted, missing = scans[0], scans[1]
+    with open(corrupted.path, 'ab') as f:
+        f.write(b'bitrot')
+    os.remove(missing.path)
+    os.makedirs(_j(db.storage_dir, 'unknown'))
+    with open(_j(db.storage_dir, scans[2].hash, 'leftover.txt'), 'w') as f:
+        f.write('leftover')
+
+    records = list(Scrubber(db, workers = 2).run())
+    results = {record['hash']: record for record in records if record['type'] == 'scan'}
+    assert results[corrupted.hash]['status'] == 'mismatch'
+    assert results[missing.hash]['status'] == 'missing'
+    assert results[scans[2].hash]['status'] == results[scans[3].hash]['status'] == 'ok'
+    orphans = {record['filepath'] for record in records if record['type'] == 'orphan'}
+    assert orphans == {_j(db.storage_dir, 'unknown'), _j(db.storage_dir, scans[2].hash, 'leftover.txt')}
+    status = Scrubber(db).get_status(corrupted.hash)
+    assert status['status'] == 'mismatch' and status['verified_at'] is not None
+
+def test_scrub_resumes(root_dir, ingress_dir):
+    db = Db(root_dir, ingress_dir, 'scans.sqlite')
+    hashes = sorted(scan.hash for scan in db.insert_from_ingress())
+    scrubber = Scrubber(db, workers = 3, bandwidth = 2**30)
+    checked = lambda **kwargs: [record['hash'] for record in scrubber.run(orphans = False, **kwargs)]
+    assert checked(limit = 3) == hashes[:3]
+    assert db.get_meta('scrub_after') == hashes[2]
+    # continues where the last run stopped and starts over after a complete pass
+    assert checked() == hashes[3:]
+    assert checked(limit = 1) == hashes[:1]
+    assert checked(limit = 2, restart = True) == hashes[:2]
+
+def test_scrub_does_not_lock(root_dir, ingress_dir):
+    db = Db(root_dir, ingress_dir, 'scans.sqlite')
+    db.insert_from_ingress()
+    records = Scrubber(db, workers = 1).run(orphans = False)
+    assert next(records)['status'] == 'ok'
+    # e.g. an insert while the scrub is paused or hashing the next scan
+    writer = Db(root_dir, None, 'scans.sqlite', timeout = 0.5)
+    writer.set_meta('other_writer', 1)
+    writer.close()
+    assert len(list(records)) == 3
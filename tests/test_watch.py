@@ -0,0 +1,65 @@
+import os
+from os.path import join as _j
+import pytest
+
+from bellastore.database.db import Db
+from bellastore.filesystem.watch import Watcher
+from conftest import get_files
+
+
+@pytest.fixture(scope="function", params=[False, True], ids=["polling", "inotify"])
+def watcher(request, root_dir, ingress_dir):
+    db = Db(root_dir, ingress_dir, 'scans.sqlite')
+    watcher = Watcher(db, settle = 0.0, interval = 0.1, use_inotify = request.param)
+    yield watcher
+    watcher.close()
+    db.close()
+
+def test_watch_existing_scans(watcher):
+    # the first check only records the scans, they are inserted once they did not change
+    assert watcher.tick() == []
+    assert len(watcher.tick()) == 4
+    assert len(watcher.db.get_entries_from_storage_db()) == 4
+    assert get_files(watcher.db.ingress_dir) == set()
+    assert os.path.isdir(watcher.db.ingress_dir)
+
+def test_watch_waits_for_stable_scans(watcher):
+    watcher.tick()
+    watcher.tick()
+    folder = _j(watcher.db.ingress_dir, 'new')
+    os.makedirs(folder)
+    path = _j(folder, 'new_scan.svs')
+    with open(path, 'w', encoding = 'utf-8') as f:
+        f.write('first half')
+    assert watcher.tick(0.1) == []
+    # still being copied
+    with open(path, 'a', encoding = 'utf-8') as f:
+        f.write(' second half')
+    assert watcher.tick(0.1) == []
+    scans = watcher.tick(0.1)
+    assert [scan.filename for scan in scans] == ['new_scan.svs']
+    assert len(watcher.db.get_entries_from_storage_db()) == 5
+    # the emptied folder is cleaned up
+    assert not os.path.exists(folder)
+
+def test_watch_retries_failed_insert(watcher, monkeypatch):
+    insert_many = Db.insert_many
+    attempts = []
+    def failing_insert(self, scans, *args, **kwargs):
+        attempts.append(len(scans))
+        if len(attempts) == 1:
+            raise RuntimeError('storage not mounted')
+        return insert_many(self, scans, *args, **kwargs)
+    monkeypatch.setattr(Db, "insert_many", failing_insert)
+    watcher.tick()
+    # fails, nothing changes in the ingress afterwards
+    assert len(watcher.tick()) == 4
+    assert watcher.db.get_entries_from_storage_db() == []
+    assert set(watcher.failures.values()) == {1}
+    for _ in range(5):
+        watcher.tick(0.1)
+        if len(attempts) > 1:
+            break
+    assert attempts == [4, 4]
+    assert len(watcher.db.get_entries_from_storage_db()) == 4
+    assert watcher.failures == {}